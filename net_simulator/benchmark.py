@@ -0,0 +1,355 @@
+"""
+Load generation and benchmark for the agent network.
+
+Starts a system server and N MockExecutor agents on localhost with the stub LLM,
+drives the selected workloads with M synthetic users and reports throughput and
+latency percentiles per endpoint as JSON.
+
+    # in learn_a2a
+    python -m net_simulator.benchmark -n 4 -m 8 -d 10 -o result.json
+    python -m net_simulator.benchmark -n 4 -m 8 -d 10 --compare result.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+from uuid import uuid4
+
+import httpx
+from a2a.client import A2AClient
+from a2a.types import MessageSendParams, SendStreamingMessageRequest
+
+CWD = Path(__file__).parent
+CONFIG_FILE = Path(os.environ.get(
+    'NET_SIMULATOR_CONFIG', CWD / 'config' / 'config.json'))
+RESULTS_DIR = CWD / 'data' / 'benchmarks'
+WORKLOADS = ['register', 'discover', 'keepalive', 'chat', 'stream']
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[idx]
+
+
+class Recorder:
+    """
+    Collects latencies (seconds) and errors per endpoint.
+    Throughput is computed over the duration of the workload that hit the endpoint.
+    """
+
+    latencies: Dict[str, List[float]]
+    errors: Dict[str, int]
+    workloads: Dict[str, str]
+    elapsed: Dict[str, float]
+    current: str
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.workloads = {}
+        self.elapsed = {}
+        self.current = ''
+
+    async def measure(self, endpoint: str, call: Callable):
+        start = time.perf_counter()
+        try:
+            await call()
+        except Exception:
+            self.error(endpoint)
+            return
+        self.record(endpoint, time.perf_counter() - start)
+
+    def record(self, endpoint: str, latency: float):
+        self.workloads[endpoint] = self.current
+        self.latencies.setdefault(endpoint, []).append(latency)
+
+    def error(self, endpoint: str):
+        self.workloads[endpoint] = self.current
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self) -> Dict[str, dict]:
+        result = {}
+        for endpoint in sorted(self.workloads):
+            values = self.latencies.get(endpoint, [])
+            elapsed = self.elapsed.get(self.workloads[endpoint]) or 1
+            result[endpoint] = {
+                'count': len(values),
+                'errors': self.errors.get(endpoint, 0),
+                'throughput': round(len(values) / elapsed, 2),
+                'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+                'p50_ms': round(percentile(values, 50) * 1000, 3),
+                'p95_ms': round(percentile(values, 95) * 1000, 3),
+                'p99_ms': round(percentile(values, 99) * 1000, 3),
+            }
+        return result
+
+
+class Benchmark:
+    args: argparse.Namespace
+    manager_url: str
+    agent_urls: List[str]
+    agent_ids: List[str]
+    user_ids: List[str]
+    processes: List[subprocess.Popen]
+    recorder: Recorder
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.manager_url = f"http://localhost:{args.port}"
+        self.agent_urls = [
+            f"http://localhost:{args.agent_port + i}" for i in range(args.agents)]
+        self.agent_ids = []
+        self.user_ids = [f"bench-user-{i}" for i in range(args.users)]
+        self.processes = []
+        self.recorder = Recorder()
+        self.work_dir = Path(tempfile.mkdtemp(prefix='net_sim_bench_'))
+
+    def _write_config(self) -> Path:
+        source = CONFIG_FILE if CONFIG_FILE.exists() else CWD / 'config' / 'config_example.json'
+        config = json.loads(source.read_text())
+        config.setdefault('system', {})['port'] = self.args.port
+        config.setdefault('api_services', {})['stub'] = {
+            'api_key': 'stub',
+            'model': 'stub',
+            'latency': self.args.llm_latency
+        }
+        upstream = config.get('api_service', 'openai')
+        config['api_service'] = 'stub'
+        if self.args.llm_trace is not None:
+            # replay the responses recorded with the configured service instead of the stub
+            config['api_services']['replay'] = {
+                'mode': 'replay',
+                'upstream': upstream,
+                'trace': str(self.args.llm_trace.resolve()),
+                **({'latency': self.args.llm_latency} if self.args.llm_latency else {})
+            }
+            config['api_service'] = 'replay'
+        config['mock'] = {
+            'chunks': self.args.chunks,
+            'chunk_interval': self.args.chunk_interval
+        }
+        config['logging'] = {'level': 'WARNING'}
+        # the stub never fails, measure the network without the retry layer
+        config['llm_routing'] = {'enabled': False}
+
+        config_file = self.work_dir / 'config.json'
+        config_file.write_text(json.dumps(config, indent=2))
+        return config_file
+
+    def _spawn(self, module: str, *args: str, env: dict):
+        log_file = open(self.work_dir / 'nodes.log', 'ab')
+        self.processes.append(subprocess.Popen(
+            [sys.executable, '-m', module, *args],
+            cwd=CWD.parent, env=env, stdout=log_file, stderr=subprocess.STDOUT))
+
+    async def _wait_ready(self, client: httpx.AsyncClient, timeout: float = 60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                response = (await client.get(f"{self.manager_url}/agents/all")).json()
+                agents = {x['url']: x['agent_id'] for x in response['content']}
+                if all(url in agents for url in self.agent_urls):
+                    self.agent_ids = [agents[url] for url in self.agent_urls]
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+        raise TimeoutError(
+            f"Network did not start in {timeout}s, see {self.work_dir / 'nodes.log'}")
+
+    def start(self):
+        env = {**os.environ, 'NET_SIMULATOR_CONFIG': str(self._write_config())}
+        self._spawn('net_simulator.nodes.system_server', env=env)
+        time.sleep(2)
+        for i in range(self.args.agents):
+            self._spawn('net_simulator.nodes.public_agent', '-a', 'mock_agent',
+                        '-p', str(self.args.agent_port + i), env=env)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    # ------------------------------------------------------------------
+    # workloads, each one is run by every synthetic user until time is up
+    # ------------------------------------------------------------------
+
+    async def _post(self, client: httpx.AsyncClient, path: str, body: dict):
+        response = await client.post(f"{self.manager_url}{path}", json=body)
+        response.raise_for_status()
+        if response.json().get('status') == 'error':
+            raise RuntimeError(response.json().get('message'))
+
+    async def work_register(self, client: httpx.AsyncClient, user: int, i: int):
+        url = f"http://bench-{uuid4().hex}"
+        response = None
+
+        async def register():
+            nonlocal response
+            response = await client.post(f"{self.manager_url}/agents/register", json={
+                'name': 'Bench', 'category': 'Debug', 'url': url, 'expose': False})
+            response.raise_for_status()
+
+        await self.recorder.measure('/agents/register', register)
+        if response is not None:
+            agent_id = response.json()['agent_id']
+            await self.recorder.measure('/agents/unregister', lambda: self._post(
+                client, '/agents/unregister', {'agent_id': agent_id}))
+
+    async def work_discover(self, client: httpx.AsyncClient, user: int, i: int):
+        agent_id = self.agent_ids[(user + i) % len(self.agent_ids)]
+        await self.recorder.measure('/agents/discover', lambda: self._post(
+            client, '/agents/discover', {'agent_id': agent_id}))
+
+    async def work_keepalive(self, client: httpx.AsyncClient, user: int, i: int):
+        agent_id = self.agent_ids[(user + i) % len(self.agent_ids)]
+        await self.recorder.measure('/agents/keepalive', lambda: self._post(
+            client, '/agents/keepalive', {'agent_id': agent_id}))
+
+    async def work_chat(self, client: httpx.AsyncClient, user: int, i: int):
+        await self.recorder.measure('/user/chat', lambda: self._post(client, '/user/chat', {
+            'user_id': self.user_ids[user],
+            'conversation_id': f"bench-{user}-{i // 10}",
+            'message': [{'kind': 'text', 'text': f"Benchmark message {i}"}]
+        }))
+
+    async def work_stream(self, client: httpx.AsyncClient, user: int, i: int):
+        agent_url = self.agent_urls[(user + i) % len(self.agent_urls)]
+        a2a_client = A2AClient(httpx_client=client, url=agent_url)
+        request = SendStreamingMessageRequest(
+            id=uuid4().hex,
+            params=MessageSendParams(message={
+                'role': 'user',
+                'parts': [{'kind': 'text', 'text': f"Benchmark message {i}"}],
+                'messageId': uuid4().hex,
+            })
+        )
+
+        start = time.perf_counter()
+        first = None
+        try:
+            async for _ in a2a_client.send_message_streaming(request):
+                if first is None:
+                    first = time.perf_counter() - start
+        except Exception:
+            self.recorder.error('message/stream')
+            return
+        self.recorder.record('message/stream', time.perf_counter() - start)
+        self.recorder.record('message/stream:first_event', first or 0.0)
+
+    async def run_workload(self, name: str, client: httpx.AsyncClient):
+        work = getattr(self, f"work_{name}")
+        deadline = time.monotonic() + self.args.duration
+
+        async def user_loop(user: int):
+            i = 0
+            while time.monotonic() < deadline:
+                await work(client, user, i)
+                i += 1
+
+        self.recorder.current = name
+        start = time.perf_counter()
+        await asyncio.gather(*[user_loop(u) for u in range(len(self.user_ids))])
+        self.recorder.elapsed[name] = time.perf_counter() - start
+
+    async def run(self) -> dict:
+        limits = httpx.Limits(max_connections=self.args.users * 2)
+        async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+            await self._wait_ready(client)
+            for user_id in self.user_ids:
+                await self._post(client, '/user/register', {'user_id': user_id, 'user_name': user_id})
+
+            for name in self.args.workloads:
+                print(f"Running workload '{name}' for {self.args.duration}s...")
+                await self.run_workload(name, client)
+
+            await self._post(client, '/user/unregister_all', {})
+
+        return {
+            'commit': _git_commit(),
+            'timestamp': datetime.now().isoformat(),
+            'params': {k: v for k, v in vars(self.args).items() if k not in ('output', 'compare')},
+            'endpoints': self.recorder.summary(),
+        }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=CWD, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result: dict, baseline: dict):
+    """
+    Print the change of throughput and latency percentiles against a baseline result.
+    """
+    print(f"{'endpoint':<32}{'metric':<12}{'baseline':>12}{'current':>12}{'change':>10}")
+    for endpoint, current in result['endpoints'].items():
+        base = baseline['endpoints'].get(endpoint)
+        if base is None:
+            continue
+        for metric in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms'):
+            change = (current[metric] - base[metric]) / base[metric] * 100 if base[metric] else 0.0
+            print(f"{endpoint:<32}{metric:<12}{base[metric]:>12}{current[metric]:>12}{change:>+9.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the agent network on localhost.')
+    parser.add_argument('-n', '--agents', type=int, default=4, help='number of mock agents')
+    parser.add_argument('-m', '--users', type=int, default=8, help='number of concurrent synthetic users')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds to run each workload')
+    parser.add_argument('-w', '--workloads', type=lambda x: x.split(','), default=WORKLOADS,
+                        help=f"comma separated workloads out of {','.join(WORKLOADS)}")
+    parser.add_argument('--port', type=int, default=9080, help='port of the system server')
+    parser.add_argument('--agent-port', type=int, default=9500, help='port of the first mock agent')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='stub LLM latency in seconds')
+    parser.add_argument('--llm-trace', type=Path, default=None,
+                        help='replay LLM responses from this trace instead of the stub, see the replay service')
+    parser.add_argument('--chunks', type=int, default=10, help='artifact chunks per mock task')
+    parser.add_argument('--chunk-interval', type=float, default=0.0, help='seconds between mock chunks')
+    parser.add_argument('-o', '--output', type=Path, default=None, help='path of the JSON result')
+    parser.add_argument('--compare', type=Path, default=None, help='baseline JSON result to compare with')
+    args = parser.parse_args()
+
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"Unknown workload {name}")
+
+    bench = Benchmark(args)
+    bench.start()
+    try:
+        result = asyncio.run(bench.run())
+    finally:
+        bench.stop()
+
+    output = args.output
+    if output is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        output = RESULTS_DIR / f"{result['commit'] or 'unknown'}-{datetime.now():%Y%m%d%H%M%S}.json"
+    output.write_text(json.dumps(result, indent=2))
+
+    print(json.dumps(result['endpoints'], indent=2))
+    print(f"Result saved to {output}")
+
+    if args.compare:
+        compare(result, json.loads(args.compare.read_text()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,43 @@
+import asyncio
 import logging
-from typing import Dict, List
+import time
+from abc import abstractmethod
+from typing import Dict, List, Set, Tuple
+from uuid import uuid4
 
 from a2a.server.agent_execution import AgentExecutor, RequestContext
 from a2a.server.events import EventQueue
 from a2a.utils import new_task, new_agent_text_message
 from a2a.server.tasks import TaskUpdater
-from a2a.types import TextPart, FileWithBytes, FilePart
+from a2a.types import (Artifact, Task, TaskArtifactUpdateEvent, TaskNotCancelableError, TaskNotFoundError,
+                       TaskState, TextPart, FileWithBytes, FilePart)
+from a2a.utils.errors import ServerError
 from fastmcp.client.transports import PythonStdioTransport
 import httpx
 import traceback
 from numpy import isin
 from openai.types.chat import ChatCompletionMessageParam
 
-from net_simulator.utils import get_config, get_file, get_llm
+from net_simulator.media import prepare_media
+from net_simulator.usage import UsageContext, usage_context
+from net_simulator.utils import AGENT_SERVICE_SCRIPT, acquire_file, agent_service_env, get_llm, get_settings, release_files
+
+TERMINAL_STATES = {TaskState.completed, TaskState.canceled, TaskState.failed, TaskState.rejected}
 
 
 class ExecutorBase(AgentExecutor):
     logger: logging.Logger
     task_messages: Dict[str, List[ChatCompletionMessageParam]]
     agent_id: str
+    manager_url: str
+    _background: Set[asyncio.Task]
+    _running: Dict[str, Tuple[asyncio.Task, EventQueue]]
 
     async def _post_task_start(self):
         try:
             async with httpx.AsyncClient() as client:
                 await client.post(
-                    f"http://localhost:{get_config('system.port')}/task_count/add",
+                    f"{self.manager_url}/task_count/add",
                     json={'agent_id': self.agent_id}
                 )
         except Exception:
@@ -34,31 +47,185 @@ class ExecutorBase(AgentExecutor):
         try:
             async with httpx.AsyncClient() as client:
                 await client.post(
-                    f"http://localhost:{get_config('system.port')}/task_count/delete",
+                    f"{self.manager_url}/task_count/delete",
                     json={'agent_id': self.agent_id}
                 )
         except Exception:
             pass
 
-    def _replace_file_part(self, part: FilePart) -> FilePart:
+    def _set_usage_context(self, context: RequestContext, task: Task) -> str | None:
+        """
+        Attribute the LLM usage of this task to the agent and the user it works for.
+        Returns the user ID, which senders pass in the message metadata.
+        """
+        metadata = context.message.metadata or {}
+        user_id = metadata.get('user_id')
+        usage_context.set(UsageContext(task_id=task.id, agent_id=self.agent_id, user_id=user_id))
+        return user_id
+
+    async def _replace_file_part(self, part: FilePart, task_id: str) -> FilePart:
         """
         Replace the FilePart with a new FilePart that contains the file bytes.
         This is used to ensure that the file bytes are available in the task messages.
+        The bytes are normalized for the LLM (see `prepare_media`). The file is kept while
+        the task runs, it may pass the ID on to other agents, and is charged to the file quota
+        of this agent.
         """
-        file_bytes, mime_type = get_file(part.file.bytes)
-        if file_bytes is None:
+        acquired = acquire_file(part.file.bytes, f"task:{task_id}", owner=self.agent_id)
+        file = await prepare_media(part.file.bytes) if acquired else None
+        if file is None:
             raise ValueError(
                 f"File {part.file.name} not found in the file system.")
+        file_bytes, mime_type = file
         self.logger.info(
             f"File(id={part.file.bytes}, type={mime_type}, size={len(file_bytes)})")
         part.file.bytes = file_bytes
         part.file.mimeType = mime_type
         return part
 
+    async def _cancel_children(self, task_id: str):
+        try:
+            async with httpx.AsyncClient(timeout=30) as client:
+                await client.post(
+                    f"{self.manager_url}/tasks/cancel",
+                    json={'task_id': task_id}
+                )
+        except Exception as e:
+            self.logger.warning(f"Task({task_id}) failed to cancel delegated tasks: {e}")
+
+    @abstractmethod
+    async def _execute(self, context: RequestContext, event_queue: EventQueue) -> None:
+        pass
+
+    async def execute(self, context: RequestContext, event_queue: EventQueue) -> None:
+        """
+        Run `_execute`, keeping track of it so `cancel` can stop it.
+        """
+        self._running[context.task_id] = (asyncio.current_task(), event_queue)
+        try:
+            await self._execute(context, event_queue)
+        except asyncio.CancelledError:
+            # stopped by `cancel`: return normally, the request handler does not expect
+            # a cancelled execution and would not close the request otherwise
+            if context.task_id in self._running:
+                raise
+        finally:
+            self._running.pop(context.task_id, None)
+            release_files(f"task:{context.task_id}")
+
+    async def cancel(self, context: RequestContext, event_queue: EventQueue) -> None:
+        """
+        Stop the running `execute` of the task, which aborts its LLM request and MCP tool calls,
+        mark the task canceled and cancel the tasks it delegated to other agents.
+        """
+        task = context.current_task
+        if task is None:
+            raise ServerError(error=TaskNotFoundError())
+        if task.status.state in TERMINAL_STATES:
+            raise ServerError(error=TaskNotCancelableError())
+
+        self.logger.info(f"Task({task.id}) canceled")
+        self.task_messages.pop(task.id, None)
+        running, queue = self._running.pop(task.id, (None, event_queue))
+        # the final event goes to the queue of the running request, which ends its stream.
+        # The cancel request taps that queue.
+        updater = TaskUpdater(queue, task.id, task.contextId)
+        await updater.update_status(
+            TaskState.canceled,
+            new_agent_text_message(text='Task canceled.', context_id=task.contextId, task_id=task.id),
+            final=True
+        )
+        if running is not None:
+            # not awaited: the request handler cancels the same task right after, both requests
+            # end in the one CancelledError `execute` returns from
+            running.cancel()
+
+        # do not hold up the cancel response while the delegated tasks are cancelled
+        children = asyncio.create_task(self._cancel_children(task.id))
+        self._background.add(children)
+        children.add_done_callback(self._background.discard)
+
     def __init__(self, agent_id: str):
         self.logger = logging.getLogger('uvicorn')
         self.task_messages = {}
         self.agent_id = agent_id
+        self.manager_url = f"http://localhost:{get_settings().system.port}"
+        self._background = set()
+        self._running = {}
+
+
+class ArtifactStreamer:
+    """
+    Sends the text deltas of a response as appended chunks of one artifact.
+    Deltas are buffered until `llm.stream_flush_chars` characters or `llm.stream_flush_interval` seconds.
+    The text of turns that end in tool calls is replaced by the next turn, see `reset`.
+    """
+
+    event_queue: EventQueue
+    task: Task
+    name: str
+    artifact_id: str
+    chunks: int
+    flush_chars: int
+    flush_interval: float
+
+    def __init__(self, event_queue: EventQueue, task: Task, name: str):
+        options = get_settings().llm
+        self.event_queue = event_queue
+        self.task = task
+        self.name = name
+        self.artifact_id = str(uuid4())
+        self.chunks = 0
+        self.flush_chars = options.stream_flush_chars
+        self.flush_interval = options.stream_flush_interval
+        self._buffer = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        # chunks were sent before a reset: the next chunk replaces them
+        self._replace = False
+
+    async def _send(self, text: str, last_chunk: bool):
+        await self.event_queue.enqueue_event(
+            TaskArtifactUpdateEvent(
+                artifact=Artifact(
+                    name=self.name,
+                    parts=[TextPart(text=text)],
+                    artifactId=self.artifact_id,
+                ),
+                taskId=self.task.id,
+                contextId=self.task.contextId,
+                append=self.chunks > 0,
+                lastChunk=last_chunk
+            )
+        )
+        self.chunks += 1
+        self._buffer, self._size = [], 0
+        self._last_flush = time.monotonic()
+        self._replace = False
+
+    async def write(self, text: str):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self.flush_chars or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self._send(''.join(self._buffer), last_chunk=False)
+
+    async def reset(self):
+        """
+        Discard the text of a turn that ended in tool calls: the next chunk replaces the
+        artifact content instead of being appended to it.
+        """
+        self._buffer, self._size = [], 0
+        self._replace = self._replace or self.chunks > 0
+        self.chunks = 0
+
+    async def close(self) -> bool:
+        """
+        Flush the buffered text as the last chunk. Returns False if no text was streamed.
+        """
+        if not self.chunks and not self._buffer and not self._replace:
+            return False
+        await self._send(''.join(self._buffer), last_chunk=True)
+        return True
 
 
 class GeneralTextExecutor(ExecutorBase):
@@ -70,36 +237,51 @@ class GeneralTextExecutor(ExecutorBase):
     name: str
     mcp_configs: dict | None = None
 
-    async def execute(self, context: RequestContext, event_queue: EventQueue) -> None:
+    def _transport(self, task_id: str, user_id: str | None) -> PythonStdioTransport | dict:
+        """
+        MCP transport of a task: the `mcp_configs`, or the agent service if there are none.
+        """
+        # the agent service links the tasks it delegates to this one, so cancelling cascades.
+        # It is passed in the environment with the config file, which `endpoint_key` ignores:
+        # the cached tool listings and results are shared across tasks.
+        if not self.mcp_configs:
+            return PythonStdioTransport(
+                script_path=AGENT_SERVICE_SCRIPT,
+                args=['-i', self.agent_id, '-r', 'agent', *(['-u', user_id] if user_id else [])],
+                env=agent_service_env(task_id)
+            )
+        servers = self.mcp_configs['mcpServers']
+        if 'agent_network' not in servers:
+            return self.mcp_configs
+        return {'mcpServers': {
+            **servers, 'agent_network': {**servers['agent_network'], 'env': agent_service_env(task_id)}}}
+
+    async def _execute(self, context: RequestContext, event_queue: EventQueue) -> None:
         task = context.current_task
         if not task:
             task = new_task(context.message)
             await event_queue.enqueue_event(task)
             await self._post_task_start()
 
-        transport = self.mcp_configs
-
-        if not transport:
-            transport = PythonStdioTransport(
-                script_path='/home/yan2u/learn_a2a/net_simulator/mcp/agent_service.py',
-                args=['-i', self.agent_id, '-r', 'agent'],
-            )
+        user_id = self._set_usage_context(context, task)
+        transport = self._transport(task.id, user_id)
 
         messages = self.task_messages.get(
             task.id, [{'role': 'system', 'content': self.system_prompt}])
 
         user_input = context.get_user_input(delimiter='\n')
         user_media = []
+        image_detail = get_settings().media.image_detail
         for item in context.message.parts:
             part = item.root
             if isinstance(part, FilePart) and isinstance(part.file, FileWithBytes):
                 file_id = part.file.bytes
-                new_part = self._replace_file_part(part)
+                new_part = await self._replace_file_part(part, task.id)
                 file_obj = new_part.file
                 if file_obj.mimeType is None:
                     raise ValueError(
                         f"File {file_obj.name} not specified with mimeType.")
-                if not file_obj.mimeType in get_config('system.supported_media_types'):
+                if not file_obj.mimeType in get_settings().system.supported_media_types:
                     raise ValueError(
                         f"File {file_obj.name} with mimeType {file_obj.mimeType} is not supported.")
                 if file_obj.mimeType.startswith('image/'):
@@ -107,6 +289,7 @@ class GeneralTextExecutor(ExecutorBase):
                         'type': 'image_url',
                         'image_url': {
                             'url': f"data:image/{file_obj.mimeType.split('/')[1]};base64,{file_obj.bytes}",
+                            **({'detail': image_detail} if image_detail else {}),
                         }
                     })
                 elif file_obj.mimeType.startswith('audio/'):
@@ -150,21 +333,32 @@ class GeneralTextExecutor(ExecutorBase):
         ))
 
         llm = get_llm()
+        streamer = ArtifactStreamer(event_queue, task, f"{self.name} response") \
+            if get_settings().llm.stream else None
         try:
 
-            messages, choice = await llm.send_message_mcp(messages, transport)
+            messages, choice = await llm.send_message_mcp(
+                messages, transport,
+                on_text=streamer.write if streamer else None,
+                on_reset=streamer.reset if streamer else None)
             self.task_messages[task.id] = messages
             self.logger.info(
-                f"Task({task.id}) response: {choice.message.content[:100]}...")
-            await updater.add_artifact(
-                parts=[TextPart(text=choice.message.content)],
-                name=f"{self.name} response",
-            )
+                f"Task({task.id}) response: {(choice.message.content or '')[:100]}...")
+            if not (streamer and await streamer.close()):
+                await updater.add_artifact(
+                    parts=[TextPart(text=choice.message.content or '')],
+                    name=f"{self.name} response",
+                )
             await updater.complete()
             await self._post_task_end()
+        except asyncio.CancelledError:
+            await self._post_task_end()
+            raise
         except Exception as e:
             self.logger.error(f"Task({task.id}) error:")
             self.logger.error(traceback.format_exc())
+            if streamer:
+                await streamer.close()
             await updater.failed(
                 new_agent_text_message(
                     text=f"Unexpected Error: {e}",
@@ -174,6 +368,3 @@ class GeneralTextExecutor(ExecutorBase):
             )
             await self._post_task_end()
             return
-
-    async def cancel(self, context: RequestContext, event_queue: EventQueue) -> None:
-        raise NotImplementedError()
@@ -2,6 +2,7 @@
 import asyncio
 import uuid
 from net_simulator.executors.executor_base import ExecutorBase
+from net_simulator.utils import get_config
 from a2a.utils import new_task, new_agent_text_message
 from a2a.types import TaskArtifactUpdateEvent, Artifact, TextPart, TaskState
 from a2a.server.tasks import TaskUpdater
@@ -10,7 +11,7 @@ from uuid import uuid4
 
 class MockExecutor(ExecutorBase):
 
-    async def execute(self, context, event_queue):
+    async def _execute(self, context, event_queue):
         task = context.current_task
         if not task:
             task = new_task(context.message)
@@ -26,8 +27,10 @@ class MockExecutor(ExecutorBase):
         ))
 
         artifact_id = str(uuid4())
+        chunks = get_config('mock.chunks', 10)
+        interval = get_config('mock.chunk_interval', 0.5)
 
-        for i in range(10):
+        for i in range(chunks):
             await event_queue.enqueue_event(
                 TaskArtifactUpdateEvent(
                     artifact=Artifact(
@@ -38,14 +41,11 @@ class MockExecutor(ExecutorBase):
                     taskId=task.id,
                     contextId=task.contextId,
                     append=True if i > 0 else False,
-                    lastChunk=True if i == 9 else False
+                    lastChunk=True if i == chunks - 1 else False
                 )
             )
             self.logger.info(f"Task({task.id}) -> Mock message {i + 1} sent.")
             await updater.update_status(state=TaskState.working)
-            await asyncio.sleep(0.5)
+            await asyncio.sleep(interval)
 
         await updater.complete()
-
-    async def cancel(self, context, event_queue):
-        raise NotImplementedError()
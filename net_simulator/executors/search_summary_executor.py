@@ -1,3 +1,4 @@
+import asyncio
 import json
 
 import fastmcp
@@ -9,7 +10,7 @@ from a2a.utils import new_task, new_agent_text_message
 import httpx
 
 from net_simulator.executors.executor_base import ExecutorBase
-from net_simulator.utils import OpenAIService, SiliconFlowService, get_config, get_llm
+from net_simulator.utils import OpenAIService, SiliconFlowService, get_config, get_llm, get_settings
 
 import traceback
 
@@ -108,7 +109,7 @@ class SearchSummaryExecutor(ExecutorBase):
         else:
             return resp
 
-    async def execute(
+    async def _execute(
             self, context: RequestContext, event_queue: EventQueue
     ) -> None:
         task = context.current_task
@@ -117,6 +118,7 @@ class SearchSummaryExecutor(ExecutorBase):
             await event_queue.enqueue_event(task)
             await self._post_task_start()
 
+        self._set_usage_context(context, task)
         messages = self.task_messages.get(
             task.id, [{'role': 'system', 'content': SYSTEM_PROMPT}])
 
@@ -127,7 +129,7 @@ class SearchSummaryExecutor(ExecutorBase):
         user_image = None
         for part in context.message.parts:
             if isinstance(part.root, FilePart) and isinstance(part.root.file, FileWithBytes):
-                user_image = part.root.file.bytes
+                user_image = (await self._replace_file_part(part.root, task.id)).file
                 break
 
         if user_image:
@@ -136,8 +138,8 @@ class SearchSummaryExecutor(ExecutorBase):
                 'content': [
                     {'type': 'text', 'text': user_input},
                     {'type': 'image_url', 'image_url': {
-                        'url': f"data:image/jpeg;base64,{user_image}",
-                        'detail': 'low'
+                        'url': f"data:{user_image.mimeType};base64,{user_image.bytes}",
+                        'detail': get_settings().media.image_detail or 'low'
                     }}
                 ]
             })
@@ -199,6 +201,9 @@ class SearchSummaryExecutor(ExecutorBase):
                         task_id=task.id
                     )
                 )
+        except asyncio.CancelledError:
+            await self._post_task_end()
+            raise
         except Exception as e:
             self.logger.error(f"Task({task.id}) error:")
             self.logger.error(traceback.format_exc())
@@ -211,8 +216,3 @@ class SearchSummaryExecutor(ExecutorBase):
             )
 
         await self._post_task_end()
-
-    async def cancel(
-            self, context: RequestContext, event_queue: EventQueue
-    ) -> None:
-        raise NotImplementedError()
@@ -0,0 +1,677 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Deque, Dict, Iterator, Set, Tuple
+from uuid import uuid4
+
+from net_simulator.settings import CWD, FilesConfig, get_settings, on_config_change
+
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): the store is only safe for the threads of one process
+    fcntl = None
+
+INDEX_LOG = 'index.log'
+INDEX_LOCK = 'index.lock'
+# derived forms of the files (e.g. downsized images): variants/<file ID>/<profile>.<media type>
+VARIANTS = 'variants'
+# the variant of a profile is the file itself
+ORIGINAL = 'original'
+# temporary files older than this are left over from a crashed upload
+TMP_AGE = 3600
+# spool entries start with the media type of their content and a newline
+SPOOL_HEADER = 256
+
+
+def _map(path: Path) -> memoryview:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'')
+        # the view keeps the mapping alive, the descriptor is not needed for it
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class MediaSpool:
+    """
+    Copies of recently used files in shared memory: a directory on tmpfs (`/dev/shm`), keyed by
+    file ID or `<file ID>.<variant profile>`. The nodes of a host map them instead of reading the
+    store from disk. A key missing from the spool (evicted, or the file was stored by a node on
+    another host) is read from the store. The least recently used entries beyond `max_bytes` are evicted.
+    Each node keeps an index of the entries it put or read with their total size; the directory,
+    which the other nodes write to as well, is only scanned at startup and by `prune`.
+    """
+
+    directory: Path
+    max_bytes: int
+    _entries: OrderedDict[str, int]
+    """
+    Size of the entries by key, least recently used first.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total = 0
+        # the variant profiles seen, so `remove` finds the variants put by other nodes
+        self._profiles: Set[str] = set()
+        self._scan()
+
+    def _scan(self, file_ids: Set[str] | None = None):
+        """
+        Rebuild the index from the directory, ordered by modification time. Entries of files not
+        in `file_ids` (if given) are removed.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if item.name.startswith('.'):
+                    continue
+                if file_ids is not None and item.name.split('.', 1)[0] not in file_ids:
+                    Path(item.path).unlink(missing_ok=True)
+                    continue
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, item.name, stat.st_size))
+        with self._lock:
+            self._entries = OrderedDict()
+            self._total = 0
+            for _, name, size in sorted(entries):
+                self._add(name, size)
+        self._evict()
+
+    def _add(self, key: str, size: int):
+        # called with the lock held
+        self._total += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        if '.' in key:
+            self._profiles.add(key.split('.', 1)[1])
+
+    def put(self, key: str, data: bytes | memoryview, media_type: str):
+        # one large file would evict all others
+        if len(data) > self.max_bytes // 4:
+            return
+        header = media_type.encode('utf-8') + b'\n'
+        tmp_path = self.directory / f".{uuid4()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(data)
+        os.replace(tmp_path, self.directory / key)
+        with self._lock:
+            self._add(key, len(header) + len(data))
+        self._evict()
+
+    def read(self, key: str) -> Tuple[memoryview, str] | None:
+        path = self.directory / key
+        try:
+            view = _map(path)
+        except FileNotFoundError:
+            return None
+        try:
+            # the modification time orders the entries for the scans
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                # put by another node
+                self._add(key, len(view))
+        end = bytes(view[:SPOOL_HEADER]).find(b'\n')
+        if end < 0:
+            return None
+        return view[end + 1:], bytes(view[:end]).decode('utf-8')
+
+    def _evict(self):
+        evicted = []
+        with self._lock:
+            while self._total > self.max_bytes and self._entries:
+                name, size = self._entries.popitem(last=False)
+                self._total -= size
+                evicted.append(name)
+        for name in evicted:
+            (self.directory / name).unlink(missing_ok=True)
+
+    def remove(self, file_id: str):
+        """
+        Remove a file and its variants.
+        """
+        with self._lock:
+            names = [file_id, *(f"{file_id}.{profile}" for profile in self._profiles)]
+            for name in names:
+                self._total -= self._entries.pop(name, 0)
+        for name in names:
+            (self.directory / name).unlink(missing_ok=True)
+
+    def prune(self, file_ids: Set[str]):
+        """
+        Remove the entries of files not in `file_ids` and rescan the directory.
+        """
+        self._scan(file_ids)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._entries = OrderedDict()
+            self._total = 0
+
+
+class FileStore:
+    """
+    Files shared by the nodes of a host by ID, e.g. user uploads forwarded between agents.
+    Files are content-addressed: uploading the same content again returns the same ID.
+    A file lives as long as it has references. A reference is held by a task, a conversation or
+    an upload (`holder`), may be charged to a user or agent (`owner`) and may expire; `collect`
+    drops the expired references and deletes the files left without one.
+    Every process keeps the index in memory and follows `index.log`, an append-only log of the
+    changes made by all processes. Changes are serialized with flock on `index.lock`.
+    Content is stored decoded and read through mmap; the base64 form the LLM APIs and A2A messages
+    need is encoded on demand, the last `b64_cache_bytes` of it are kept.
+    Variants derived from a file by a named profile are kept with it and deleted with it.
+    Recently used files and variants are also kept in a `MediaSpool` shared by the nodes of the host.
+    """
+
+    directory: Path
+    options: FilesConfig
+    spool: MediaSpool | None
+    index: Dict[str, dict]
+    holders: Dict[str, Set[str]]
+    usage: Dict[str, int]
+
+    def __init__(self, directory: Path, options: FilesConfig = FilesConfig()):
+        self.directory = directory
+        self.options = options
+        self.index = {}
+        self.holders = {}
+        self.usage = {}
+        self._b64: OrderedDict[str, Tuple[str, str]] = OrderedDict()
+        self._b64_size = 0
+        self._log = directory / INDEX_LOG
+        self._offset = 0
+        self._lines = 0
+        self._inode: int | None = None
+        self._gc_queue: Deque[str] = deque()
+        self._lock = threading.Lock()
+        directory.mkdir(parents=True, exist_ok=True)
+
+        spool_directory = options.spool_directory
+        if spool_directory is None and Path('/dev/shm').is_dir():
+            # one spool per store, several simulations may run on the host
+            spool_directory = f"/dev/shm/net_simulator-{hashlib.sha256(str(directory.resolve()).encode()).hexdigest()[:12]}"
+        self.spool = MediaSpool(Path(spool_directory), options.spool_bytes) \
+            if spool_directory and options.spool_bytes else None
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(self.directory / INDEX_LOCK, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _owns(file: dict, owner: str) -> bool:
+        return any(ref[0] == owner for ref in file['refs'].values())
+
+    def _apply(self, entry: dict):
+        op, file_id, holder = entry['op'], entry['id'], entry['holder']
+        if op == 'add':
+            self.index[file_id] = {'media_type': entry['media_type'], 'size': entry['size'], 'refs': {}}
+            op = 'ref'
+        file = self.index.get(file_id)
+        if file is None:
+            return
+        refs = file['refs']
+
+        if op == 'ref':
+            if holder in refs:
+                # a holder keeps its owner, a new reference only renews it
+                refs[holder] = refs[holder][0], entry['expires']
+                return
+            owner = entry['owner']
+            if owner and not self._owns(file, owner):
+                self.usage[owner] = self.usage.get(owner, 0) + file['size']
+            refs[holder] = owner, entry['expires']
+            self.holders.setdefault(holder, set()).add(file_id)
+
+        elif op == 'unref':
+            ref = refs.pop(holder, None)
+            if ref is None:
+                return
+            files = self.holders.get(holder)
+            if files is not None:
+                files.discard(file_id)
+                if not files:
+                    del self.holders[holder]
+            owner = ref[0]
+            if owner and not self._owns(file, owner):
+                self.usage[owner] -= file['size']
+                if self.usage[owner] <= 0:
+                    del self.usage[owner]
+            if not refs:
+                del self.index[file_id]
+                self._uncache(file_id)
+
+    def _reset(self, inode: int | None):
+        self.index, self.holders, self.usage = {}, {}, {}
+        self._offset, self._lines, self._inode = 0, 0, inode
+        self._b64.clear()
+        self._b64_size = 0
+
+    def _follow(self):
+        """
+        Apply the log entries appended since the last call. A new log file (the store was
+        cleared or the log compacted) is read from the start.
+        """
+        try:
+            f = open(self._log, 'rb')
+        except FileNotFoundError:
+            self._reset(None)
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._reset(stat.st_ino)
+            if stat.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read()
+        # an entry is complete once its newline is written
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            self._apply(json.loads(line))
+            self._lines += 1
+        self._offset += end
+
+    def _append(self, entry: dict):
+        # called with the flock held and the index followed, so the entry applies to the current state
+        with open(self._log, 'ab') as f:
+            f.write(json.dumps(entry).encode('utf-8') + b'\n')
+        self._follow()
+
+    def _unref(self, file_id: str, holder: str):
+        self._append({'op': 'unref', 'id': file_id, 'holder': holder})
+        if file_id not in self.index:
+            (self.directory / file_id).unlink(missing_ok=True)
+            shutil.rmtree(self.directory / VARIANTS / file_id, ignore_errors=True)
+            if self.spool is not None:
+                self.spool.remove(file_id)
+
+    def _expires(self, ttl: float | None) -> float | None:
+        ttl = self.options.ttl if ttl is None else ttl
+        return time.time() + ttl if ttl else None
+
+    def _uncache(self, file_id: str):
+        cached = self._b64.pop(file_id, None)
+        if cached is not None:
+            self._b64_size -= len(cached[0])
+
+    def _cached(self, key: str, file_id: str) -> Tuple[str, str] | None:
+        cached = self._b64.get(key)
+        if cached is None:
+            return None
+        # removed by another process, which the log may not show yet
+        if not (self.directory / file_id).exists():
+            return None
+        with self._lock:
+            if key in self._b64:
+                self._b64.move_to_end(key)
+        return cached
+
+    def _cache(self, key: str, content: memoryview, media_type: str) -> Tuple[str, str]:
+        b64 = base64.b64encode(content).decode('ascii')
+        content.release()
+        if len(b64) <= self.options.b64_cache_bytes:
+            with self._lock:
+                self._uncache(key)
+                self._b64[key] = b64, media_type
+                self._b64_size += len(b64)
+                while self._b64_size > self.options.b64_cache_bytes:
+                    self._b64_size -= len(self._b64.popitem(last=False)[1][0])
+        return b64, media_type
+
+    def info(self, file_id: str) -> dict | None:
+        """
+        Get the index entry (media type, size and references) of a file, None if there is no such file.
+        """
+        entry = self.index.get(file_id)
+        if entry is None:
+            # maybe created by another process since the last lookup
+            with self._lock:
+                self._follow()
+            entry = self.index.get(file_id)
+        return entry
+
+    def _check_quota(self, owner: str | None, file_id: str, size: int):
+        if not owner:
+            return
+        quota = self.options.quotas.get(owner, self.options.quota_bytes)
+        file = self.index.get(file_id)
+        if file is not None and self._owns(file, owner):
+            return
+        if quota is not None and self.usage.get(owner, 0) + size > quota:
+            raise ValueError(f"File quota of {owner} exceeded: {self.usage.get(owner, 0)} + {size} > {quota} bytes.")
+
+    def create(self, data: bytes, media_type: str, holder: str | None = None,
+               owner: str | None = None, ttl: float | None = None) -> str:
+        """
+        Store a file, or reference the stored file with the same content, and return its ID.
+        The reference is held by `holder` (this upload only if not set), charged to `owner` and
+        expires after `ttl` seconds (`files.ttl` if not set, never if 0).
+        Raises ValueError if the file would exceed the quota of `owner`.
+        """
+        file_id = hashlib.sha256(data).hexdigest()[:32]
+        holder = holder or f"upload:{uuid4().hex}"
+        ref = {'id': file_id, 'holder': holder, 'owner': owner, 'expires': self._expires(ttl)}
+
+        tmp_path = None
+        added = False
+        if self.info(file_id) is None:
+            # written outside of the flock; dropped if another process stores the same content first
+            tmp_path = self.directory / f".{uuid4()}.tmp"
+            tmp_path.write_bytes(data)
+
+        try:
+            with self._lock, self._locked():
+                self._follow()
+                self._check_quota(owner, file_id, len(data))
+                if file_id in self.index:
+                    self._append({'op': 'ref', **ref})
+                else:
+                    if tmp_path is None:
+                        tmp_path = self.directory / f".{uuid4()}.tmp"
+                        tmp_path.write_bytes(data)
+                    # other processes can look the ID up as soon as it is logged, so the content goes first
+                    os.replace(tmp_path, self.directory / file_id)
+                    tmp_path = None
+                    self._append({'op': 'add', 'media_type': media_type, 'size': len(data), **ref})
+                    added = True
+        finally:
+            if tmp_path is not None:
+                tmp_path.unlink(missing_ok=True)
+        if added and self.spool is not None:
+            # the upload is usually forwarded to agents right away
+            self.spool.put(file_id, data, media_type)
+        return file_id
+
+    def acquire(self, file_id: str, holder: str, owner: str | None = None, ttl: float | None = None) -> bool:
+        """
+        Reference a stored file for `holder`, see `create`. Returns False if there is no such file.
+        """
+        if self.info(file_id) is None:
+            return False
+        with self._lock, self._locked():
+            self._follow()
+            if file_id not in self.index:
+                return False
+            self._check_quota(owner, file_id, self.index[file_id]['size'])
+            self._append({'op': 'ref', 'id': file_id, 'holder': holder, 'owner': owner,
+                          'expires': self._expires(ttl)})
+        return True
+
+    def read(self, file_id: str) -> Tuple[memoryview, str] | None:
+        """
+        Map the content of a file, returns a read-only view of it and its media type,
+        None if there is no such file.
+        """
+        entry = self.info(file_id)
+        if entry is None:
+            return None
+        if self.spool is not None:
+            spooled = self.spool.read(file_id)
+            if spooled is not None:
+                return spooled
+        try:
+            content = _map(self.directory / file_id)
+        except FileNotFoundError:
+            return None
+        if self.spool is not None:
+            self.spool.put(file_id, content, entry['media_type'])
+        return content, entry['media_type']
+
+    def get(self, file_id: str) -> Tuple[str, str] | None:
+        """
+        Get the base64 content and media type of a file, None if there is no such file.
+        """
+        cached = self._cached(file_id, file_id)
+        if cached is not None:
+            return cached
+        file = self.read(file_id)
+        if file is None:
+            return None
+        return self._cache(file_id, *file)
+
+    def get_variant(self, file_id: str, profile: str) -> Tuple[str, str] | None:
+        """
+        Get the base64 content and media type of the `profile` variant of a file,
+        None if it is not stored.
+        """
+        key = f"{file_id}/{profile}"
+        cached = self._cached(key, file_id)
+        if cached is not None:
+            return cached
+        if self.spool is not None:
+            spooled = self.spool.read(f"{file_id}.{profile}")
+            if spooled is not None:
+                content, kind = spooled
+                return self.get(file_id) if kind == ORIGINAL else self._cache(key, content, kind)
+        try:
+            names = os.listdir(self.directory / VARIANTS / file_id)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if name.startswith(f"{profile}."):
+                kind = name[len(profile) + 1:]
+                if kind != ORIGINAL:
+                    kind = kind.replace('_', '/', 1)
+                try:
+                    content = _map(self.directory / VARIANTS / file_id / name)
+                except FileNotFoundError:
+                    return None
+                if self.spool is not None:
+                    self.spool.put(f"{file_id}.{profile}", content, kind)
+                return self.get(file_id) if kind == ORIGINAL else self._cache(key, content, kind)
+        return None
+
+    def put_variant(self, file_id: str, profile: str, data: bytes | None, media_type: str | None = None):
+        """
+        Store the `profile` variant of a file, None `data` if the file itself serves as the variant.
+        """
+        if self.info(file_id) is None:
+            return
+        directory = self.directory / VARIANTS / file_id
+        directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = directory / f".{uuid4()}.tmp"
+        tmp_path.write_bytes(data or b'')
+        kind = ORIGINAL if data is None else media_type.replace('/', '_')
+        os.replace(tmp_path, directory / f"{profile}.{kind}")
+        if self.spool is not None:
+            self.spool.put(f"{file_id}.{profile}", data or b'', media_type if data is not None else ORIGINAL)
+
+    def release(self, file_id: str, holder: str):
+        """
+        Drop the reference of `holder` to a file, the file is deleted with its last reference.
+        """
+        with self._lock, self._locked():
+            self._follow()
+            if holder in self.index.get(file_id, {}).get('refs', {}):
+                self._unref(file_id, holder)
+
+    def release_all(self, holder: str):
+        """
+        Drop all references of `holder`, e.g. when its task ends.
+        """
+        if holder not in self.holders:
+            with self._lock:
+                self._follow()
+            if holder not in self.holders:
+                return
+        with self._lock, self._locked():
+            self._follow()
+            for file_id in list(self.holders.get(holder, ())):
+                self._unref(file_id, holder)
+
+    def _sweep(self):
+        # files on disk the index does not know, e.g. of a node that crashed while uploading.
+        # The directories are scanned without the locks, they are only taken to delete the files
+        now = time.time()
+        with self._lock:
+            self._follow()
+            known = set(self.index)
+
+        stale = []
+        variants = self.directory / VARIANTS
+        if variants.exists():
+            stale.extend(item for item in variants.iterdir() if item.name not in known)
+        for item in self.directory.iterdir():
+            if item.name in (INDEX_LOG, INDEX_LOCK) or item.name in known or not item.is_file():
+                continue
+            try:
+                if not item.name.endswith('.tmp') or now - item.stat().st_mtime > TMP_AGE:
+                    stale.append(item)
+            except FileNotFoundError:
+                pass
+        # a file stored since only loses its spool entry
+        if self.spool is not None:
+            self.spool.prune(known)
+        if not stale:
+            return
+
+        with self._lock, self._locked():
+            self._follow()
+            for item in stale:
+                # stored since the scan
+                if item.name in self.index:
+                    continue
+                if item.is_dir():
+                    shutil.rmtree(item, ignore_errors=True)
+                else:
+                    item.unlink(missing_ok=True)
+
+    def _compact(self):
+        # rewrite the log as the current state, the other processes re-read the new file.
+        # Called with the locks held, the log is written at once
+        lines = []
+        for file_id, file in self.index.items():
+            op = 'add'
+            for holder, (owner, expires) in file['refs'].items():
+                entry = {'op': op, 'id': file_id, 'holder': holder, 'owner': owner, 'expires': expires}
+                if op == 'add':
+                    entry.update(media_type=file['media_type'], size=file['size'])
+                lines.append(json.dumps(entry).encode('utf-8') + b'\n')
+                op = 'ref'
+        tmp_path = self.directory / f".{uuid4()}.tmp"
+        tmp_path.write_bytes(b''.join(lines))
+        os.replace(tmp_path, self._log)
+        self._follow()
+
+    def collect(self, batch: int = 100) -> int:
+        """
+        Check the next `batch` files: drop their expired references and delete the files left
+        without one. After a pass over all files, remove unknown files and compact the log.
+        The locks are taken for each change only, the callers on the event loop wait for them.
+        Returns the number of deleted files.
+        """
+        now = time.time()
+        with self._lock:
+            self._follow()
+            if not self._gc_queue:
+                self._gc_queue.extend(self.index)
+            ids = [self._gc_queue.popleft() for _ in range(min(batch, len(self._gc_queue)))]
+            expired = [
+                (file_id, holder) for file_id in ids if file_id in self.index
+                for holder, (_, expires) in self.index[file_id]['refs'].items()
+                if expires is not None and expires <= now
+            ]
+
+        deleted = 0
+        for file_id, holder in expired:
+            with self._lock, self._locked():
+                self._follow()
+                ref = self.index.get(file_id, {}).get('refs', {}).get(holder)
+                # renewed since
+                if ref is None or ref[1] is None or ref[1] > now:
+                    continue
+                self._unref(file_id, holder)
+                deleted += file_id not in self.index
+
+        if not self._gc_queue:
+            self._sweep()
+            with self._lock:
+                self._follow()
+                refs = sum(len(x['refs']) for x in self.index.values())
+                compact = self._lines > 2 * refs + 1024
+            if compact:
+                with self._lock, self._locked():
+                    self._follow()
+                    self._compact()
+        return deleted
+
+    def clear(self):
+        """
+        Remove all files, including those of other processes.
+        """
+        with self._lock, self._locked():
+            for item in self.directory.iterdir():
+                if item.is_file() and item.name != INDEX_LOCK:
+                    item.unlink(missing_ok=True)
+            shutil.rmtree(self.directory / VARIANTS, ignore_errors=True)
+            if self.spool is not None:
+                self.spool.clear()
+            self._follow()
+
+
+_store: FileStore | None = None
+
+
+def get_file_store() -> FileStore:
+    """
+    The store under `files.directory` (default `data/filesystem`).
+    """
+    global _store
+    if _store is None:
+        options = get_settings().files
+        _store = FileStore(Path(options.directory) if options.directory else CWD / 'data' / 'filesystem', options)
+    return _store
+
+
+async def collect_files():
+    """
+    Collect the file store every `files.gc_interval` seconds, `files.gc_batch` files at a time,
+    in a worker thread so the event loop is not blocked.
+    """
+    logger = logging.getLogger('uvicorn')
+    while True:
+        options = get_settings().files
+        await asyncio.sleep(options.gc_interval)
+        try:
+            deleted = await asyncio.to_thread(get_file_store().collect, options.gc_batch)
+        except OSError as e:
+            logger.warning(f"File store collection failed: {e}")
+            continue
+        if deleted:
+            logger.info(f"File store: {deleted} expired files deleted.",
+                        extra={'category': 'file_store', 'deleted': deleted})
+
+
+@on_config_change
+def _reset_store(old, new):
+    global _store
+    if old.files != new.files:
+        _store = None
@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from openai.types.chat import ChatCompletionMessageParam
+from openai.types.chat.chat_completion import Choice
+
+from net_simulator.settings import CWD, get_settings, on_config_change
+
+# name of the agent the current task runs for, set by the executors
+current_agent: ContextVar[str | None] = ContextVar('current_agent', default=None)
+
+
+def _json_default(obj: Any):
+    if hasattr(obj, 'model_dump'):
+        return obj.model_dump(mode='json')
+    return repr(obj)
+
+
+def cache_key(model: str, messages: List[ChatCompletionMessageParam], tools: Any) -> str:
+    """
+    Stable hash of a model request. `tools` is a list of MCP tools, or of their conversion
+    to the format of the service.
+    """
+    if isinstance(tools, list):
+        tools = [x.model_dump(mode='json') if hasattr(x, 'model_dump') else x for x in tools]
+    else:
+        tools = repr(tools)
+    payload = json.dumps([model, messages, tools], sort_keys=True, ensure_ascii=False, default=_json_default)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Exact-match cache of model responses: an in-memory LRU in front of an on-disk store.
+    Disk entries are one JSON file per key, shared by all processes using the same directory.
+    They are read and written in worker threads, the memory is only used from the event loop.
+    """
+
+    memory_entries: int
+    ttl: float
+    directory: Path | None
+    stats: Dict[str, int]
+    logger: logging.Logger
+
+    def __init__(self, memory_entries: int, ttl: float, directory: Path | None):
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'bypassed': 0}
+        self.logger = logging.getLogger('uvicorn')
+        self._memory: OrderedDict[str, Tuple[float, dict]] = OrderedDict()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, expires: float, choice: dict):
+        self._memory[key] = (expires, choice)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Tuple[float, dict] | None:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+        if entry['expires'] < time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return entry['expires'], entry['choice']
+
+    def _write_disk(self, key: str, expires: float, choice: dict):
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_file.write_text(json.dumps({'expires': expires, 'choice': choice}), encoding='utf-8')
+            os.replace(tmp_file, path)
+        except OSError as e:
+            self.logger.warning(f"LLM cache write failed: {e}")
+
+    def _count(self, event: str, key: str):
+        self.stats[event] += 1
+        self.logger.debug(f"LLM cache {event}: {key[:12]}", extra={'category': 'llm_cache', 'event': event})
+
+    def bypassed(self) -> bool:
+        return current_agent.get() in get_settings().llm_cache.bypass
+
+    async def get(self, key: str) -> Choice | None:
+        if self.bypassed():
+            self._count('bypassed', key)
+            return None
+
+        entry = self._memory.get(key)
+        if entry is not None and entry[0] >= time.time():
+            self._memory.move_to_end(key)
+            self._count('memory_hits', key)
+            return Choice.model_validate(entry[1])
+
+        entry = await asyncio.to_thread(self._read_disk, key) if self.directory else None
+        if entry is not None:
+            self._remember(key, *entry)
+            self._count('disk_hits', key)
+            return Choice.model_validate(entry[1])
+
+        self._memory.pop(key, None)
+        self._count('misses', key)
+        return None
+
+    async def put(self, key: str, choice: Choice):
+        if self.bypassed():
+            return
+
+        expires = time.time() + self.ttl
+        data = choice.model_dump(mode='json')
+        self._remember(key, expires, data)
+        if self.directory:
+            await asyncio.to_thread(self._write_disk, key, expires, data)
+        self.stats['stores'] += 1
+
+    def hit_rate(self) -> float:
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+
+_cache: LLMResponseCache | None = None
+
+
+def get_llm_cache() -> LLMResponseCache | None:
+    """
+    Get the response cache of this process, or None if `llm_cache.enabled` is off.
+    """
+    global _cache
+
+    options = get_settings().llm_cache
+    if not options.enabled:
+        return None
+    if _cache is None:
+        directory = None
+        if options.disk:
+            directory = Path(options.directory) if options.directory else CWD / 'data' / 'llm_cache'
+        _cache = LLMResponseCache(options.memory_entries, options.ttl, directory)
+    return _cache
+
+
+def log_llm_cache_stats():
+    if _cache is not None:
+        logging.getLogger('uvicorn').info(
+            f"LLM cache: {_cache.stats}, hit rate {_cache.hit_rate():.1%}",
+            extra={'category': 'llm_cache', **_cache.stats})
+
+
+@on_config_change
+def _reset_llm_cache(old, new):
+    global _cache
+
+    # the bypass list is read on every lookup, the other options need a new cache
+    if old.llm_cache.model_dump(exclude={'bypass'}) != new.llm_cache.model_dump(exclude={'bypass'}):
+        _cache = None
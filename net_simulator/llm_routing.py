@@ -0,0 +1,192 @@
+import logging
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, List, Literal
+
+import httpx
+import openai
+from google.genai import errors as genai_errors
+
+from net_simulator.msgs.usage_msgs import HedgeStats
+from net_simulator.settings import RoutingConfig, get_settings, on_config_change
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether a provider error is transient (rate limits, overload, network), so the request
+    may be retried or sent to another provider. Client errors such as 400/401 are not.
+    """
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    if isinstance(error, genai_errors.APIError):
+        return error.code in RETRYABLE_STATUS or error.code >= 500
+    return False
+
+
+def retry_after(error: BaseException) -> float | None:
+    """
+    The delay requested by the provider through the `Retry-After` header, if any.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, options: RoutingConfig) -> float:
+    """
+    Exponential backoff with full jitter: a random delay in [0, min(max, base * 2^attempt)].
+    """
+    return random.uniform(0, min(options.backoff_max, options.backoff_base * 2 ** attempt))
+
+
+class RetryBudget:
+    """
+    Limits retries to a fraction of the requests seen in a sliding window, plus a small
+    constant allowance. It keeps retries from multiplying the load on a degraded provider.
+    """
+
+    window: float
+    _requests: Deque[float]
+    _retries: Deque[float]
+
+    def __init__(self, window: float = 10.0):
+        self.window = window
+        self._requests = deque()
+        self._retries = deque()
+
+    def _expire(self, now: float):
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        self._requests.append(time.monotonic())
+
+    def try_retry(self) -> bool:
+        """
+        Withdraw one retry from the budget. Returns False if the budget is exhausted.
+        """
+        options = get_settings().llm_routing
+        now = time.monotonic()
+        self._expire(now)
+        allowed = options.retry_budget_min + options.retry_budget_ratio * len(self._requests)
+        if len(self._retries) >= allowed:
+            return False
+        self._retries.append(now)
+        return True
+
+
+class CircuitBreaker:
+    """
+    Per-provider circuit breaker. After `breaker_failures` consecutive transient failures the
+    circuit opens and the provider is skipped for `breaker_reset` seconds, then a single
+    trial request decides whether it closes again.
+    """
+
+    state: Literal['closed', 'open', 'half_open']
+    failures: int
+    opened_at: float
+
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+        # let one trial request through per reset period, also if a trial never reported back
+        if time.monotonic() - self.opened_at >= get_settings().llm_routing.breaker_reset:
+            self.state = 'half_open'
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= get_settings().llm_routing.breaker_failures:
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """
+    Latencies of the last successful requests of a service, used to decide when to hedge.
+    """
+
+    samples: Deque[float]
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+
+    def record(self, latency: float):
+        self.samples.append(latency)
+
+    def hedge_delay(self) -> float:
+        options = get_settings().llm_routing
+        if len(self.samples) < options.hedge_min_samples:
+            return options.hedge_delay
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * options.hedge_percentile / 100))]
+
+    def expected_beyond(self, elapsed: float) -> float | None:
+        """
+        Mean latency of the recorded requests slower than `elapsed`, the expected latency of
+        a request that has not answered after `elapsed` seconds.
+        """
+        slower = [x for x in self.samples if x > elapsed]
+        return sum(slower) / len(slower) if slower else None
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_latencies: Dict[str, LatencyTracker] = {}
+retry_budget = RetryBudget()
+
+# hedged: requests sent to a second service, hedge_wins: the second service answered first,
+# saved_seconds: estimated latency saved by those wins
+hedge_stats: Dict[str, float] = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'saved_seconds': 0.0}
+
+
+def get_breaker(api_service: str) -> CircuitBreaker:
+    if api_service not in _breakers:
+        _breakers[api_service] = CircuitBreaker()
+    return _breakers[api_service]
+
+
+def get_latencies(api_service: str) -> LatencyTracker:
+    if api_service not in _latencies:
+        _latencies[api_service] = LatencyTracker()
+    return _latencies[api_service]
+
+
+def get_hedge_stats() -> HedgeStats:
+    requests = hedge_stats['requests']
+    return HedgeStats(**hedge_stats, hedge_rate=hedge_stats['hedged'] / requests if requests else 0.0)
+
+
+def log_hedge_stats():
+    if hedge_stats['requests']:
+        rate = hedge_stats['hedged'] / hedge_stats['requests']
+        logging.getLogger('uvicorn').info(
+            f"LLM hedging: {hedge_stats}, hedge rate {rate:.1%}",
+            extra={'category': 'llm_routing', **hedge_stats})
+
+
+@on_config_change
+def _reset_breakers(old, new):
+    if old.api_services != new.api_services:
+        _breakers.clear()
@@ -0,0 +1,231 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict
+
+DEFAULT_MAX_FIELD_LENGTH = 512
+DEFAULT_QUEUE_SIZE = 10000
+
+# uvicorn access log paths -> sampling category
+ACCESS_CATEGORIES = {
+    '/agents/keepalive': 'keepalive',
+    '/task_count': 'task_count',
+    '/events/': 'event',
+    '/usage/report': 'usage',
+}
+
+# attributes of a plain LogRecord, everything else is a structured field
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listener: QueueListener | None = None
+
+
+def truncate(value: Any, limit: int = DEFAULT_MAX_FIELD_LENGTH) -> str:
+    """
+    Convert `value` to a string and cut it to at most `limit` characters.
+    A marker with the number of dropped characters is appended when truncated.
+    """
+    text = value if isinstance(value, str) else str(value)
+    if limit <= 0 or len(text) <= limit:
+        return text
+    return f"{text[:limit]}...<{len(text) - limit} chars truncated>"
+
+
+def _record_category(record: logging.LogRecord) -> str | None:
+    category = getattr(record, 'category', None)
+    if category:
+        return category
+
+    # uvicorn access records: (client_addr, method, full_path, http_version, status_code)
+    if record.name == 'uvicorn.access' and isinstance(record.args, tuple) and len(record.args) >= 3:
+        path = str(record.args[2])
+        for prefix, name in ACCESS_CATEGORIES.items():
+            if path.startswith(prefix):
+                record.category = name
+                return name
+
+    return None
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Per-category sampling and rate limiting.
+    Each category in `rules` may define:
+    - rate: probability of keeping a record (0.0 ~ 1.0).
+    - limit / interval: at most `limit` records every `interval` seconds.
+    Warnings and errors are never dropped.
+    """
+
+    rules: Dict[str, dict]
+    windows: Dict[str, list]
+    dropped: Dict[str, int]
+
+    def __init__(self, rules: Dict[str, dict] | None = None):
+        super().__init__()
+        self.rules = rules or {}
+        self.windows = {}
+        self.dropped = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        category = _record_category(record)
+        if category is None or category not in self.rules:
+            return True
+
+        rule = self.rules[category]
+        rate = rule.get('rate', 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return self._drop(category)
+
+        limit = rule.get('limit')
+        if limit is None:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            window = self.windows.setdefault(category, [now, 0])
+            if now - window[0] >= rule.get('interval', 60):
+                window[0], window[1] = now, 0
+            if window[1] >= limit:
+                self.dropped[category] = self.dropped.get(category, 0) + 1
+                return False
+            window[1] += 1
+            # report how many records were suppressed since the last one kept
+            suppressed = self.dropped.pop(category, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def _drop(self, category: str) -> bool:
+        with self._lock:
+            self.dropped[category] = self.dropped.get(category, 0) + 1
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line.
+    Fields passed through `extra` are included and truncated to `max_field_length`.
+    """
+
+    def __init__(self, node: str = '', max_field_length: int = DEFAULT_MAX_FIELD_LENGTH):
+        super().__init__()
+        self.node = node
+        self.max_field_length = max_field_length
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'node': self.node,
+            'msg': truncate(record.getMessage(), self.max_field_length * 4),
+        }
+        for key, value in vars(record).items():
+            if key in _RECORD_ATTRS or key.startswith('_'):
+                continue
+            if not isinstance(value, (int, float, bool)) and value is not None:
+                value = truncate(value, self.max_field_length)
+            entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks the caller: records are dropped when the queue is full.
+    Formatting is left to the listener thread, only the message arguments are merged here.
+    """
+
+    dropped: int = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(node: str, options: dict | None = None) -> QueueListener:
+    """
+    Route all log records of this process through a bounded queue to a background writer thread.
+    `options` is the `logging` section of the config, see `config_example.json`.
+    Call this before `uvicorn.run(..., log_config=None)` so uvicorn keeps these handlers.
+    """
+    global _listener
+
+    options = options or {}
+    if _listener is not None:
+        return _listener
+
+    if options.get('format', 'plain') == 'json':
+        formatter = JsonFormatter(node, options.get('max_field_length', DEFAULT_MAX_FIELD_LENGTH))
+    else:
+        formatter = logging.Formatter(f'%(levelname)s:\t[{node}] %(message)s')
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(options.get('queue_size', DEFAULT_QUEUE_SIZE))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(options.get('sampling')))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(options.get('level', 'INFO'))
+
+    # uvicorn loggers propagate to root when uvicorn does not configure them,
+    # FastMCP adds its own handler when imported
+    for name in ('uvicorn', 'uvicorn.error', 'uvicorn.access', 'FastMCP'):
+        logger = logging.getLogger(name)
+        logger.handlers.clear()
+        logger.propagate = True
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return _listener
+
+
+def update_logging(options: dict):
+    """
+    Apply a changed `logging` config section (level and sampling rules) to the running pipeline.
+    """
+    root = logging.getLogger()
+    root.setLevel(options.get('level', 'INFO'))
+    for handler in root.handlers:
+        for f in handler.filters:
+            if isinstance(f, SamplingFilter):
+                f.rules = options.get('sampling') or {}
+
+
+def shutdown_logging():
+    """
+    Flush pending records and stop the writer thread.
+    """
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,4 +1,5 @@
 import logging
+import os
 from argparse import ArgumentParser
 from datetime import datetime
 from typing import List, Literal
@@ -19,8 +20,10 @@ from pydantic import Field
 from typing_extensions import Annotated
 
 from net_simulator.datamodels import StampedTask
+from net_simulator.logs import setup_logging
 from net_simulator.msgs import AgentRegistryInfo
-from net_simulator.utils import get_config
+from net_simulator.tool_results import READ_TOOL, read_tool_result
+from net_simulator.utils import PARENT_TASK_ENV, get_config, get_settings
 from pathlib import Path
 import json
 
@@ -31,10 +34,18 @@ class AgentService:
 
     agent_id: str
     role: Literal['agent', 'user']
+    user_id: str | None
+    parent_task_id: str | None
+    manager_url: str
 
-    def __init__(self, agent_id: str, role: str):
+    def __init__(self, agent_id: str, role: str, user_id: str | None = None):
         self.agent_id = agent_id
         self.role = role
+        # the user the work is done for, passed on to the agents we send messages to
+        self.user_id = user_id or (agent_id if role == 'user' else None)
+        # the task or user conversation we work for, the tasks we delegate are linked to it
+        self.parent_task_id = os.environ.get(PARENT_TASK_ENV)
+        self.manager_url = f"http://localhost:{get_settings().system.port}"
 
     async def _update_event(self, event: Task | TaskStatusUpdateEvent | TaskArtifactUpdateEvent):
         client = httpx.AsyncClient()
@@ -42,7 +53,7 @@ class AgentService:
             url = ''
             response = None
             if isinstance(event, Task):
-                url = f"http://localhost:{get_config('system.port')}/events/task/{self.agent_id}"
+                url = f"{self.manager_url}/events/task/{self.agent_id}"
                 response = await client.post(
                     url,
                     json={
@@ -51,13 +62,13 @@ class AgentService:
                     }
                 )
             elif isinstance(event, TaskStatusUpdateEvent):
-                url = f"http://localhost:{get_config('system.port')}/events/task_status/{self.agent_id}"
+                url = f"{self.manager_url}/events/task_status/{self.agent_id}"
                 response = await client.post(
                     url,
                     json=event.model_dump()
                 )
             elif isinstance(event, TaskArtifactUpdateEvent):
-                url = f"http://localhost:{get_config('system.port')}/events/task_artifact/{self.agent_id}"
+                url = f"{self.manager_url}/events/task_artifact/{self.agent_id}"
                 response = await client.post(
                     url,
                     json=event.model_dump()
@@ -75,6 +86,18 @@ class AgentService:
 
         await client.aclose()
 
+    async def _link_task(self, task_id: str, agent_url: str):
+        if not self.parent_task_id:
+            return
+        try:
+            async with httpx.AsyncClient(timeout=10) as client:
+                await client.post(
+                    f"{self.manager_url}/tasks/link",
+                    json={'parent_task_id': self.parent_task_id, 'task_id': task_id, 'agent_url': agent_url}
+                )
+        except httpx.HTTPError as e:
+            logging.getLogger('uvicorn').warning(f"Failed to link task {task_id}: {e}")
+
     async def _send_messages(self, agent_url: str, parts: List[Part], task_id: str | None = None, context_id: str | None = None) -> dict:
         async with httpx.AsyncClient(base_url=agent_url, timeout=1800) as httpx_client:
             client = await A2AClient.get_client_from_agent_card_url(
@@ -89,6 +112,7 @@ class AgentService:
                     'messageId': uuid4().hex,
                     'taskId': task_id,
                     'contextId': context_id,
+                    'metadata': {'user_id': self.user_id} if self.user_id else None,
                 }
             }
 
@@ -108,8 +132,11 @@ class AgentService:
                 result = event.root.result
 
                 if isinstance(result, (Task, TaskStatusUpdateEvent, TaskArtifactUpdateEvent)):
+                    new_task = task_id is None
                     task_id = result.id if isinstance(
                         result, Task) else result.taskId
+                    if new_task:
+                        await self._link_task(task_id, agent_url)
                     await self._update_event(result)
 
             get_task_req = GetTaskRequest(
@@ -125,9 +152,8 @@ class AgentService:
         Get all public agents registered with the MCP manager.
         Returns a list of AgentRegistryInfo objects.
         """
-        manager_url = f"http://localhost:{get_config('system.port')}"
         try:
-            async with httpx.AsyncClient(base_url=manager_url, timeout=10) as client:
+            async with httpx.AsyncClient(base_url=self.manager_url, timeout=10) as client:
                 response = await client.post('/agents/discover', json={'agent_id': self.agent_id})
                 if response.status_code != 200:
                     raise ToolError(
@@ -251,7 +277,6 @@ class AgentService:
             """
 
             try:
-                manager_url = f"http://localhost:{get_config('system.port')}"
                 agents = await self._get_public_agents()
                 target = ''
                 for agent in agents:
@@ -261,7 +286,7 @@ class AgentService:
                 if not target:
                     raise ToolError(
                         f"Agent with URL {agent_url} not found in the agent registry.")
-                async with httpx.AsyncClient(base_url=manager_url, timeout=10) as client:
+                async with httpx.AsyncClient(base_url=self.manager_url, timeout=10) as client:
                     # start interaction
                     response = await client.post(
                         '/interactions/add',
@@ -324,6 +349,22 @@ class AgentService:
 
             return response.json()['data']['webPages']['value']
 
+        @mcp.tool(name=READ_TOOL)
+        def tool_result_read(
+                result_id: Annotated[str, Field(description='result_id given in the truncated tool result')],
+                offset: Annotated[int, Field(description='index of the first character to read, default=0', default=0)],
+                length: Annotated[int, Field(description='number of characters to read, default=8000', default=8000)],
+        ) -> str:
+            """
+            Read a part of a tool result that was too long and has been truncated.
+            Use the `result_id` from the truncation marker, and `offset` to continue where the shown part ends.
+            """
+
+            text = read_tool_result(result_id, max(0, offset), max(1, length))
+            if text is None:
+                raise ToolError(f"Tool result {result_id} not found.")
+            return text
+
         mcp.run()
 
 
@@ -334,10 +375,14 @@ if __name__ == '__main__':
                         help='Role of the service, either "agent" or "user".')
     parser.add_argument('-i', '--id', type=str, required=True,
                         help='ID to register with the agent service mcp. Represents the user ID or agent ID in the agent network.')
+    parser.add_argument('-u', '--user', type=str, default=None,
+                        help='ID of the user the agent works for, used to attribute LLM usage.')
 
     args = parser.parse_args()
 
-    service = AgentService(agent_id=args.id, role=args.role)
+    # records go to stderr, stdout carries the MCP messages
+    setup_logging(f"agent_service:{args.id}", get_config('logging'))
+    service = AgentService(agent_id=args.id, role=args.role, user_id=args.user)
     logger = logging.getLogger(__file__)
     logger.info(f"AgentService(id={args.id}, role={args.role}) started...")
     service.run()
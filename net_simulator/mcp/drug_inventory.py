@@ -6,6 +6,7 @@ from fastmcp import FastMCP
 from fastmcp.exceptions import ToolError
 from typing_extensions import Annotated
 from pydantic import Field
+from net_simulator.logs import setup_logging
 from net_simulator.utils import get_config
 from pathlib import Path
 from uuid import uuid4
@@ -51,8 +52,9 @@ def main():
             raise ToolError("No expense items found in the inventory.")
         return data
 
+    setup_logging('drug_inventory', get_config('logging'))
     port = get_config('mcp.drug_inventory_port')
-    mcp.run(host='0.0.0.0', port=port, transport='sse')
+    mcp.run(host='0.0.0.0', port=port, transport='sse', uvicorn_config={'log_config': None})
 
 
 if __name__ == '__main__':
@@ -6,6 +6,7 @@ from fastmcp import FastMCP
 from fastmcp.exceptions import ToolError
 from typing_extensions import Annotated
 from pydantic import Field
+from net_simulator.logs import setup_logging
 from net_simulator.utils import get_config
 
 
@@ -47,8 +48,9 @@ def main():
 
         return response.json()['data']['webPages']['value']
 
+    setup_logging('langsearch', get_config('logging'))
     port = get_config('mcp.langsearch_port')
-    mcp.run(host='0.0.0.0', port=port, transport='sse')
+    mcp.run(host='0.0.0.0', port=port, transport='sse', uvicorn_config={'log_config': None})
 
 
 if __name__ == '__main__':
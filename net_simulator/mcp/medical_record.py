@@ -6,6 +6,7 @@ from fastmcp import FastMCP
 from fastmcp.exceptions import ToolError
 from typing_extensions import Annotated
 from pydantic import Field
+from net_simulator.logs import setup_logging
 from net_simulator.utils import get_config
 from pathlib import Path
 from uuid import uuid4
@@ -72,8 +73,9 @@ def main():
         """
         return data
 
+    setup_logging('medical_record', get_config('logging'))
     port = get_config('mcp.medical_record_port')
-    mcp.run(host='0.0.0.0', port=port, transport='sse')
+    mcp.run(host='0.0.0.0', port=port, transport='sse', uvicorn_config={'log_config': None})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import shutil
+import subprocess
+import wave
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Set, Tuple
+
+from net_simulator.file_store import get_file_store
+from net_simulator.settings import MediaConfig, get_settings, on_config_change
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        # deprecated, removed in Python 3.13: wav files are passed as is without it
+        import audioop
+    except ImportError:
+        audioop = None
+
+# media types of the audio formats ffmpeg writes
+AUDIO_TYPES = {'mp3': 'audio/mp3', 'wav': 'audio/wav'}
+
+
+def _convert_image(data: bytes, options: dict) -> Tuple[bytes, str] | None:
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        max_size = options['image_max_size']
+        resized = max(image.size) > max_size
+        if resized:
+            image.thumbnail((max_size, max_size))
+        # transparency would be lost in JPEG
+        alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        image_format = 'png' if alpha else options['image_format']
+        if image_format == 'jpeg' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, image_format.upper(), quality=options['image_quality'], optimize=True)
+
+    result = out.getvalue()
+    if not resized and len(result) >= len(data):
+        return None
+    return result, f"image/{image_format}"
+
+
+def _convert_wav(data: bytes, options: dict) -> Tuple[bytes, str] | None:
+    with wave.open(io.BytesIO(data)) as f:
+        channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+        frames = f.readframes(f.getnframes())
+
+    sample_rate, target_channels = options['audio_sample_rate'], options['audio_channels']
+    if (rate, channels, width) == (sample_rate, target_channels, 2) or channels not in (1, 2):
+        return None
+
+    if width == 1:
+        # 8 bit wav is unsigned
+        frames = audioop.bias(frames, 1, -128)
+    if width != 2:
+        frames = audioop.lin2lin(frames, width, 2)
+    if channels == 2 and target_channels == 1:
+        frames = audioop.tomono(frames, 2, 0.5, 0.5)
+        channels = 1
+    if rate != sample_rate:
+        frames, _ = audioop.ratecv(frames, 2, channels, rate, sample_rate, None)
+
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(frames)
+    return out.getvalue(), 'audio/wav'
+
+
+def _convert_audio(data: bytes, audio_format: str, options: dict) -> Tuple[bytes, str] | None:
+    result = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-i', 'pipe:0', '-ac', str(options['audio_channels']),
+         '-ar', str(options['audio_sample_rate']), '-f', audio_format, 'pipe:1'],
+        input=data, capture_output=True, timeout=options['timeout'], check=True
+    )
+    return result.stdout, AUDIO_TYPES[audio_format]
+
+
+def convert(data: bytes, media_type: str, options: dict) -> Tuple[bytes, str] | None:
+    """
+    Normalize an image or audio file by `options` (a dumped `MediaConfig`).
+    Returns the converted content and its media type, None if the file is better passed as is.
+    Runs in the worker processes.
+    """
+    if media_type.startswith('image/'):
+        return _convert_image(data, options)
+
+    source_format = media_type.split('/')[1].replace('mpeg', 'mp3').replace('x-wav', 'wav')
+    audio_format = options['audio_format'] or source_format
+    if source_format == audio_format == 'wav' and audioop is not None:
+        return _convert_wav(data, options)
+    if audio_format in AUDIO_TYPES and shutil.which('ffmpeg'):
+        return _convert_audio(data, audio_format, options)
+    return None
+
+
+def profile_name(kind: str, options: MediaConfig) -> str:
+    """
+    Name of the variants made with the `kind` ('image' or 'audio') options.
+    """
+    if kind == 'image':
+        fields = ['image_max_size', 'image_format', 'image_quality']
+    else:
+        fields = ['audio_format', 'audio_sample_rate', 'audio_channels']
+    key = json.dumps(options.model_dump(include=set(fields)), sort_keys=True)
+    return f"{kind}-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:12]}"
+
+
+# missing converters already warned about
+_warned: Set[str] = set()
+
+
+def _warn_once(tool: str, message: str):
+    if tool not in _warned:
+        _warned.add(tool)
+        logging.getLogger('uvicorn').warning(message, extra={'category': 'media'})
+
+
+def _can_convert(kind: str, media_type: str, options: MediaConfig) -> bool:
+    if kind == 'image':
+        if importlib.util.find_spec('PIL') is None:
+            _warn_once('pillow', "Media normalization is enabled but Pillow is not installed, "
+                                 "images are sent as is. Install the `media` extra.")
+            return False
+        return True
+    if shutil.which('ffmpeg'):
+        return True
+    if audioop is not None and media_type in ('audio/wav', 'audio/x-wav') and options.audio_format in (None, 'wav'):
+        return True
+    _warn_once('ffmpeg', "Media normalization is enabled but ffmpeg is not on the PATH, "
+                         "audio other than wav is sent as is.")
+    return False
+
+
+_pool: ProcessPoolExecutor | None = None
+# conversions in flight in this process: (file ID, profile) -> future
+_pending: Dict[Tuple[str, str], asyncio.Future] = {}
+
+
+def _get_pool(options: MediaConfig) -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: forking a process running threads (log queue, keep-alive) may copy held locks
+        _pool = ProcessPoolExecutor(options.workers, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+async def _make_variant(file_id: str, profile: str, options: MediaConfig) -> Tuple[str, str] | None:
+    store = get_file_store()
+    file = store.read(file_id)
+    if file is None:
+        return None
+    content, media_type = file
+    data = bytes(content)
+    content.release()
+
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            _get_pool(options), convert, data, media_type, options.model_dump())
+    except Exception as e:
+        logging.getLogger('uvicorn').warning(f"File({file_id}, type={media_type}) not normalized: {e!r}")
+        result = None
+
+    if result is None:
+        store.put_variant(file_id, profile, None)
+    else:
+        store.put_variant(file_id, profile, *result)
+        logging.getLogger('uvicorn').debug(
+            f"File({file_id}) normalized: {media_type} {len(data)} -> {result[1]} {len(result[0])} bytes",
+            extra={'category': 'media', 'before': len(data), 'after': len(result[0])})
+    return store.get_variant(file_id, profile)
+
+
+async def prepare_media(file_id: str) -> Tuple[str, str] | None:
+    """
+    Get the base64 content and media type of a file as it is sent to the LLM: images are
+    downsized and recompressed, audio resampled, by the `media` settings. Variants are made once
+    per (file, profile) in a process pool and kept in the file store.
+    Returns None if there is no such file.
+    """
+    store = get_file_store()
+    options = get_settings().media
+    entry = store.info(file_id)
+    if entry is None:
+        return None
+    kind = entry['media_type'].split('/')[0]
+    if not options.enabled or kind not in ('image', 'audio') or entry['size'] < options.min_bytes \
+            or not _can_convert(kind, entry['media_type'], options):
+        return store.get(file_id)
+
+    profile = profile_name(kind, options)
+    variant = store.get_variant(file_id, profile)
+    if variant is not None:
+        return variant
+
+    key = (file_id, profile)
+    pending = _pending.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(_make_variant(file_id, profile, options))
+        _pending[key] = pending
+        pending.add_done_callback(lambda _: _pending.pop(key, None))
+    # shielded: a cancelled request does not abort the conversion others wait for
+    variant = await asyncio.shield(pending)
+    return variant or store.get(file_id)
+
+
+def shutdown_media(cancel: bool = True):
+    """
+    Stop the worker processes. Without `cancel`, the conversions already submitted still finish.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=cancel)
+        _pool = None
+
+
+@on_config_change
+def _reset_pool(old, new):
+    # requests may be waiting for conversions of the old pool
+    if old.media.workers != new.media.workers:
+        shutdown_media(cancel=False)
@@ -3,6 +3,7 @@ from net_simulator.msgs.agent_msgs import *
 from net_simulator.msgs.user_msgs import *
 from net_simulator.msgs.task_msgs import *
 from net_simulator.msgs.graph_msgs import *
+from net_simulator.msgs.usage_msgs import *
 
 __all__ = [
     'AgentKeepAliveRequest',
@@ -15,9 +16,16 @@ __all__ = [
     'ResponseT',
     'UserRegisterRequest',
     'UserChatRequest',
+    'UserCancelRequest',
     'TaskUpdateRequestBase',
     'TaskUpdateRequest',
     'TaskArtifactUpdateRequest',
     'TaskUpdateResponse',
+    'TaskLinkRequest',
+    'TaskCancelRequest',
     'AgentInteractionAddRequest',
+    'UsageRecord',
+    'UsageReportRequest',
+    'UsageTotals',
+    'UsageSummary',
 ]
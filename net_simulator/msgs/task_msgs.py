@@ -57,6 +57,43 @@ class TaskArtifactUpdateRequest(TaskUpdateRequestBase):
     """
 
 
+class TaskLinkRequest(BaseModel):
+    """
+    Link a task delegated to another agent to the task (or user conversation) it was sent for.
+    """
+
+    parent_task_id: str
+    """
+    ID of the task or user conversation that sent the message.
+    """
+
+    task_id: str
+    """
+    ID of the task created by the other agent.
+    """
+
+    agent_url: str
+    """
+    URL of the agent running the task.
+    """
+
+
+class TaskCancelRequest(BaseModel):
+    """
+    Cancel a task and the tasks delegated by it.
+    """
+
+    task_id: str
+    """
+    ID of the task or user conversation.
+    """
+
+    agent_url: str | None = None
+    """
+    URL of the agent running the task. If None, only the delegated tasks are cancelled.
+    """
+
+
 class UserTasksResponse(ResponseBase):
     """
     Response for user tasks requests.
@@ -0,0 +1,107 @@
+from typing import Dict, List
+from net_simulator.msgs.core_msgs import ResponseBase
+from pydantic import BaseModel
+
+
+class UsageRecord(BaseModel):
+    """
+    Token usage of one LLM call.
+    """
+
+    timestamp: float
+    """
+    Unix time the call finished.
+    """
+
+    task_id: str | None = None
+    """
+    ID of the task (or user conversation) the call was made for.
+    """
+
+    agent_id: str | None = None
+    """
+    ID of the agent (or user agent) that made the call.
+    """
+
+    user_id: str | None = None
+    """
+    ID of the user the work was done for.
+    """
+
+    service: str
+    model: str | None = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+
+    latency: float
+    """
+    Duration of the call in seconds.
+    """
+
+    cost: float = 0.0
+    """
+    Cost of the call, from the prices of the `api_services` entry.
+    """
+
+
+class UsageReportRequest(BaseModel):
+    """
+    Usage records reported by a node to the system server.
+    """
+
+    records: List[UsageRecord]
+
+
+class UsageTotals(BaseModel):
+    """
+    Aggregated usage of an agent, user or task.
+    """
+
+    name: str | None = None
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    latency: float = 0.0
+    cost: float = 0.0
+
+    calls_per_minute: float = 0.0
+    tokens_per_minute: float = 0.0
+    cost_per_minute: float = 0.0
+    """
+    Rates over the last minute.
+    """
+
+
+class HedgeStats(BaseModel):
+    """
+    Hedged LLM requests of the user chats, see `llm_routing.hedge`.
+    """
+
+    requests: int = 0
+    hedged: int = 0
+    """
+    Requests also sent to a second service because the first did not answer in time.
+    """
+
+    hedge_wins: int = 0
+    """
+    Hedged requests the second service answered first.
+    """
+
+    hedge_rate: float = 0.0
+    saved_seconds: float = 0.0
+    """
+    Estimated latency saved by the hedge wins.
+    """
+
+
+class UsageSummary(BaseModel):
+    """
+    Usage totals per agent and per user.
+    """
+
+    agents: Dict[str, UsageTotals]
+    users: Dict[str, UsageTotals]
+    hedging: HedgeStats = HedgeStats()
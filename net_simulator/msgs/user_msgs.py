@@ -34,6 +34,22 @@ class UserChatRequest(BaseModel):
     """
 
 
+class UserCancelRequest(BaseModel):
+    """
+    Cancel the running chats of a user and the tasks delegated by them.
+    """
+
+    user_id: str
+    """
+    ID of the user.
+    """
+
+    conversation_id: str | None = None
+    """
+    Only cancel this conversation. If None, all conversations of the user are cancelled.
+    """
+
+
 class UserMessageResponse(ResponseBase):
     """
     Represents a response to a user message.
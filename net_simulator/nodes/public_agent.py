@@ -17,7 +17,13 @@ from a2a.types import AgentCard
 from starlette.applications import Starlette
 
 import net_simulator.executors as executors
-from net_simulator.utils import get_config
+from net_simulator.llm_cache import current_agent, log_llm_cache_stats
+from net_simulator.logs import setup_logging, update_logging
+from net_simulator.media import shutdown_media
+from net_simulator.usage import flush_usage
+from net_simulator.settings import on_config_change, watch_config
+from net_simulator.tool_loop import log_tool_cache_stats
+from net_simulator.utils import close_llm_clients, get_config, get_settings
 
 CWD = Path(__file__).parent
 AGENTS_DIR = CWD.parent / 'config' / 'agents'
@@ -31,16 +37,17 @@ class PublicAgent:
     agent_category: str
     keep_alive_thread: threading.Thread
 
-    def __init__(self, config_name: str):
+    def __init__(self, config_name: str, port: int | None = None):
         config_file = AGENTS_DIR / f'{config_name}.json'
         if not config_file.exists():
             raise FileNotFoundError(f'Agent {config_name} does not exist')
 
         self.config = json.load(open(str(config_file), 'r'))
+        if port is not None:
+            self.config['port'] = port
 
     def _keep_alive(self):
-        interval = get_config('system.keep_alive_interval')
-        sleep(interval)
+        sleep(get_settings().system.keep_alive_interval)
         while True:
             response = requests.post(
                 f"{self.manager_url}/agents/keepalive",
@@ -49,9 +56,11 @@ class PublicAgent:
             if response.status_code != 200:
                 raise RuntimeError(f"Failed to keep alive: {response.text}")
 
-            sleep(interval)
+            sleep(get_settings().system.keep_alive_interval)
 
     def run(self):
+        setup_logging(self.config['agent_card']['name'], get_config('logging'))
+        on_config_change(lambda _, new: update_logging(new.logging.model_dump()))
 
         # register
         self.manager_url = f"http://localhost:{get_config('system.port')}"
@@ -77,6 +86,8 @@ class PublicAgent:
         self.agent_category = self.config['category']
 
         print(F"Registered as {self.agent_id}")
+        # inherited by every task of the server, see `llm_cache.bypass`
+        current_agent.set(self.agent_name)
 
         exec_class = self.config['executor']
         if exec_class not in executors.__all__:
@@ -108,11 +119,18 @@ class PublicAgent:
         @asynccontextmanager
         async def app_lifespan(_: Starlette):
             # startup
+            watcher = asyncio.create_task(watch_config())
 
             # run
             yield
+            watcher.cancel()
 
             # shutdown
+            log_llm_cache_stats()
+            log_tool_cache_stats()
+            shutdown_media()
+            await flush_usage()
+            await close_llm_clients()
             try:
                 client = httpx.AsyncClient(timeout=5)
                 await client.post(
@@ -123,17 +141,19 @@ class PublicAgent:
                 pass
 
         uvicorn.run(server.build(lifespan=app_lifespan),
-                    host='0.0.0.0', port=self.config['port'])
+                    host='0.0.0.0', port=self.config['port'], log_config=None)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', '--agent')
+    parser.add_argument('-p', '--port', type=int, default=None,
+                        help='Override the port in the agent config, e.g. to run several instances.')
 
     args = parser.parse_args()
 
     if args.agent:
-        agent = PublicAgent(args.agent)
+        agent = PublicAgent(args.agent, args.port)
         agent.run()
     else:
         print('No agent defined')
@@ -8,9 +8,11 @@ from typing import Any, Dict, List, Literal, Tuple, TypeVar
 from uuid import uuid4
 
 import fastapi
+import httpx
 import uvicorn
-from a2a.types import (Artifact, Task, TaskArtifactUpdateEvent, TextPart,
-                       TaskStatusUpdateEvent, FilePart, FileWithBytes)
+from a2a.client import A2AClient
+from a2a.types import (Artifact, CancelTaskRequest, JSONRPCErrorResponse, Task, TaskArtifactUpdateEvent,
+                       TaskIdParams, TextPart, TaskStatusUpdateEvent, FilePart, FileWithBytes)
 from a2a.utils import get_text_parts
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -20,15 +22,25 @@ from pydantic import BaseModel
 
 from net_simulator.datamodels import (AgentInteraction, PublicAgentNode,
                                       StampedTask, UserAgentNode)
+from net_simulator.file_store import collect_files
+from net_simulator.llm_cache import log_llm_cache_stats
+from net_simulator.llm_routing import get_hedge_stats, log_hedge_stats
+from net_simulator.logs import setup_logging, update_logging
+from net_simulator.media import prepare_media, shutdown_media
 from net_simulator.msgs import (AgentInteractionAddRequest,
                                 AgentKeepAliveRequest, AgentRegistryInfo,
                                 AgentRegistryRequest, AgentRegistryResponse,
                                 AgentTaskCountAddRequest, ErrorResponse,
                                 ResponseT, TextResponse, UserChatRequest,
                                 UserConversationsResponse, UserMessageResponse,
-                                UserRegisterRequest, AgentInteractionDeleteRequest)
-from net_simulator.utils import (OpenAIService, SiliconFlowService, clear_files, create_file, get_config,
-                                 get_llm)
+                                UserRegisterRequest, AgentInteractionDeleteRequest,
+                                UsageReportRequest, UsageSummary, UsageTotals,
+                                TaskCancelRequest, TaskLinkRequest, UserCancelRequest)
+from net_simulator.settings import on_config_change, watch_config
+from net_simulator.tool_loop import log_tool_cache_stats
+from net_simulator.usage import UsageAggregator, UsageContext, set_usage_sink, usage_context
+from net_simulator.utils import (AGENT_SERVICE_SCRIPT, OpenAIService, SiliconFlowService, agent_service_env, clear_files,
+                                 close_llm_clients, create_file, get_config, get_llm, get_settings)
 
 CWD = Path(__file__).parent
 ROLE = get_config('system.role')
@@ -38,18 +50,26 @@ SYSTEM_PROMPT = (CONFIG_ROOT / 'user_agent_prompts' /
                  f"{ROLE}.txt").read_text()
 
 
-KEEP_ALIVE_THRESHOLD = get_config('system.keep_alive_threshold')  # seconds
-KEEP_ALIVE_INTERVAL = get_config('system.keep_alive_interval')  # seconds
 PORT = get_config('system.port')  # port for the system
 
 
 def main():
+    setup_logging('system', get_config('logging'))
+    on_config_change(lambda _, new: update_logging(new.logging.model_dump()))
     logger = logging.getLogger('uvicorn')
 
     # network graph
     graph: Dict[str, PublicAgentNode | UserAgentNode] = {}
 
-    llm = get_llm()
+    # LLM usage of all nodes, the user chats of this process are recorded directly
+    usage = UsageAggregator()
+    set_usage_sink(usage.add)
+
+    # tasks delegated by a task or user conversation: parent ID -> {task ID: agent URL}
+    task_children: Dict[str, Dict[str, str]] = {}
+    task_parents: Dict[str, str] = {}
+    # running user chats: user ID -> {conversation ID: chat}
+    user_chats: Dict[str, Dict[str, asyncio.Task]] = {}
 
     # ================================================================================
     # Public agnets registration
@@ -60,24 +80,34 @@ def main():
         Periodically check if agents are still alive.
         """
         while True:
+            # read on every round, both values can be hot reloaded
+            system_config = get_settings().system
             current_time = time.time()
             for agent_id, agent in list(graph.items()):
                 if agent.kind != 'public':
                     continue
-                if current_time - agent.lastseen > KEEP_ALIVE_THRESHOLD:
+                if current_time - agent.lastseen > system_config.keep_alive_threshold:
                     logger.warning(
                         f"Agent({agent_id}) is inactive, removing from registry.")
                     del graph[agent_id]
-            await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+            await asyncio.sleep(system_config.keep_alive_interval)
 
     @asynccontextmanager
     async def lifespan(_: fastapi.FastAPI):
         """
-        Lifespan event to start the keep-alive check.
+        Lifespan event to start the keep-alive check and the config watcher.
         """
         asyncio.create_task(keep_alive_check())
-        clear_files()
+        asyncio.create_task(watch_config())
+        if get_settings().files.clear_on_start:
+            clear_files()
+        asyncio.create_task(collect_files())
         yield
+        log_llm_cache_stats()
+        log_tool_cache_stats()
+        log_hedge_stats()
+        shutdown_media()
+        await close_llm_clients()
 
     app = FastAPI(lifespan=lifespan)
 
@@ -131,7 +161,8 @@ def main():
             )
 
         graph[request.agent_id].lastseen = time.time()
-        logger.info(f"Agent({request.agent_id}) keep-alive.")
+        logger.info(f"Agent({request.agent_id}) keep-alive.",
+                    extra={'category': 'keepalive'})
         return TextResponse(content='OK')
 
     @app.post('/agents/discover')
@@ -306,7 +337,8 @@ def main():
         agent = graph[request.agent_id]
         agent.task_count += 1
         logger.info(
-            f"Agent({request.agent_id}) task_count ADD -> {agent.task_count}.")
+            f"Agent({request.agent_id}) task_count ADD -> {agent.task_count}.",
+            extra={'category': 'task_count'})
         return TextResponse(content='ok')
 
     @app.post('/task_count/delete')
@@ -332,7 +364,8 @@ def main():
         if agent.task_count > 0:
             agent.task_count -= 1
             logger.info(
-                f"Agent({request.agent_id}) task_count DELETE -> {agent.task_count}.")
+                f"Agent({request.agent_id}) task_count DELETE -> {agent.task_count}.",
+                extra={'category': 'task_count'})
         return TextResponse(content='ok')
 
     @app.get('/task_count/{agent_id}')
@@ -398,7 +431,7 @@ def main():
         user = graph[user_id]
         user.tasks[request.id] = request
 
-        logger.info(f"Task(id={request.id})")
+        logger.info(f"Task(id={request.id})", extra={'category': 'event'})
         return TextResponse(content='ok')
 
     @app.post('/events/task_status/{user_id}')
@@ -407,6 +440,9 @@ def main():
         Handle task update requests.
         """
 
+        if request.final:
+            unlink_task(request.taskId)
+
         if not user_id in graph:
             logger.error(f"User {user_id} does not exist.")
             return ErrorResponse(message=f"User {user_id} does not exist.")
@@ -426,7 +462,8 @@ def main():
         task.status = request.status
 
         logger.info(
-            f"TaskStatusUpdate(id={request.taskId}, state={request.status.state})")
+            f"TaskStatusUpdate(id={request.taskId}, state={request.status.state})",
+            extra={'category': 'event'})
         return TextResponse(content='ok')
 
     @app.post('/events/task_artifact/{user_id}')
@@ -471,7 +508,8 @@ def main():
         task.artifacts.append(request.artifact)
 
         logger.info(
-            f"TaskArtifactUpdate(id={request.taskId}, artifactId={request.artifact.artifactId})")
+            f"TaskArtifactUpdate(id={request.taskId}, artifactId={request.artifact.artifactId})",
+            extra={'category': 'event'})
         return TextResponse(content='ok')
 
     @app.get('/events/get/all_tasks')
@@ -560,6 +598,111 @@ def main():
 
         return ResponseT(content=all_artifacts)
 
+    # ================================================================================
+    # Task cancellation
+    # ================================================================================
+
+    def unlink_task(task_id: str):
+        parent = task_parents.pop(task_id, None)
+        if parent is not None:
+            children = task_children.get(parent, {})
+            children.pop(task_id, None)
+            if not children:
+                task_children.pop(parent, None)
+
+    async def cancel_agent_task(agent_url: str, task_id: str) -> str | None:
+        """
+        Cancel a task at its agent. Returns the error, if any.
+        """
+        try:
+            async with httpx.AsyncClient(timeout=30) as httpx_client:
+                client = A2AClient(httpx_client=httpx_client, url=agent_url)
+                response = await client.cancel_task(
+                    CancelTaskRequest(id=uuid4().hex, params=TaskIdParams(id=task_id)))
+        except httpx.HTTPError as e:
+            return str(e)
+        if isinstance(response.root, JSONRPCErrorResponse):
+            return str(response.root.error.message)
+        return None
+
+    async def cancel_children(task_id: str) -> int:
+        """
+        Cancel the tasks delegated by a task or user conversation. Their executors cancel the
+        tasks they delegated in turn. Returns the number of tasks.
+        """
+        children = task_children.pop(task_id, {})
+        for child_id in children:
+            task_parents.pop(child_id, None)
+
+        errors = await asyncio.gather(*[cancel_agent_task(url, child_id) for child_id, url in children.items()])
+        for (child_id, url), error in zip(children.items(), errors):
+            if error is not None:
+                logger.warning(f"Failed to cancel Task({child_id}) at {url}: {error}")
+        return len(children)
+
+    @app.post('/tasks/link')
+    def task_link(request: TaskLinkRequest):
+        """
+        Record that a task was delegated by another task or user conversation.
+        """
+        task_children.setdefault(request.parent_task_id, {})[request.task_id] = request.agent_url
+        task_parents[request.task_id] = request.parent_task_id
+        return TextResponse(content='ok')
+
+    @app.post('/tasks/cancel')
+    async def task_cancel(request: TaskCancelRequest):
+        """
+        Cancel a task at its agent, which also cancels the tasks it delegated.
+        Without `agent_url`, only the tasks delegated by the task are cancelled.
+        """
+        if request.agent_url is None:
+            count = await cancel_children(request.task_id)
+            if count:
+                logger.info(f"TaskCancel(id={request.task_id}, delegated={count})", extra={'category': 'event'})
+            return TextResponse(content='ok')
+
+        error = await cancel_agent_task(request.agent_url, request.task_id)
+        unlink_task(request.task_id)
+        if error is not None:
+            logger.error(f"Failed to cancel Task({request.task_id}): {error}")
+            return ErrorResponse(message=f"Failed to cancel task {request.task_id}: {error}")
+
+        logger.info(f"TaskCancel(id={request.task_id})", extra={'category': 'event'})
+        return TextResponse(content='ok')
+
+    # ================================================================================
+    # LLM usage
+    # ================================================================================
+
+    @app.post('/usage/report')
+    def usage_report(request: UsageReportRequest) -> ResponseT[int]:
+        """
+        Receive the usage records of a node.
+        """
+        usage.add(request.records)
+        return ResponseT(content=len(request.records))
+
+    @app.get('/usage')
+    def get_usage() -> ResponseT[UsageSummary]:
+        """
+        Get the token usage, cost and latency totals and per-minute rates of every agent and user,
+        and the hedging of the user chat requests.
+        """
+        names = {node_id: node.name for node_id, node in graph.items()}
+        summary = usage.summary(names)
+        summary.hedging = get_hedge_stats()
+        return ResponseT(content=summary)
+
+    @app.get('/usage/task/{task_id}')
+    def get_task_usage(task_id: str) -> ResponseT[UsageTotals] | ErrorResponse:
+        """
+        Get the usage totals of a task or user conversation.
+        """
+        totals = usage.task(task_id)
+        if totals is None:
+            return ErrorResponse(message=f"No usage recorded for task {task_id}.")
+        return ResponseT(content=totals)
+
     # ============================================================
     # User Services
     # ============================================================
@@ -622,6 +765,40 @@ def main():
         logger.info("All users unregistered.")
         return TextResponse(content='ok')
 
+    @app.post('/user/cancel')
+    async def user_cancel(request: UserCancelRequest) -> ResponseT[int]:
+        """
+        Cancel the running chats of a user and the tasks they delegated.
+        Returns the number of cancelled chats and delegated tasks.
+        """
+
+        user_id = request.user_id
+
+        if not user_id in graph:
+            logger.error(f"User {user_id} does not exist.")
+            return ErrorResponse(message=f"User {user_id} does not exist.")
+
+        if graph[user_id].kind != 'user':
+            logger.error(f"User {user_id} is not a user agent.")
+            return ErrorResponse(message=f"User {user_id} is not a user agent.")
+
+        chats = user_chats.get(user_id, {})
+        if request.conversation_id is not None:
+            conversations = [request.conversation_id]
+        else:
+            conversations = list(set(chats) | set(graph[user_id].conversations))
+
+        count = 0
+        for conversation_id in conversations:
+            chat = chats.get(conversation_id)
+            if chat is not None and not chat.done():
+                chat.cancel()
+                count += 1
+            count += await cancel_children(conversation_id)
+
+        logger.info(f"UserCancel(id={user_id}, cancelled={count})", extra={'category': 'event'})
+        return ResponseT(content=count)
+
     @app.post('/user/chat')
     async def chat(request: UserChatRequest):
         """
@@ -658,16 +835,26 @@ def main():
                 if not isinstance(part.file, FileWithBytes):
                     return ErrorResponse(message="Only FileWithBytes is supported.")
                 media_type = part.file.mimeType
-                if (not media_type) or (media_type not in get_config('system.supported_media_types')):
+                if (not media_type) or (media_type not in get_settings().system.supported_media_types):
                     return ErrorResponse(message=f"Unsupported media type: {media_type}")
+                try:
+                    # kept for the conversation, agents get the file by ID
+                    file_id = create_file(part.file.bytes, media_type,
+                                          holder=f"conversation:{user_id}/{request.conversation_id}", owner=user_id)
+                except ValueError as e:
+                    logger.error(f"User {user_id} file rejected: {e}")
+                    return ErrorResponse(message=str(e))
+                # the model gets the file normalized, e.g. a downsized image
+                llm_bytes, llm_media_type = await prepare_media(file_id) or (part.file.bytes, media_type)
                 if part.file.mimeType.startswith('image/'):
+                    image_detail = get_settings().media.image_detail
                     user_media.append({
                         'type': 'image_url',
                         'image_url': {
-                            'url': f"data:{media_type};base64,{part.file.bytes}",
+                            'url': f"data:{llm_media_type};base64,{llm_bytes}",
+                            **({'detail': image_detail} if image_detail else {}),
                         }
                     })
-                    file_id = create_file(part.file.bytes, part.file.mimeType)
                     user_media.append({
                         'type': 'text',
                         'text': f"The ID of this image in the file system is {file_id}. You can use this ID to communicating with other agents."
@@ -678,11 +865,10 @@ def main():
                     user_media.append({
                         'type': 'input_audio',
                         'input_audio': {
-                            'data': part.file.bytes,
-                            'format': part.file.mimeType.split('/')[1],
+                            'data': llm_bytes,
+                            'format': llm_media_type.split('/')[1],
                         }
                     })
-                    file_id = create_file(part.file.bytes, part.file.mimeType)
                     user_media.append({
                         'type': 'text',
                         'text': f"The ID of this video in the file system is {file_id}. You can use this ID to communicating with other agents."
@@ -694,8 +880,9 @@ def main():
 
         try:
             transport = PythonStdioTransport(
-                script_path='/home/yan2u/learn_a2a/net_simulator/mcp/agent_service.py',
+                script_path=AGENT_SERVICE_SCRIPT,
                 args=['-i', request.user_id, '-r', 'user'],
+                env=agent_service_env(request.conversation_id)
             )
             if not user_media:
                 messages.append({
@@ -713,10 +900,27 @@ def main():
                         *user_media
                     ]
                 })
-            messages, choice = await llm.send_message_mcp(
+            usage_context.set(UsageContext(
+                task_id=request.conversation_id, agent_id=user_id, user_id=user_id))
+            # the user waits for this answer, hedge slow providers if configured
+            llm = get_llm(hedge=True)
+            # a separate task, so /user/cancel can cancel the chat and still answer this request
+            chat_task = asyncio.create_task(llm.send_message_mcp(
                 messages=messages,
                 mcp_url=transport
-            )
+            ))
+            chats = user_chats.setdefault(user_id, {})
+            chats[request.conversation_id] = chat_task
+            try:
+                messages, choice = await chat_task
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                logger.info(f"Chat(user={user_id}, conversation={request.conversation_id}) cancelled.")
+                return ErrorResponse(message='The chat was cancelled.')
+            finally:
+                if chats.get(request.conversation_id) is chat_task:
+                    del chats[request.conversation_id]
             user.conversations[request.conversation_id] = messages
             return TextResponse(content=str(choice.message.content))
         except Exception as e:
@@ -777,7 +981,7 @@ def main():
         allow_headers=["*"],
     )
 
-    uvicorn.run(app, host='0.0.0.0', port=get_config('system.port'))
+    uvicorn.run(app, host='0.0.0.0', port=PORT, log_config=None)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List
+from uuid import uuid4
+
+from openai.types.chat import ChatCompletionMessageParam
+
+from net_simulator.settings import CWD, get_settings, on_config_change
+
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): buckets are only shared by the threads of one process
+    fcntl = None
+
+# rough cost of an image or audio part, their base64 data says little about the tokens
+MEDIA_TOKENS = 1000
+# waiters poll the bucket state between these intervals (seconds), a ticket not polled
+# for `TICKET_TIMEOUT` seconds is dropped from the queue
+MIN_POLL = 0.05
+MAX_POLL = 1.0
+TICKET_TIMEOUT = 10.0
+
+
+def estimate_tokens(messages: List[ChatCompletionMessageParam]) -> int:
+    """
+    Estimate the tokens of a request: about 4 characters per token for text, a fixed cost
+    per media part, plus `rate_limits.output_tokens` for the answer.
+    """
+    chars, media = 0, 0
+    for message in messages:
+        content = message.get('content') if isinstance(message, dict) else getattr(message, 'content', None)
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'text':
+                    chars += len(part['text'])
+                else:
+                    media += 1
+    return chars // 4 + media * MEDIA_TOKENS + get_settings().rate_limits.output_tokens
+
+
+class RateLimiter:
+    """
+    Token buckets for the requests (RPM) and estimated tokens (TPM) of one provider and API key.
+    The bucket state is kept in a file guarded by flock, so all processes of the host draw
+    from the same buckets. Callers wait for capacity instead of running into 429s, in the
+    order they arrived: waiters queue their tickets in the state file and only the oldest one
+    may draw, so a large request is not starved by smaller ones arriving after it.
+    """
+
+    name: str
+    rpm: int | None
+    tpm: int | None
+    path: Path
+    logger: logging.Logger
+
+    def __init__(self, name: str, rpm: int | None, tpm: int | None, directory: Path, bucket: str | None = None):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.path = directory / f"{bucket or name}.json"
+        self.logger = logging.getLogger('uvicorn')
+        self._lock = threading.Lock()
+        directory.mkdir(parents=True, exist_ok=True)
+
+    def _refill(self, state: dict, now: float) -> dict:
+        elapsed = max(0.0, now - state['time'])
+        return {
+            'requests': min(self.rpm or 0, state['requests'] + elapsed * (self.rpm or 0) / 60),
+            'tokens': min(self.tpm or 0, state['tokens'] + elapsed * (self.tpm or 0) / 60),
+            'time': now,
+            'queue': state.get('queue', {}),
+            'until': state.get('until', 0.0)
+        }
+
+    @contextmanager
+    def _state(self) -> Iterator[dict]:
+        with self._lock, open(self.path, 'a+') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            now = time.time()
+            try:
+                state = self._refill(json.loads(f.read()), now)
+            except (ValueError, KeyError):
+                state = self._refill({'requests': self.rpm or 0, 'tokens': self.tpm or 0, 'time': now}, now)
+            yield state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+
+    def _take(self, tokens: int, ticket: str) -> float:
+        """
+        Take one request and `tokens` from the buckets for `ticket`, queueing it on the first call.
+        Returns 0 on success, otherwise the seconds until it should try again.
+        """
+        # a request larger than the whole bucket waits for a full bucket
+        tokens = min(tokens, self.tpm or 0)
+        with self._state() as state:
+            now = state['time']
+            # tickets are [arrival, last poll]; waiters that stopped polling (their process died) leave
+            queue = {key: times for key, times in state['queue'].items() if now - times[1] < TICKET_TIMEOUT}
+            queue[ticket] = [queue.get(ticket, [now])[0], now]
+            state['queue'] = queue
+            if min(queue, key=lambda key: queue[key][0]) != ticket:
+                # the oldest waiter draws first, it expects capacity at `until`
+                return max(state['until'] - now, MIN_POLL)
+
+            wait = 0.0
+            if self.rpm and state['requests'] < 1:
+                wait = (1 - state['requests']) * 60 / self.rpm
+            if self.tpm and state['tokens'] < tokens:
+                wait = max(wait, (tokens - state['tokens']) * 60 / self.tpm)
+            if wait == 0:
+                state['requests'] -= 1 if self.rpm else 0
+                state['tokens'] -= tokens if self.tpm else 0
+                del queue[ticket]
+            state['until'] = now + wait
+            return wait
+
+    def _leave(self, ticket: str):
+        with self._state() as state:
+            state['queue'].pop(ticket, None)
+
+    async def acquire(self, tokens: int):
+        start = time.monotonic()
+        ticket = uuid4().hex
+        try:
+            while True:
+                wait = await asyncio.to_thread(self._take, tokens, ticket)
+                if wait == 0:
+                    break
+                # poll at least every `MAX_POLL` seconds, so the ticket does not time out
+                await asyncio.sleep(min(wait, MAX_POLL))
+        except asyncio.CancelledError:
+            # do not hold up the queue until the ticket times out
+            self._leave(ticket)
+            raise
+
+        waited = time.monotonic() - start
+        if waited > 0.01:
+            self.logger.debug(
+                f"Rate limit of {self.name}: waited {waited:.2f}s for {tokens} tokens.",
+                extra={'category': 'rate_limit', 'service': self.name, 'waited': waited})
+
+
+_limiters: Dict[str, RateLimiter | None] = {}
+
+
+def get_rate_limiter(api_service: str) -> RateLimiter | None:
+    """
+    Get the limiter of an `api_services` entry, or None if it sets neither `rpm` nor `tpm`.
+    Services with the same `base_url` and `api_key` draw from the same buckets.
+    """
+    if api_service not in _limiters:
+        settings = get_settings()
+        service = settings.api_services.get(api_service)
+        limiter = None
+        if service is not None and (service.rpm or service.tpm):
+            directory = settings.rate_limits.directory
+            # the key is hashed, it is not written to the disk
+            bucket = f"{service.base_url or ''}\n{service.api_key or ''}"
+            bucket = hashlib.sha256(bucket.encode('utf-8')).hexdigest()[:16]
+            limiter = RateLimiter(
+                api_service, service.rpm, service.tpm,
+                Path(directory) if directory else CWD / 'data' / 'rate_limits', bucket
+            )
+        _limiters[api_service] = limiter
+    return _limiters[api_service]
+
+
+@on_config_change
+def _reset_limiters(old, new):
+    if old.api_services != new.api_services or old.rate_limits != new.rate_limits:
+        _limiters.clear()
@@ -0,0 +1,435 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Literal
+
+from pydantic import BaseModel, ConfigDict, ValidationError
+
+CWD = Path(__file__).parent
+CONFIG_ENV = 'NET_SIMULATOR_CONFIG'
+CONFIG_FILE = Path(os.environ.get(
+    CONFIG_ENV, CWD / 'config' / 'config.json'))
+
+# fields that are bound once at startup (ports, prompts...), never hot reloaded
+UNSAFE_FIELDS = ['system.port', 'system.role', 'mcp']
+
+
+class SystemConfig(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    port: int = 8080
+    keep_alive_threshold: float = 30
+    keep_alive_interval: float = 10
+    supported_media_types: List[str] = []
+    role: str = 'general'
+    config_watch_interval: float = 2.0
+
+
+class ProxyConfig(BaseModel):
+    """
+    Proxy settings. Besides `enabled` and `use`, each extra key maps a proxy name to its URL.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    enabled: bool = False
+    use: str = 'ssh'
+
+    @property
+    def url(self) -> str | None:
+        return getattr(self, self.use, None) if self.enabled else None
+
+
+class ApiServiceConfig(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    api_key: str | None = None
+    base_url: str | None = None
+    model: str | None = None
+    tools: bool = True
+    # client-side limits shared by the processes of the host, see `rate_limits`
+    rpm: int | None = None
+    tpm: int | None = None
+    # prices per 1M tokens, cached prompt tokens cost `prompt_price` unless `cached_price` is set
+    prompt_price: float = 0.0
+    completion_price: float = 0.0
+    cached_price: float | None = None
+
+
+class McpConfig(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    langsearch_port: int = 8081
+    agent_discover_port: int = 8082
+    medical_record_port: int = 8083
+    drug_inventory_port: int = 8084
+
+
+class HttpClientConfig(BaseModel):
+    """
+    Connection pool of the shared LLM provider clients.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 60
+    http2: bool = True
+    timeout: float = 600
+    connect_timeout: float = 10
+    # retries inside the OpenAI SDK, by default none when `llm_routing` retries within its
+    # budget and the SDK default otherwise
+    max_retries: int | None = None
+
+
+class LLMConfig(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    tool_concurrency: int = 4
+    max_iterations: int = 20
+    turn_timeout: float = 600
+    deadline: float = 1800
+    # how long MCP tool listings are reused, 0 lists the tools on every run
+    tool_list_ttl: float = 300
+    # stream responses as artifact chunks, flushed every `stream_flush_chars` or `stream_flush_interval` seconds
+    stream: bool = True
+    stream_flush_chars: int = 200
+    stream_flush_interval: float = 0.5
+
+
+class ToolResultsConfig(BaseModel):
+    """
+    Post-processing of tool results before they are added to the history. `drop_keys` are removed
+    from JSON results at any depth (A2A task history by default). Results longer than `max_chars`
+    are truncated; with `offload` the full result is kept under `directory` (default
+    `data/tool_results`) and the model can read it with the `tool_result_read` tool.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    enabled: bool = True
+    drop_keys: List[str] = ['history']
+    drop_nulls: bool = True
+    max_chars: int = 8000
+    offload: bool = False
+    directory: str | None = None
+
+
+class ToolCachePolicy(BaseModel):
+    """
+    Caching of an idempotent tool. `key_fields` are the arguments identifying a result (all if
+    not set), `scope` who shares the results, `invalidated_by` the tools that modify them. A call
+    of those drops the results whose key arguments match its arguments of the same name, or all
+    results if it has no argument named like a key field.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    ttl: float = 60
+    key_fields: List[str] | None = None
+    scope: Literal['task', 'agent', 'global'] = 'task'
+    invalidated_by: List[str] = []
+
+
+class ToolCacheConfig(BaseModel):
+    """
+    Results of the tools listed in `tools` are reused by the tool loop, see `ToolCachePolicy`.
+    Invalidation only sees the calls of this process, so tools whose data other processes
+    modify are shared per task.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    enabled: bool = True
+    max_entries: int = 1024
+    tools: Dict[str, ToolCachePolicy] = {
+        'agent_discover': ToolCachePolicy(ttl=30, scope='global'),
+        'search_web': ToolCachePolicy(ttl=3600, scope='global'),
+        'Langsearch': ToolCachePolicy(ttl=3600, scope='global'),
+        'get_medical_record': ToolCachePolicy(
+            ttl=300, scope='task', key_fields=['record_id'], invalidated_by=['add_medical_record']),
+        'list_all_medical_records': ToolCachePolicy(ttl=300, scope='task', invalidated_by=['add_medical_record']),
+        'get_expense_items': ToolCachePolicy(ttl=300, scope='task', invalidated_by=['add_expense_item']),
+    }
+
+
+class FilesConfig(BaseModel):
+    """
+    File store shared by the nodes, `directory` defaults to `data/filesystem`.
+    `b64_cache_bytes` caps the base64 forms of recently read files kept by each process.
+    References to files expire after `ttl` seconds (0 for never); the files a user or agent
+    references may take `quota_bytes` (per ID in `quotas`). The system server collects expired
+    files every `gc_interval` seconds, `gc_batch` files at a time. Recently used files are
+    shared by the nodes of a host through `spool_bytes` of memory under `spool_directory`
+    (default a directory in `/dev/shm`, 0 bytes to disable).
+    """
+    model_config = ConfigDict(extra='allow')
+
+    directory: str | None = None
+    b64_cache_bytes: int = 32 * 1024 * 1024
+    ttl: float = 86400
+    quota_bytes: int | None = None
+    quotas: Dict[str, int] = {}
+    gc_interval: float = 60
+    gc_batch: int = 100
+    clear_on_start: bool = False
+    spool_directory: str | None = None
+    spool_bytes: int = 256 * 1024 * 1024
+
+
+class MediaConfig(BaseModel):
+    """
+    Normalization of the images and audio sent to the LLM. Images are downsized to
+    `image_max_size` pixels and recompressed (needs Pillow), audio is resampled to
+    `audio_sample_rate` and converted to `audio_format` (needs ffmpeg, except for wav).
+    Files smaller than `min_bytes` are sent as is. `image_detail` is passed to OpenAI if set.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    enabled: bool = True
+    min_bytes: int = 64 * 1024
+    image_max_size: int = 1024
+    image_format: Literal['jpeg', 'png'] = 'jpeg'
+    image_quality: int = 85
+    image_detail: Literal['low', 'high', 'auto'] | None = None
+    audio_format: Literal['mp3', 'wav'] | None = None
+    audio_sample_rate: int = 16000
+    audio_channels: int = 1
+    workers: int = 2
+    timeout: float = 60
+
+
+class RateLimitsConfig(BaseModel):
+    """
+    Shared state of the `rpm` / `tpm` buckets, `directory` defaults to `data/rate_limits`.
+    `output_tokens` is the answer size assumed when estimating the tokens of a request.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    directory: str | None = None
+    output_tokens: int = 512
+
+
+class LLMCacheConfig(BaseModel):
+    """
+    Exact-match response cache. `directory` defaults to `data/llm_cache`, `bypass` lists agent names never cached.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    enabled: bool = False
+    memory_entries: int = 1024
+    disk: bool = True
+    directory: str | None = None
+    ttl: float = 86400
+    bypass: List[str] = []
+
+
+class RoutingConfig(BaseModel):
+    """
+    Retries and failover of LLM requests. `fallbacks` lists `api_services` tried after `api_service`.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    enabled: bool = True
+    fallbacks: List[str] = []
+    max_attempts: int = 4
+    backoff_base: float = 0.5
+    backoff_max: float = 8
+    # retries allowed per 10s window: retry_budget_min + retry_budget_ratio * requests
+    retry_budget_ratio: float = 0.2
+    retry_budget_min: int = 10
+    breaker_failures: int = 5
+    breaker_reset: float = 30
+    # hedge interactive requests (/user/chat): after the `hedge_percentile` latency of the
+    # primary service (`hedge_delay` until `hedge_min_samples` are known), ask a fallback too
+    hedge: bool = False
+    hedge_percentile: float = 95
+    hedge_delay: float = 2.0
+    hedge_min_samples: int = 20
+
+
+class LoggingConfig(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    level: str = 'INFO'
+    format: str = 'plain'
+    max_field_length: int = 512
+    queue_size: int = 10000
+    sampling: Dict[str, dict] = {}
+
+
+class Config(BaseModel):
+    """
+    Typed view of `config.json`. Unknown sections are kept as extra fields.
+    """
+    model_config = ConfigDict(extra='allow')
+
+    system: SystemConfig = SystemConfig()
+    proxy: ProxyConfig = ProxyConfig()
+    api_services: Dict[str, ApiServiceConfig] = {}
+    api_service: str = 'openai'
+    langsearch_api_key: str | None = None
+    mcp: McpConfig = McpConfig()
+    logging: LoggingConfig = LoggingConfig()
+    http_client: HttpClientConfig = HttpClientConfig()
+    llm: LLMConfig = LLMConfig()
+    tool_results: ToolResultsConfig = ToolResultsConfig()
+    tool_cache: ToolCacheConfig = ToolCacheConfig()
+    llm_cache: LLMCacheConfig = LLMCacheConfig()
+    llm_routing: RoutingConfig = RoutingConfig()
+    rate_limits: RateLimitsConfig = RateLimitsConfig()
+    files: FilesConfig = FilesConfig()
+    media: MediaConfig = MediaConfig()
+
+
+ConfigCallback = Callable[[Config, Config], None]
+
+_MISSING = object()
+_lock = threading.RLock()
+_raw: dict = {}
+_settings: Config = Config()
+_lookup: Dict[str, Any] = {}
+_callbacks: List[ConfigCallback] = []
+_mtime: float = 0.0
+
+
+def _walk(obj: Any, keys: List[str]) -> Any:
+    for k in keys:
+        if isinstance(obj, dict) and k in obj:
+            obj = obj[k]
+        else:
+            return _MISSING
+    return obj
+
+
+def _apply(raw: dict) -> Config:
+    global _raw, _settings, _lookup
+
+    settings = Config.model_validate(raw)
+    _raw, _settings, _lookup = raw, settings, {}
+    return settings
+
+
+def _notify(old: Config, new: Config):
+    for callback in list(_callbacks):
+        try:
+            callback(old, new)
+        except Exception:
+            logging.getLogger('uvicorn').exception('Config change callback failed.')
+
+
+def get_settings() -> Config:
+    """
+    Get the typed configuration of this process.
+    Do not keep the returned object for long, it is replaced on reload.
+    """
+    return _settings
+
+
+def get_config(key: str, default=None):
+    # key can be nested, e.g., 'database.host'
+    raw, lookup = _raw, _lookup
+    value = lookup.get(key, _MISSING)
+    if value is _MISSING:
+        value = _walk(raw, key.split('.'))
+        lookup[key] = value
+    return default if value is _MISSING else value
+
+
+def save_config(key: str, value):
+    """
+    Set a (nested) config value and persist it to the config file.
+    """
+    global _mtime
+
+    keys = key.split('.')
+    with _lock:
+        raw = json.loads(json.dumps(_raw))
+        obj = raw
+        for k in keys[:-1]:
+            if not isinstance(obj.get(k), dict):
+                obj[k] = {}
+            obj = obj[k]
+        obj[keys[-1]] = value
+
+        old = _settings
+        new = _apply(raw)
+        tmp_file = CONFIG_FILE.with_suffix('.json.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(raw, f, indent=2)
+        os.replace(tmp_file, CONFIG_FILE)
+        _mtime = CONFIG_FILE.stat().st_mtime
+
+    _notify(old, new)
+
+
+def reload_config() -> bool:
+    """
+    Re-read the config file. Fields in `UNSAFE_FIELDS` keep their current values.
+    Returns True if the config changed. An invalid file is logged and ignored.
+    """
+    global _mtime
+
+    logger = logging.getLogger('uvicorn')
+    with _lock:
+        try:
+            _mtime = CONFIG_FILE.stat().st_mtime
+            raw = json.loads(CONFIG_FILE.read_text())
+            Config.model_validate(raw)
+        except (OSError, ValueError, ValidationError) as e:
+            logger.error(f"Config reload failed, keeping current config: {e}")
+            return False
+
+        for field in UNSAFE_FIELDS:
+            keys = field.split('.')
+            old_value = _walk(_raw, keys)
+            parent = _walk(raw, keys[:-1]) if len(keys) > 1 else raw
+            if old_value is _MISSING or not isinstance(parent, dict):
+                continue
+            if parent.get(keys[-1], _MISSING) != old_value:
+                logger.warning(
+                    f"Config field '{field}' cannot be hot reloaded, restart to apply it.")
+                parent[keys[-1]] = old_value
+
+        if raw == _raw:
+            return False
+
+        old = _settings
+        new = _apply(raw)
+
+    logger.info('Config reloaded.')
+    _notify(old, new)
+    return True
+
+
+def on_config_change(callback: ConfigCallback) -> ConfigCallback:
+    """
+    Register `callback(old, new)` to be called after the config changed.
+    Use it to refresh values derived from the config. Can be used as a decorator.
+    """
+    _callbacks.append(callback)
+    return callback
+
+
+async def watch_config(interval: float | None = None):
+    """
+    Reload the config file when it is modified, until cancelled. Run it as a task on the event
+    loop: the config change callbacks then run on the loop, which owns the state they reset.
+    """
+    interval = interval or _settings.system.config_watch_interval
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if CONFIG_FILE.stat().st_mtime != _mtime:
+                reload_config()
+        except OSError:
+            pass
+
+
+def _load():
+    global _mtime
+
+    _mtime = CONFIG_FILE.stat().st_mtime
+    _apply(json.loads(CONFIG_FILE.read_text()))
+
+
+_load()
@@ -0,0 +1,9 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+# the settings are loaded on import: point them at a copy of the example config
+_config = Path(tempfile.mkdtemp()) / 'config.json'
+shutil.copy(Path(__file__).parent.parent / 'config' / 'config_example.json', _config)
+os.environ.setdefault('NET_SIMULATOR_CONFIG', str(_config))
@@ -0,0 +1,32 @@
+"""
+Stdio MCP server used by the tests: a record store that counts the reads.
+"""
+import json
+import os
+
+from fastmcp import FastMCP
+
+mcp = FastMCP("records")
+versions = {}
+reads = {'count': 0}
+
+
+@mcp.tool()
+def get_medical_record(record_id: str) -> str:
+    reads['count'] += 1
+    return json.dumps({'record_id': record_id, 'version': versions.get(record_id, 0), 'reads': reads['count']})
+
+
+@mcp.tool()
+def add_medical_record(record_id: str) -> str:
+    versions[record_id] = versions.get(record_id, 0) + 1
+    return 'ok'
+
+
+@mcp.tool()
+def get_environ(name: str) -> str:
+    return os.environ.get(name, '')
+
+
+if __name__ == '__main__':
+    mcp.run()
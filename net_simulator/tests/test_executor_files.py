@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+from a2a.types import FilePart, FileWithBytes
+
+from net_simulator import file_store
+from net_simulator.executors.executor_base import ExecutorBase
+from net_simulator.file_store import FileStore
+from net_simulator.settings import FilesConfig
+
+
+class Executor(ExecutorBase):
+    async def _execute(self, context, event_queue):
+        pass
+
+
+def test_agent_file_quota(tmp_path, monkeypatch):
+    """
+    Files received by a task are charged to the agent running it.
+    """
+    options = FilesConfig(spool_bytes=0, quotas={'doctor': 10})
+    store = FileStore(tmp_path / 'files', options)
+    monkeypatch.setattr(file_store, '_store', store)
+    small = store.create(b'small', 'text/plain', holder='conversation:user/1')
+    large = store.create(b'a larger file', 'text/plain', holder='conversation:user/1')
+
+    def part(file_id: str) -> FilePart:
+        return FilePart(file=FileWithBytes(bytes=file_id, name='file', mimeType='text/plain'))
+
+    doctor = Executor('doctor')
+    assert asyncio.run(doctor._replace_file_part(part(small), 'task-1')).file.mimeType == 'text/plain'
+    assert store.usage['doctor'] == 5
+    with pytest.raises(ValueError, match='quota of doctor'):
+        asyncio.run(doctor._replace_file_part(part(large), 'task-2'))
+    # other agents have no quota
+    asyncio.run(Executor('nurse')._replace_file_part(part(large), 'task-3'))
@@ -0,0 +1,70 @@
+import time
+
+from net_simulator.file_store import VARIANTS, FileStore, MediaSpool
+from net_simulator.settings import FilesConfig
+
+
+def _store(tmp_path) -> FileStore:
+    return FileStore(tmp_path / 'files', FilesConfig(spool_directory=str(tmp_path / 'spool')))
+
+
+def test_collect_expired(tmp_path):
+    store = _store(tmp_path)
+    expiring = store.create(b'expiring', 'text/plain', ttl=0.01)
+    kept = store.create(b'kept', 'text/plain', ttl=0)
+    store.put_variant(expiring, 'profile', b'variant', 'text/plain')
+    time.sleep(0.02)
+
+    # another process sees the same store
+    other = _store(tmp_path)
+    assert other.collect() == 1
+    assert other.info(expiring) is None and store.read(expiring) is None
+    assert not (tmp_path / 'files' / VARIANTS / expiring).exists()
+    assert store.get(kept) is not None
+
+
+def test_sweep_unknown_files(tmp_path):
+    store = _store(tmp_path)
+    file_id = store.create(b'content', 'text/plain')
+    (tmp_path / 'files' / 'unknown').write_bytes(b'stray')
+    (tmp_path / 'files' / '.upload.tmp').write_bytes(b'uploading')
+
+    store.collect()
+    names = {item.name for item in (tmp_path / 'files').iterdir()}
+    assert 'unknown' not in names
+    assert {file_id, '.upload.tmp'} <= names
+
+
+def test_compact(tmp_path):
+    store = _store(tmp_path)
+    file_id = store.create(b'content', 'text/plain', holder='task-1', ttl=0)
+    for i in range(1200):
+        store.acquire(file_id, f"task-{i % 2}")
+        store.release(file_id, 'task-0')
+    lines = store._lines
+
+    store.collect()
+    assert store._lines < lines
+    assert _store(tmp_path).info(file_id)['refs'].keys() == {'task-1'}
+
+
+def test_spool_index(tmp_path, monkeypatch):
+    spool = MediaSpool(tmp_path / 'spool', 100)
+    spool.put('a', b'a' * 20, 'text/plain')
+    spool.put('a.profile', b'v' * 20, 'text/plain')
+    spool.put('b', b'b' * 20, 'text/plain')
+    assert spool.read('a') is not None
+
+    # another node sees the entries at startup
+    other = MediaSpool(tmp_path / 'spool', 100)
+    assert set(other._entries) == {'a', 'a.profile', 'b'} and other._total == spool._total
+
+    # puts and removals do not list the directory
+    monkeypatch.setattr('os.scandir', None)
+    monkeypatch.setattr('os.listdir', None)
+    spool.put('c', b'c' * 20, 'text/plain')
+    # 'a.profile' was used least recently
+    assert spool.read('a.profile') is None and spool.read('a') is not None
+    assert spool._total <= 100
+    other.remove('a')
+    assert spool.read('a') is None and not (tmp_path / 'spool' / 'a').exists()
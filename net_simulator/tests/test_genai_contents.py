@@ -0,0 +1,28 @@
+import base64
+
+from net_simulator.utils import GeminiGenAIService
+
+
+def test_contents_keyed_by_content(monkeypatch):
+    """
+    Equal messages share a conversion whatever their identity, and the cache stays within its
+    byte bound.
+    """
+    service = GeminiGenAIService('gemini-genai')
+    converted = []
+    convert = service._convert_message
+    monkeypatch.setattr(service, '_convert_message', lambda m: converted.append(m) or convert(m))
+
+    def image(data: bytes):
+        url = f"data:image/png;base64,{base64.b64encode(data).decode()}"
+        return {'role': 'user', 'content': [{'type': 'image_url', 'image_url': {'url': url}}]}
+
+    history = [{'role': 'system', 'content': 'be brief'}, image(b'a' * 1000)]
+    service._openai_message_to_genai(history)
+    service._openai_message_to_genai([dict(m) for m in history] + [{'role': 'user', 'content': 'hi'}])
+    assert len(converted) == 3
+
+    monkeypatch.setattr(service, 'CONTENTS_BYTES', 2000)
+    service._openai_message_to_genai([image(bytes([i]) * 1000) for i in range(5)])
+    assert service._contents_bytes <= 2000
+    assert service._contents_bytes == sum(size for size, _ in service._contents.values())
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+import pytest
+from openai.types.chat import ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+from net_simulator import llm_cache, settings, utils
+from net_simulator.settings import Config
+from net_simulator.utils import CachedLLMService, LLMService
+
+
+class _Service(LLMService):
+
+    def __init__(self):
+        self.api_service = 'fake'
+        self.api_key = 'key'
+        self.model = 'fake-model'
+        self.base_url = None
+        self.enable_tools = True
+        self.calls = 0
+
+    async def send_message(self, messages, tools):
+        self.calls += 1
+        message = ChatCompletionMessage(role='assistant', content=f"answer {self.calls}")
+        return [Choice(index=0, finish_reason='stop', message=message)]
+
+
+@pytest.fixture
+def cached(monkeypatch):
+    monkeypatch.setattr(settings, '_settings', Config.model_validate({'llm_cache': {'enabled': True, 'disk': False}}))
+    monkeypatch.setattr(llm_cache, '_cache', None)
+    monkeypatch.setattr(utils, '_llm_services', {})
+    return CachedLLMService(_Service())
+
+
+def test_send_message(cached):
+    messages = [{'role': 'user', 'content': 'hi'}]
+    first = asyncio.run(cached.send_message(messages, []))[0]
+    assert asyncio.run(cached.send_message(messages, []))[0].message.content == first.message.content
+    assert cached.service.calls == 1
+    asyncio.run(cached.send_message([{'role': 'user', 'content': 'bye'}], []))
+    assert cached.service.calls == 2
+
+
+def test_stream_message(cached):
+    async def stream(messages):
+        return [x async for x in cached.stream_message(messages, [])]
+
+    messages = [{'role': 'user', 'content': 'hi'}]
+    first = asyncio.run(stream(messages))
+    assert asyncio.run(stream(messages))[0] == first[0] == 'answer 1'
+    assert cached.service.calls == 1
+
+
+def test_get_llm(cached, monkeypatch):
+    monkeypatch.setattr(utils, 'create_llm', lambda name: cached.service)
+    assert isinstance(utils.get_llm(), CachedLLMService)
+    monkeypatch.setattr(settings, '_settings', Config())
+    assert not isinstance(utils.get_llm(), CachedLLMService)
+
+
+def test_disk_off_loop(tmp_path, monkeypatch):
+    """
+    Disk entries are shared with a new cache, and read and written outside the event loop thread.
+    """
+    threads = []
+    read_disk, write_disk = llm_cache.LLMResponseCache._read_disk, llm_cache.LLMResponseCache._write_disk
+    monkeypatch.setattr(llm_cache.LLMResponseCache, '_read_disk',
+                        lambda self, *args: threads.append(threading.current_thread()) or read_disk(self, *args))
+    monkeypatch.setattr(llm_cache.LLMResponseCache, '_write_disk',
+                        lambda self, *args: threads.append(threading.current_thread()) or write_disk(self, *args))
+    monkeypatch.setattr(settings, '_settings', Config())
+    message = ChatCompletionMessage(role='assistant', content='answer')
+    choice = Choice(index=0, finish_reason='stop', message=message)
+
+    asyncio.run(llm_cache.LLMResponseCache(8, 60, tmp_path).put('key', choice))
+    other = llm_cache.LLMResponseCache(8, 60, tmp_path)
+    assert asyncio.run(other.get('key')).message.content == 'answer'
+    assert other.stats['disk_hits'] == 1
+    assert threads and threading.main_thread() not in threads
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+from openai import AsyncOpenAI
+
+from net_simulator import llm_routing, settings, usage, utils
+from net_simulator.llm_routing import RetryBudget, get_breaker
+from net_simulator.settings import Config
+from net_simulator.utils import RoutedLLMService
+
+COMPLETION = {
+    'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0, 'model': 'test',
+    'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'hello'}}],
+}
+
+
+def _config(**routing) -> Config:
+    services = {
+        name: {'api_key': 'key', 'base_url': f"http://{name}.test/v1", 'model': 'test'}
+        for name in ('primary', 'backup')
+    }
+    return Config.model_validate({
+        'api_services': services, 'api_service': 'primary',
+        'llm_routing': {'fallbacks': ['backup'], 'backoff_base': 0.01, **routing},
+    })
+
+
+@pytest.fixture
+def routing(monkeypatch):
+    """
+    Set the config and return a function making a routed service whose providers answer
+    with the given responses (status code and headers, the last one repeats).
+    """
+    monkeypatch.setattr(usage, '_sink', lambda records: None)
+    monkeypatch.setattr(llm_routing, '_breakers', {})
+    monkeypatch.setattr(llm_routing, '_latencies', {})
+    monkeypatch.setattr(utils, 'retry_budget', RetryBudget())
+    monkeypatch.setattr(utils, '_llm_services', {})
+    calls = {'primary': 0, 'backup': 0}
+
+    def make(responses, **options):
+        monkeypatch.setattr(settings, '_settings', _config(**options))
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            name = request.url.host.split('.')[0]
+            answers = responses[name]
+            status, headers = answers[min(calls[name], len(answers) - 1)]
+            calls[name] += 1
+            if status == 200:
+                return httpx.Response(200, json=COMPLETION)
+            return httpx.Response(status, headers=headers, json={'error': {'message': 'unavailable'}})
+
+        service = RoutedLLMService('primary', ['backup'])
+        for name, llm in service.services:
+            llm.openai_client = AsyncOpenAI(
+                api_key='key', base_url=llm.base_url, max_retries=0,
+                http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        return service
+
+    make.calls = calls
+    return make
+
+
+def _send(service: RoutedLLMService):
+    return asyncio.run(service.send_message([{'role': 'user', 'content': 'hi'}], []))
+
+
+def test_retry_after(routing, monkeypatch):
+    limited = (429, {'Retry-After': '0.05'})
+    service = routing({'primary': [limited, (200, {})], 'backup': [limited]})
+
+    def backoff(*args):
+        raise AssertionError('Retry-After not used')
+
+    monkeypatch.setattr(utils, 'backoff_delay', backoff)
+    start = time.monotonic()
+    assert _send(service)[0].message.content == 'hello'
+    assert time.monotonic() - start >= 0.05
+    assert routing.calls == {'primary': 2, 'backup': 1}
+
+
+def test_failover(routing):
+    service = routing({'primary': [(503, {})], 'backup': [(200, {})]})
+    assert _send(service)[0].message.content == 'hello'
+    assert routing.calls == {'primary': 1, 'backup': 1}
+
+
+def test_retry_budget_exhausted(routing):
+    service = routing({'primary': [(500, {})], 'backup': [(502, {})]}, retry_budget_min=1, retry_budget_ratio=0)
+    with pytest.raises(openai.InternalServerError):
+        _send(service)
+    # the first attempt and a single retry
+    assert routing.calls == {'primary': 1, 'backup': 1}
+
+
+def test_breaker_opens(routing):
+    service = routing({'primary': [(503, {})], 'backup': [(200, {})]}, breaker_failures=2)
+    _send(service)
+    _send(service)
+    assert get_breaker('primary').state == 'open'
+    _send(service)
+    assert routing.calls == {'primary': 2, 'backup': 3}
+
+
+def test_client_retries(monkeypatch):
+    monkeypatch.setattr(utils, '_openai_clients', {})
+    monkeypatch.setattr(settings, '_settings', _config())
+    assert utils.get_openai_client('key', 'http://primary.test/v1').max_retries == 0
+    monkeypatch.setattr(settings, '_settings', _config(enabled=False))
+    assert utils.get_openai_client('key', 'http://primary.test/v1').max_retries == openai.DEFAULT_MAX_RETRIES
+
+
+def test_bad_request_leaves_breaker(routing):
+    service = routing({'primary': [(503, {}), (400, {})], 'backup': [(503, {})]}, breaker_failures=1)
+    with pytest.raises(openai.APIStatusError):
+        _send(service)
+    assert get_breaker('primary').state == 'open'
+
+    # once the reset period has passed, a bad request on the trial keeps the breaker half open
+    get_breaker('primary').opened_at -= 60
+    with pytest.raises(openai.BadRequestError):
+        _send(service)
+    assert get_breaker('primary').state == 'half_open'
+    assert get_breaker('primary').failures == 1
@@ -0,0 +1,56 @@
+import asyncio
+
+from net_simulator import rate_limit, settings
+from net_simulator.rate_limit import RateLimiter, get_rate_limiter
+from net_simulator.settings import Config
+
+
+def test_fifo(tmp_path):
+    """
+    A large request is served before smaller ones that arrived after it.
+    """
+    limiter = RateLimiter('test', None, 6000, tmp_path)
+    done = []
+
+    async def acquire(name: str, tokens: int):
+        await limiter.acquire(tokens)
+        done.append(name)
+
+    async def main():
+        await acquire('drain', 6000)
+        large = asyncio.create_task(acquire('large', 100))
+        await asyncio.sleep(0.01)
+        small = asyncio.create_task(acquire('small', 10))
+        await asyncio.gather(large, small)
+
+    asyncio.run(main())
+    assert done == ['drain', 'large', 'small']
+
+
+def test_cancelled_waiter_leaves(tmp_path):
+    limiter = RateLimiter('test', None, 6000, tmp_path)
+
+    async def main():
+        await limiter.acquire(6000)
+        waiter = asyncio.create_task(limiter.acquire(6000))
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        # the next request does not wait for the cancelled one
+        await asyncio.wait_for(limiter.acquire(10), 1)
+
+    asyncio.run(main())
+
+
+def test_bucket_per_key(tmp_path, monkeypatch):
+    services = {
+        'chat': {'api_key': 'key', 'base_url': 'http://provider.test/v1', 'rpm': 10},
+        'summary': {'api_key': 'key', 'base_url': 'http://provider.test/v1', 'rpm': 10},
+        'other': {'api_key': 'other key', 'base_url': 'http://provider.test/v1', 'rpm': 10},
+    }
+    monkeypatch.setattr(settings, '_settings', Config.model_validate({
+        'api_services': services, 'rate_limits': {'directory': str(tmp_path)}}))
+    monkeypatch.setattr(rate_limit, '_limiters', {})
+    assert get_rate_limiter('chat').path == get_rate_limiter('summary').path
+    assert get_rate_limiter('chat').path != get_rate_limiter('other').path
+    assert 'key' not in get_rate_limiter('chat').path.name
@@ -0,0 +1,85 @@
+import asyncio
+import random
+from uuid import uuid4
+
+import pytest
+from openai.types.chat import ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+from net_simulator import settings, usage, utils
+from net_simulator.llm_cache import current_agent
+from net_simulator.settings import Config
+from net_simulator.utils import LLMService, ReplayLLMService
+
+
+class _Upstream(LLMService):
+    """
+    The orchestrator asks the doctor through a tool call, the doctor answers.
+    """
+
+    def __init__(self):
+        self.api_service = 'upstream'
+        self.api_key = 'key'
+        self.model = 'upstream-model'
+        self.base_url = None
+        self.enable_tools = True
+
+    async def send_message(self, messages, tools):
+        if current_agent.get() == 'doctor':
+            message = ChatCompletionMessage(role='assistant', content='Rest and drink water.')
+            return [Choice(index=0, finish_reason='stop', message=message)]
+        if messages[-1]['role'] == 'tool':
+            answer = messages[-1]['content'].rsplit(': ', 1)[1]
+            message = ChatCompletionMessage(role='assistant', content=f"The doctor says: {answer}")
+            return [Choice(index=0, finish_reason='stop', message=message)]
+        message = ChatCompletionMessage(role='assistant', tool_calls=[{
+            'id': f"call_{uuid4().hex[:12]}", 'type': 'function',
+            'function': {'name': 'agent_send_message', 'arguments': '{"agent": "doctor"}'}}])
+        return [Choice(index=0, finish_reason='tool_calls', message=message)]
+
+
+async def _exchange(llm: LLMService, note: str = '') -> str:
+    """
+    One run of the two agents, with fresh task IDs and timestamps like a real run.
+    """
+    async def doctor(task_id: str) -> str:
+        current_agent.set('doctor')
+        messages = [{'role': 'system', 'content': 'You are a doctor.'},
+                    {'role': 'user', 'content': f"Task {task_id}: I have a cold.{note}"}]
+        return (await llm.send_message(messages, []))[0].message.content
+
+    current_agent.set('orchestrator')
+    messages = [{'role': 'system', 'content': 'You route patients.'}, {'role': 'user', 'content': 'I have a cold.'}]
+    choice = (await llm.send_message(messages, []))[0]
+    task_id = str(uuid4())
+    answer = await asyncio.create_task(doctor(task_id))
+    messages.append(choice.message)
+    messages.append({
+        'role': 'tool', 'tool_call_id': choice.message.tool_calls[0].id,
+        'content': f"Task {task_id} completed at 2026-10-19T10:{random.randint(10, 59)}:00: {answer}"})
+    return (await llm.send_message(messages, []))[0].message.content
+
+
+@pytest.fixture
+def replay(tmp_path, monkeypatch):
+    monkeypatch.setattr(usage, '_sink', lambda records: None)
+    monkeypatch.setattr(utils, '_llm_services', {'upstream': _Upstream()})
+
+    def make(mode: str) -> ReplayLLMService:
+        monkeypatch.setattr(settings, '_settings', Config.model_validate({'api_services': {'replay': {
+            'mode': mode, 'upstream': 'upstream', 'trace': str(tmp_path / 'trace.jsonl'), 'latency': 0}}}))
+        return ReplayLLMService()
+
+    return make
+
+
+def test_replay_two_agents(replay):
+    recorded = asyncio.run(_exchange(replay('record')))
+    assert recorded == 'The doctor says: Rest and drink water.'
+    assert asyncio.run(_exchange(replay('replay'))) == recorded
+
+
+def test_replay_in_agent_order(replay):
+    recorded = asyncio.run(_exchange(replay('record')))
+    # the doctor's request differs from the recording, it gets the doctor's next response
+    assert asyncio.run(_exchange(replay('replay'), note=' Since yesterday.')) == recorded
@@ -0,0 +1,41 @@
+import asyncio
+import json
+import os
+import threading
+
+from net_simulator import settings
+from net_simulator.settings import CONFIG_FILE, get_settings, on_config_change, watch_config
+
+
+def test_reload_runs_callbacks_on_loop():
+    seen = []
+    callback = on_config_change(lambda old, new: seen.append((threading.current_thread(), new.tool_cache.max_entries)))
+    original = CONFIG_FILE.read_text()
+
+    def write(max_entries: int):
+        raw = json.loads(original)
+        raw['tool_cache']['max_entries'] = max_entries
+        CONFIG_FILE.write_text(json.dumps(raw))
+        # mtime granularity may hide a quick rewrite
+        stat = CONFIG_FILE.stat()
+        os.utime(CONFIG_FILE, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+    async def run():
+        watcher = asyncio.create_task(watch_config(0.01))
+        try:
+            write(7)
+            for _ in range(100):
+                if seen:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            watcher.cancel()
+
+    try:
+        asyncio.run(run())
+        assert seen == [(threading.main_thread(), 7)]
+        assert get_settings().tool_cache.max_entries == 7
+    finally:
+        settings._callbacks.remove(callback)
+        CONFIG_FILE.write_text(original)
+        settings.reload_config()
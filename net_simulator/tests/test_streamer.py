@@ -0,0 +1,63 @@
+import asyncio
+
+from a2a.types import Task, TaskState, TaskStatus
+
+from net_simulator.executors.executor_base import ArtifactStreamer
+
+
+class _Queue:
+
+    def __init__(self):
+        self.events = []
+
+    async def enqueue_event(self, event):
+        self.events.append(event)
+
+
+def _streamer() -> ArtifactStreamer:
+    task = Task(id='task-1', contextId='context-1', status=TaskStatus(state=TaskState.working))
+    streamer = ArtifactStreamer(_Queue(), task, 'response')
+    streamer.flush_chars = 1
+    return streamer
+
+
+def _chunks(streamer: ArtifactStreamer):
+    return [(x.artifact.parts[0].root.text, x.append, x.lastChunk) for x in streamer.event_queue.events]
+
+
+def test_tool_call_turns_are_replaced():
+    async def run():
+        streamer = _streamer()
+        await streamer.write('Let me look that up.')
+        await streamer.reset()
+        await streamer.write('The answer')
+        await streamer.write(' is 42.')
+        assert await streamer.close()
+        return streamer
+
+    assert _chunks(asyncio.run(run())) == [
+        ('Let me look that up.', False, False),
+        ('The answer', False, False),
+        (' is 42.', True, False),
+        ('', True, True),
+    ]
+
+
+def test_reset_without_final_text():
+    async def run():
+        streamer = _streamer()
+        await streamer.write('Let me look that up.')
+        await streamer.reset()
+        assert await streamer.close()
+        return streamer
+
+    assert _chunks(asyncio.run(run()))[-1] == ('', False, True)
+
+
+def test_nothing_streamed():
+    async def run():
+        streamer = _streamer()
+        await streamer.reset()
+        return await streamer.close()
+
+    assert not asyncio.run(run())
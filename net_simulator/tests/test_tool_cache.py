@@ -0,0 +1,84 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import fastmcp
+import mcp
+
+from net_simulator import settings
+from net_simulator.settings import Config
+from net_simulator.tool_loop import split_tool_name, tool_call_cache
+from net_simulator.usage import UsageContext, usage_context
+
+SERVER = str(Path(__file__).parent / 'records_server.py')
+CONFIG = {'mcpServers': {
+    'records': {'command': sys.executable, 'args': [SERVER]},
+    'archive': {'command': sys.executable, 'args': [SERVER]},
+}}
+
+
+async def _call(client: fastmcp.Client, name: str, **arguments) -> dict | str:
+    result = tool_call_cache.get(CONFIG, name, arguments)
+    if result is None:
+        result = await client.call_tool_mcp(name, arguments)
+        tool_call_cache.put(CONFIG, name, arguments, result)
+    text = result.content[0].text
+    return json.loads(text) if text.startswith('{') else text
+
+
+def test_split_tool_name():
+    assert split_tool_name(CONFIG, 'records_get_medical_record') == ('records_', 'get_medical_record')
+    assert split_tool_name(CONFIG, 'get_medical_record') == ('', 'get_medical_record')
+    single = {'mcpServers': {'records_x': CONFIG['mcpServers']['records']}}
+    assert split_tool_name(single, 'records_x_get_medical_record') == ('', 'records_x_get_medical_record')
+
+
+def test_cache_through_mcp_config():
+    async def run():
+        usage_context.set(UsageContext(task_id='task-1'))
+        tool_call_cache.clear()
+        async with fastmcp.Client(CONFIG) as client:
+            names = {tool.name for tool in await client.list_tools()}
+            assert 'records_get_medical_record' in names
+
+            first = await _call(client, 'records_get_medical_record', record_id='a')
+            assert await _call(client, 'records_get_medical_record', record_id='a') == first
+            assert tool_call_cache.stats['hits'] >= 1
+
+            # a write on the other server does not drop the results of this one
+            await _call(client, 'archive_add_medical_record', record_id='a')
+            assert await _call(client, 'records_get_medical_record', record_id='a') == first
+
+            await _call(client, 'records_add_medical_record', record_id='a')
+            second = await _call(client, 'records_get_medical_record', record_id='a')
+            assert second['version'] == 1 and second['reads'] == first['reads'] + 1
+
+            # results are per task
+            usage_context.set(UsageContext(task_id='task-2'))
+            assert (await _call(client, 'records_get_medical_record', record_id='a'))['reads'] == second['reads'] + 1
+
+    asyncio.run(run())
+
+
+def test_invalidate_by_shared_arguments(monkeypatch):
+    """
+    A writer drops the results whose key arguments match its arguments of the same name, and all
+    results of the reader if it passes none of them.
+    """
+    monkeypatch.setattr(settings, '_settings', Config.model_validate({'tool_cache': {'tools': {
+        'get_record': {'key_fields': ['record_id'], 'invalidated_by': ['add_record', 'rename_patient']},
+    }}}))
+    usage_context.set(UsageContext(task_id='task-1'))
+    tool_call_cache.clear()
+    url = 'http://records.test/sse'
+    result = mcp.types.CallToolResult(content=[mcp.types.TextContent(type='text', text='record')])
+    for record_id in ('a', 'b'):
+        tool_call_cache.put(url, 'get_record', {'record_id': record_id}, result)
+
+    tool_call_cache.put(url, 'add_record', {'record_id': 'a', 'text': 'new'}, result)
+    assert tool_call_cache.get(url, 'get_record', {'record_id': 'a'}) is None
+    assert tool_call_cache.get(url, 'get_record', {'record_id': 'b'}) is result
+
+    tool_call_cache.put(url, 'rename_patient', {'patient': 'Ada'}, result)
+    assert tool_call_cache.get(url, 'get_record', {'record_id': 'b'}) is None
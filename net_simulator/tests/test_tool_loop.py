@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+import pytest
+from openai.types.chat import ChatCompletionMessageToolCall
+
+from net_simulator.tool_loop import ToolLoop
+
+
+class _Client:
+
+    def __init__(self):
+        self.cancelled = []
+
+    async def call_tool_mcp(self, name: str, arguments: dict, timeout: float):
+        if name == 'fail':
+            raise RuntimeError('tool failed')
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.cancelled.append(name)
+            raise
+
+
+def _tool_call(name: str) -> ChatCompletionMessageToolCall:
+    return ChatCompletionMessageToolCall(id=name, type='function', function={'name': name, 'arguments': '{}'})
+
+
+def test_failed_call_cancels_siblings():
+    client = _Client()
+
+    async def run():
+        loop = ToolLoop(llm=None)
+        calls = [_tool_call('slow'), _tool_call('fail')]
+        with pytest.raises(RuntimeError):
+            await loop._call_tools(client, 'http://tools.test/mcp', 0, calls, time.monotonic() + 60)
+        assert client.cancelled == ['slow']
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import fastmcp
+from fastmcp.client.transports import PythonStdioTransport
+
+from net_simulator.executors.executor_base import GeneralTextExecutor
+from net_simulator.executors.hospital_executors import MedialRecordExecutor
+from net_simulator.settings import CONFIG_ENV, CONFIG_FILE
+from net_simulator.tool_loop import endpoint_key
+
+SERVER = str(Path(__file__).parent / 'records_server.py')
+
+
+def test_same_key_across_tasks():
+    for executor in (GeneralTextExecutor('agent-1'), MedialRecordExecutor('agent-1')):
+        first, second = executor._transport('task-1', 'user-1'), executor._transport('task-2', 'user-1')
+        assert endpoint_key(first) == endpoint_key(second)
+
+
+def test_parent_task_is_passed():
+    transport = MedialRecordExecutor('agent-1')._transport('task-1', None)
+    assert transport['mcpServers']['agent_network']['env']['NET_SIMULATOR_PARENT_TASK'] == 'task-1'
+    assert GeneralTextExecutor('agent-1')._transport('task-1', None).env['NET_SIMULATOR_PARENT_TASK'] == 'task-1'
+
+
+def test_config_is_forwarded():
+    async def environ(transport) -> str:
+        async with fastmcp.Client(transport) as client:
+            return (await client.call_tool('get_environ', {'name': CONFIG_ENV}))[0].text
+
+    expected = str(CONFIG_FILE.resolve())
+    # the records server stands in for the agent service, with the environment it would get
+    transport = GeneralTextExecutor('agent-1')._transport('task-1', None)
+    assert asyncio.run(environ(PythonStdioTransport(SERVER, env=transport.env))) == expected
+
+    config = MedialRecordExecutor('agent-1')._transport('task-1', None)
+    env = config['mcpServers']['agent_network']['env']
+    server = {'command': sys.executable, 'args': [SERVER], 'env': env}
+    assert asyncio.run(environ({'mcpServers': {'agent_network': server}})) == expected
@@ -0,0 +1,455 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Coroutine, Dict, List, Tuple
+
+import fastmcp
+import mcp.types
+from fastmcp.client.messages import MessageHandler
+from fastmcp.client.transports import ClientTransport, MCPConfigTransport
+from openai.types.chat import (ChatCompletionMessage,
+                               ChatCompletionMessageParam,
+                               ChatCompletionMessageToolCall)
+from openai.types.chat.chat_completion import Choice
+
+from net_simulator.llm_cache import current_agent
+from net_simulator.logs import truncate
+from net_simulator.settings import ToolCachePolicy, get_settings, on_config_change
+from net_simulator.tool_results import process_tool_result
+from net_simulator.usage import usage_context
+
+if TYPE_CHECKING:
+    from net_simulator.utils import LLMService
+
+TextCallback = Callable[[str], Awaitable[None]]
+ResetCallback = Callable[[], Awaitable[None]]
+
+
+class ToolLoopLimitError(RuntimeError):
+    """
+    Raised when a tool loop exceeds its iteration limit or deadline.
+    """
+
+
+class ToolLoopAdapter:
+    """
+    Appends the assistant turn and the tool results to the message history.
+    The default follows the OpenAI chat completions format, override it for providers that differ.
+    """
+
+    def append_assistant(self, messages: List[ChatCompletionMessageParam], message: ChatCompletionMessage):
+        messages.append(message.model_dump())
+
+    def append_tool_result(self, messages: List[ChatCompletionMessageParam],
+                           tool_call: ChatCompletionMessageToolCall, result: mcp.types.CallToolResult):
+        if tool_call.id:
+            messages.append({
+                'role': 'tool',
+                'content': result.model_dump_json(),
+                'tool_call_id': tool_call.id
+            })
+        else:
+            messages.append({
+                'role': 'tool',
+                'content': result.model_dump_json(),
+            })
+
+
+class ToolLoopHooks:
+    """
+    Callbacks around each step of a tool loop, e.g. for metrics or tracing.
+    Register instances with `register_tool_loop_hooks`. Hooks must not raise.
+    """
+
+    def before_llm(self, loop: 'ToolLoop', iteration: int, messages: List[ChatCompletionMessageParam]):
+        pass
+
+    def after_llm(self, loop: 'ToolLoop', iteration: int, choice: Choice | None, elapsed: float,
+                  error: BaseException | None):
+        pass
+
+    def before_tool(self, loop: 'ToolLoop', iteration: int, tool_call: ChatCompletionMessageToolCall):
+        pass
+
+    def after_tool(self, loop: 'ToolLoop', iteration: int, tool_call: ChatCompletionMessageToolCall,
+                   result: mcp.types.CallToolResult | None, elapsed: float, error: BaseException | None):
+        pass
+
+
+class LoggingHooks(ToolLoopHooks):
+
+    def before_tool(self, loop: 'ToolLoop', iteration: int, tool_call: ChatCompletionMessageToolCall):
+        log_tool_call(tool_call.function.name, tool_call.function.arguments, tool_call.id)
+
+    def after_llm(self, loop: 'ToolLoop', iteration: int, choice: Choice | None, elapsed: float,
+                  error: BaseException | None):
+        loop.logger.debug(
+            f"LLM step {iteration} took {elapsed:.2f}s",
+            extra={'category': 'tool_loop', 'model': loop.llm.model, 'elapsed': elapsed})
+
+    def after_tool(self, loop: 'ToolLoop', iteration: int, tool_call: ChatCompletionMessageToolCall,
+                   result: mcp.types.CallToolResult | None, elapsed: float, error: BaseException | None):
+        loop.logger.debug(
+            f"Tool {tool_call.function.name}(id={tool_call.id}) took {elapsed:.2f}s",
+            extra={'category': 'tool_loop', 'tool': tool_call.function.name, 'elapsed': elapsed})
+
+
+tool_loop_hooks: List[ToolLoopHooks] = [LoggingHooks()]
+
+
+def register_tool_loop_hooks(hooks: ToolLoopHooks):
+    tool_loop_hooks.append(hooks)
+
+
+def log_tool_call(tool_name: str, tool_args: str, call_id: str | None):
+    max_length = get_settings().logging.max_field_length
+    logging.getLogger('uvicorn').info(
+        f"Tool Call: {tool_name}(id={call_id}) args={truncate(tool_args, max_length)}",
+        extra={'category': 'tool_call', 'tool': tool_name, 'call_id': call_id}
+    )
+
+
+def endpoint_key(mcp_url: Any) -> str:
+    """
+    Identify an MCP endpoint: URLs and configs by value, transports by their command line,
+    in-process servers by identity. The environment of the servers is left out, it carries
+    per task values such as the parent task.
+    """
+    if isinstance(mcp_url, dict) and 'mcpServers' in mcp_url:
+        servers = {
+            name: {k: v for k, v in server.items() if k != 'env'} if isinstance(server, dict) else server
+            for name, server in mcp_url['mcpServers'].items()
+        }
+        mcp_url = {**mcp_url, 'mcpServers': servers}
+    if isinstance(mcp_url, (str, dict)):
+        return json.dumps(mcp_url, sort_keys=True, default=str)
+    if isinstance(mcp_url, ClientTransport):
+        return repr(mcp_url)
+    return f"{type(mcp_url).__name__}@{id(mcp_url)}"
+
+
+def split_tool_name(mcp_url: Any, name: str) -> Tuple[str, str]:
+    """
+    Split the server prefix off a tool name: configs of several servers expose their tools as
+    `{server}_{tool}`. Returns the prefix ('' if none) and the tool name.
+    """
+    if isinstance(mcp_url, MCPConfigTransport):
+        servers = list(mcp_url.config.mcpServers)
+    elif isinstance(mcp_url, dict):
+        servers = list(mcp_url.get('mcpServers', {}))
+    else:
+        return '', name
+
+    if len(servers) > 1:
+        for server in sorted(servers, key=len, reverse=True):
+            if name.startswith(f"{server}_"):
+                return f"{server}_", name[len(server) + 1:]
+    return '', name
+
+
+class ToolListCache:
+    """
+    Tool listings per MCP endpoint. Entries expire after `llm.tool_list_ttl` seconds, or
+    immediately when the server sends a tool list changed notification.
+    The cached lists are shared, do not modify them.
+    """
+
+    _entries: Dict[str, Tuple[float, List[mcp.types.Tool]]]
+
+    def __init__(self):
+        self._entries = {}
+
+    async def get(self, client: fastmcp.Client, mcp_url: Any) -> List[mcp.types.Tool]:
+        key = endpoint_key(mcp_url)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        tools = await client.list_tools()
+        self._entries[key] = (time.monotonic() + get_settings().llm.tool_list_ttl, tools)
+        return tools
+
+    def invalidate(self, mcp_url: Any | None = None):
+        if mcp_url is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(endpoint_key(mcp_url), None)
+
+
+tool_list_cache = ToolListCache()
+
+
+class ToolCallCache:
+    """
+    Results of idempotent tool calls, following the `tool_cache.tools` policies. Results are
+    shared within a task, an agent or this process by the policy's scope, keyed by the endpoint
+    and the policy's key arguments. A call of a tool in `invalidated_by` drops the cached results
+    whose key arguments it matches, e.g. `add_medical_record` drops `get_medical_record` of that ID.
+    Only the key arguments the writer also passes are compared: a writer sharing none of them
+    (e.g. one taking a patient name for results keyed by record ID) drops all results of the reader.
+    Policies name the tools without the server prefix of multi-server configs, and a writer only
+    invalidates the readers of its own server. Failed calls are not cached.
+    Invalidation is local to this process: calls made by other processes are not seen.
+    """
+
+    _entries: OrderedDict[str, Tuple[str, float, dict, mcp.types.CallToolResult]]
+    stats: Dict[str, int]
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @staticmethod
+    def _key(mcp_url: Any, name: str, arguments: dict, policy: ToolCachePolicy) -> Tuple[str | None, dict]:
+        if policy.scope == 'task':
+            scope = usage_context.get().task_id
+            if scope is None:
+                return None, {}
+        elif policy.scope == 'agent':
+            scope = current_agent.get() or ''
+        else:
+            scope = ''
+
+        fields = policy.key_fields if policy.key_fields is not None else sorted(arguments)
+        key_args = {k: arguments.get(k) for k in fields}
+        key = json.dumps([endpoint_key(mcp_url), scope, name, key_args], sort_keys=True, default=str)
+        return key, key_args
+
+    def get(self, mcp_url: Any, name: str, arguments: dict) -> mcp.types.CallToolResult | None:
+        options = get_settings().tool_cache
+        policy = options.tools.get(split_tool_name(mcp_url, name)[1])
+        if not options.enabled or policy is None:
+            return None
+
+        key, _ = self._key(mcp_url, name, arguments, policy)
+        entry = self._entries.get(key) if key is not None else None
+        if entry is None or entry[1] <= time.monotonic():
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self._entries.move_to_end(key)
+        return entry[3]
+
+    def put(self, mcp_url: Any, name: str, arguments: dict, result: mcp.types.CallToolResult):
+        options = get_settings().tool_cache
+        if not options.enabled:
+            return
+        self.invalidate(mcp_url, name, arguments)
+
+        policy = options.tools.get(split_tool_name(mcp_url, name)[1])
+        if policy is None or result.isError:
+            return
+        key, key_args = self._key(mcp_url, name, arguments, policy)
+        if key is None:
+            return
+        self._entries[key] = (name, time.monotonic() + policy.ttl, key_args, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > options.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, mcp_url: Any, writer: str, arguments: dict):
+        """
+        Drop the results invalidated by a call of `writer` with `arguments`: those whose key
+        arguments equal the writer's arguments of the same name, all of them if none are named alike.
+        """
+        prefix, writer = split_tool_name(mcp_url, writer)
+        readers = {prefix + k for k, v in get_settings().tool_cache.tools.items() if writer in v.invalidated_by}
+        if not readers:
+            return
+        stale = [
+            key for key, (name, _, key_args, _) in self._entries.items()
+            if name in readers and all(arguments[k] == v for k, v in key_args.items() if k in arguments)
+        ]
+        for key in stale:
+            del self._entries[key]
+        self.stats['invalidations'] += len(stale)
+
+    def clear(self):
+        self._entries.clear()
+
+
+tool_call_cache = ToolCallCache()
+
+
+def log_tool_cache_stats():
+    stats = tool_call_cache.stats
+    if stats['hits'] or stats['misses']:
+        logging.getLogger('uvicorn').info(
+            f"Tool cache: {stats}", extra={'category': 'tool_cache', **stats})
+
+
+@on_config_change
+def _reset_tool_call_cache(old, new):
+    if old.tool_cache != new.tool_cache:
+        tool_call_cache.clear()
+
+
+class ToolListChangedHandler(MessageHandler):
+    """
+    Drops the cached tool listing of an endpoint when its tools change.
+    """
+
+    def __init__(self, mcp_url: Any):
+        self.mcp_url = mcp_url
+
+    async def on_tool_list_changed(self, message: mcp.types.ToolListChangedNotification) -> None:
+        tool_list_cache.invalidate(self.mcp_url)
+
+
+class ToolLoop:
+    """
+    The model <-> MCP tool loop behind `LLMService.send_message_mcp`.
+
+    Each iteration sends the history to the model. If the model requests tools, all calls of
+    the turn run concurrently and their results are appended in call order. The loop ends when
+    the model answers without tool calls, or fails with `ToolLoopLimitError` after
+    `llm.max_iterations` iterations or when `llm.turn_timeout` / `llm.deadline` is exceeded.
+    """
+
+    llm: 'LLMService'
+    adapter: ToolLoopAdapter
+    max_iterations: int
+    turn_timeout: float
+    deadline: float
+    tool_concurrency: int
+    logger: logging.Logger
+
+    def __init__(self, llm: 'LLMService', adapter: ToolLoopAdapter | None = None):
+        options = get_settings().llm
+        self.llm = llm
+        self.adapter = adapter or ToolLoopAdapter()
+        self.max_iterations = options.max_iterations
+        self.turn_timeout = options.turn_timeout
+        self.deadline = options.deadline
+        self.tool_concurrency = options.tool_concurrency
+        self.logger = logging.getLogger('uvicorn')
+
+    def _hook(self, name: str, *args):
+        for hooks in tool_loop_hooks:
+            try:
+                getattr(hooks, name)(self, *args)
+            except Exception:
+                self.logger.exception(f"Tool loop hook {name} failed.")
+
+    @staticmethod
+    def _remaining(deadline: float, step: str) -> float:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ToolLoopLimitError(f"Deadline exceeded before {step}.")
+        return remaining
+
+    async def _stream_llm(self, messages: List[ChatCompletionMessageParam], tools: Any,
+                          on_text: TextCallback) -> List[Choice]:
+        async for item in self.llm.stream_message(messages=messages, tools=tools):
+            if isinstance(item, Choice):
+                return [item]
+            await on_text(item)
+        return []
+
+    async def _throttled(self, messages: List[ChatCompletionMessageParam], request: Coroutine[Any, Any, List[Choice]]) \
+            -> List[Choice]:
+        try:
+            await self.llm.throttle(messages)
+        except BaseException:
+            request.close()
+            raise
+        return await request
+
+    async def _call_llm(self, iteration: int, messages: List[ChatCompletionMessageParam], tools: Any,
+                        deadline: float, on_text: TextCallback | None) -> Choice:
+        self._hook('before_llm', iteration, messages)
+        start = time.monotonic()
+        choice, error = None, None
+        try:
+            if on_text is None:
+                request = self.llm.send_message(messages=messages, tools=tools)
+            else:
+                request = self._stream_llm(messages, tools, on_text)
+            choices = await asyncio.wait_for(
+                self._throttled(messages, request), timeout=self._remaining(deadline, 'the LLM call'))
+            if not choices:
+                raise ValueError("No choices returned from the model.")
+            choice = choices[0]
+            return choice
+        except asyncio.TimeoutError as e:
+            error = ToolLoopLimitError(f"LLM call {iteration} exceeded the deadline.")
+            raise error from e
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._hook('after_llm', iteration, choice, time.monotonic() - start, error)
+
+    async def _call_tools(self, client: fastmcp.Client, mcp_url: Any, iteration: int,
+                          tool_calls: List[ChatCompletionMessageToolCall], deadline: float) \
+            -> List[mcp.types.CallToolResult]:
+        semaphore = asyncio.Semaphore(self.tool_concurrency)
+
+        async def _call(tool_call: ChatCompletionMessageToolCall) -> mcp.types.CallToolResult:
+            self._hook('before_tool', iteration, tool_call)
+            result, error = None, None
+            name = tool_call.function.name
+            async with semaphore:
+                start = time.monotonic()
+                try:
+                    arguments = json.loads(tool_call.function.arguments)
+                    result = tool_call_cache.get(mcp_url, name, arguments)
+                    if result is None:
+                        result = await client.call_tool_mcp(
+                            name=name,
+                            arguments=arguments,
+                            timeout=self._remaining(deadline, f"tool {name}")
+                        )
+                        tool_call_cache.put(mcp_url, name, arguments, result)
+                    return result
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    self._hook('after_tool', iteration, tool_call, result, time.monotonic() - start, error)
+
+        tasks = [asyncio.ensure_future(_call(x)) for x in tool_calls]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            # a failed call fails the turn, do not leave the other calls running
+            pending = [x for x in tasks if not x.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def run(self, messages: List[ChatCompletionMessageParam], mcp_url: Any,
+                  on_text: TextCallback | None = None, on_reset: ResetCallback | None = None) \
+            -> Tuple[List[ChatCompletionMessageParam], Choice]:
+        """
+        Run the loop until the model answers. With `on_text`, the text deltas of each model
+        turn are passed to `on_text` as they arrive, but only the final turn is the answer:
+        when a turn ends in tool calls, `on_reset` is called before the tools run and the
+        text passed for that turn is discarded (the `ArtifactStreamer` replaces it with the
+        next turn).
+        """
+        loop_deadline = time.monotonic() + self.deadline
+
+        async with fastmcp.Client(transport=mcp_url, timeout=self.deadline,
+                                  message_handler=ToolListChangedHandler(mcp_url)) as client:
+            tools = await self.llm.list_loop_tools(client, mcp_url)
+            for iteration in range(self.max_iterations):
+                turn_deadline = min(loop_deadline, time.monotonic() + self.turn_timeout)
+
+                choice = await self._call_llm(iteration, messages, tools, turn_deadline, on_text)
+                if choice.finish_reason != 'tool_calls' or not choice.message.tool_calls:
+                    return messages, choice
+
+                if on_reset is not None:
+                    await on_reset()
+                tool_calls = choice.message.tool_calls
+                results = await self._call_tools(client, mcp_url, iteration, tool_calls, turn_deadline)
+
+                self.adapter.append_assistant(messages, choice.message)
+                for tool_call, result in zip(tool_calls, results):
+                    self.adapter.append_tool_result(messages, tool_call, process_tool_result(tool_call, result))
+
+        raise ToolLoopLimitError(
+            f"The model did not finish within {self.max_iterations} iterations.")
@@ -0,0 +1,110 @@
+import json
+import logging
+import re
+from pathlib import Path
+from typing import Any
+from uuid import uuid4
+
+import mcp.types
+from openai.types.chat import ChatCompletionMessageToolCall
+
+from net_simulator.settings import CWD, ToolResultsConfig, get_settings
+
+# name of the agent_service tool reading offloaded results
+READ_TOOL = 'tool_result_read'
+
+_RESULT_ID = re.compile(r'[0-9a-f]{32}')
+
+
+def _directory() -> Path:
+    directory = get_settings().tool_results.directory
+    return Path(directory) if directory else CWD / 'data' / 'tool_results'
+
+
+def store_tool_result(text: str) -> str:
+    """
+    Keep the full text of a tool result and return its ID.
+    """
+    result_id = uuid4().hex
+    directory = _directory()
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / f"{result_id}.txt").write_text(text, encoding='utf-8')
+    return result_id
+
+
+def read_tool_result(result_id: str, offset: int = 0, length: int | None = None) -> str | None:
+    """
+    Read `length` characters from `offset` of a stored tool result, None if there is no such result.
+    """
+    if not _RESULT_ID.fullmatch(result_id):
+        return None
+    path = _directory() / f"{result_id}.txt"
+    if not path.exists():
+        return None
+    text = path.read_text(encoding='utf-8')
+    return text[offset:] if length is None else text[offset:offset + length]
+
+
+def _prune(value: Any, options: ToolResultsConfig) -> Any:
+    if isinstance(value, dict):
+        return {
+            k: _prune(v, options) for k, v in value.items()
+            if k not in options.drop_keys and not (options.drop_nulls and v is None)
+        }
+    if isinstance(value, list):
+        return [_prune(x, options) for x in value]
+    return value
+
+
+def _truncate(text: str, options: ToolResultsConfig) -> str:
+    if len(text) <= options.max_chars:
+        return text
+
+    # keep the start and the end, the end of a task holds its status and last artifacts
+    head = options.max_chars * 2 // 3
+    tail = options.max_chars - head
+    omitted = len(text) - head - tail
+    if options.offload:
+        result_id = store_tool_result(text)
+        marker = f"\n[... {omitted} of {len(text)} characters omitted. The full result is stored, " \
+                 f"read it with the `{READ_TOOL}` tool and result_id {result_id} ...]\n"
+    else:
+        marker = f"\n[... {omitted} of {len(text)} characters omitted ...]\n"
+    return text[:head] + marker + text[len(text) - tail:]
+
+
+def _process_text(text: str, options: ToolResultsConfig) -> str:
+    try:
+        value = json.loads(text)
+    except ValueError:
+        pass
+    else:
+        text = json.dumps(_prune(value, options), ensure_ascii=False, separators=(',', ':'))
+    return _truncate(text, options)
+
+
+def process_tool_result(tool_call: ChatCompletionMessageToolCall,
+                        result: mcp.types.CallToolResult) -> mcp.types.CallToolResult:
+    """
+    Shrink a tool result before it is added to the history and re-sent on every following turn:
+    drop `tool_results.drop_keys` and nulls from JSON, compact it and cap it at `tool_results.max_chars`.
+    """
+    options = get_settings().tool_results
+    if not options.enabled:
+        return result
+
+    content = []
+    before, after = 0, 0
+    for item in result.content:
+        if isinstance(item, mcp.types.TextContent):
+            text = _process_text(item.text, options)
+            before += len(item.text)
+            after += len(text)
+            item = item.model_copy(update={'text': text})
+        content.append(item)
+
+    if after < before:
+        logging.getLogger('uvicorn').debug(
+            f"Tool result of {tool_call.function.name}: {before} -> {after} characters",
+            extra={'category': 'tool_loop', 'tool': tool_call.function.name, 'before': before, 'after': after})
+    return result.model_copy(update={'content': content})
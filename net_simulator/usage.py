@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Callable, Deque, Dict, List
+
+import httpx
+from pydantic import BaseModel
+
+from net_simulator.msgs import UsageRecord, UsageSummary, UsageTotals
+from net_simulator.settings import get_settings
+
+RATE_WINDOW = 60.0
+MAX_TASKS = 10000
+FLUSH_INTERVAL = 2.0
+
+
+class UsageContext(BaseModel):
+    """
+    Who an LLM call is made for. Set by the executors and `/user/chat`, read by `record_usage`.
+    """
+
+    task_id: str | None = None
+    agent_id: str | None = None
+    user_id: str | None = None
+
+
+usage_context: ContextVar[UsageContext] = ContextVar('usage_context', default=UsageContext())
+
+UsageSink = Callable[[List[UsageRecord]], None]
+
+_sink: UsageSink | None = None
+_buffer: List[UsageRecord] = []
+_flusher: asyncio.Task | None = None
+
+
+def set_usage_sink(sink: UsageSink):
+    """
+    Handle the records of this process with `sink` instead of reporting them to the system server.
+    """
+    global _sink
+    _sink = sink
+
+
+async def _post(records: List[UsageRecord]):
+    try:
+        async with httpx.AsyncClient(timeout=10) as client:
+            await client.post(
+                f"http://localhost:{get_settings().system.port}/usage/report",
+                json={'records': [x.model_dump() for x in records]}
+            )
+    except httpx.HTTPError as e:
+        logging.getLogger('uvicorn').warning(f"Failed to report {len(records)} usage records: {e}")
+
+
+async def flush_usage():
+    """
+    Report the buffered records now, e.g. before shutdown.
+    """
+    global _buffer
+    records, _buffer = _buffer, []
+    if records:
+        await _post(records)
+
+
+async def _flush_loop():
+    global _flusher
+    try:
+        while _buffer:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await flush_usage()
+    finally:
+        _flusher = None
+
+
+def record_usage(record: UsageRecord):
+    """
+    Record the usage of an LLM call. Records are batched and reported to the system server.
+    """
+    global _flusher
+
+    context = usage_context.get()
+    record.task_id = record.task_id or context.task_id
+    record.agent_id = record.agent_id or context.agent_id
+    record.user_id = record.user_id or context.user_id
+
+    if _sink is not None:
+        _sink([record])
+        return
+
+    _buffer.append(record)
+    if _flusher is None:
+        _flusher = asyncio.get_running_loop().create_task(_flush_loop())
+
+
+class _Totals:
+
+    def __init__(self):
+        self.totals = UsageTotals()
+        self.recent: Deque[UsageRecord] = deque()
+
+    def add(self, record: UsageRecord):
+        totals = self.totals
+        totals.calls += 1
+        totals.prompt_tokens += record.prompt_tokens
+        totals.completion_tokens += record.completion_tokens
+        totals.cached_tokens += record.cached_tokens
+        totals.latency += record.latency
+        totals.cost += record.cost
+        now = time.time()
+        if record.timestamp >= now - RATE_WINDOW:
+            self.recent.append(record)
+        self._prune(now)
+
+    def _prune(self, now: float):
+        while self.recent and self.recent[0].timestamp < now - RATE_WINDOW:
+            self.recent.popleft()
+
+    def summary(self, now: float, name: str | None = None) -> UsageTotals:
+        self._prune(now)
+        scale = 60.0 / RATE_WINDOW
+        return self.totals.model_copy(update={
+            'name': name,
+            'calls_per_minute': len(self.recent) * scale,
+            'tokens_per_minute': sum(x.prompt_tokens + x.completion_tokens for x in self.recent) * scale,
+            'cost_per_minute': sum(x.cost for x in self.recent) * scale,
+        })
+
+
+class UsageAggregator:
+    """
+    Usage totals per agent, user and task, kept by the system server.
+    Only the last `MAX_TASKS` tasks are kept.
+    """
+
+    agents: Dict[str, _Totals]
+    users: Dict[str, _Totals]
+    tasks: OrderedDict[str, _Totals]
+
+    def __init__(self):
+        self.agents = {}
+        self.users = {}
+        self.tasks = OrderedDict()
+
+    def add(self, records: List[UsageRecord]):
+        for record in records:
+            if record.agent_id:
+                self.agents.setdefault(record.agent_id, _Totals()).add(record)
+            if record.user_id:
+                self.users.setdefault(record.user_id, _Totals()).add(record)
+            if record.task_id:
+                self.tasks.setdefault(record.task_id, _Totals()).add(record)
+                self.tasks.move_to_end(record.task_id)
+                if len(self.tasks) > MAX_TASKS:
+                    self.tasks.popitem(last=False)
+
+    def summary(self, names: Dict[str, str] | None = None) -> UsageSummary:
+        names = names or {}
+        now = time.time()
+        return UsageSummary(
+            agents={k: v.summary(now, names.get(k)) for k, v in self.agents.items()},
+            users={k: v.summary(now, names.get(k)) for k, v in self.users.items()},
+        )
+
+    def task(self, task_id: str) -> UsageTotals | None:
+        totals = self.tasks.get(task_id)
+        return totals.summary(time.time()) if totals else None
@@ -1,8 +1,15 @@
+import asyncio
+import base64
+import hashlib
+import importlib.util
 import json
 from abc import ABC, abstractproperty, abstractmethod
 import logging
+import re
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Iterable, List, Tuple, Union
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Tuple, TypeVar, Union
 from weakref import proxy
 
 import fastmcp
@@ -10,48 +17,59 @@ from httpx import get
 import httpx
 import mcp.types
 from numpy import isin
-from openai import AsyncOpenAI, NOT_GIVEN
+from openai import DEFAULT_MAX_RETRIES, AsyncOpenAI, NOT_GIVEN
 from openai.types.chat import ChatCompletionMessageParam, ChatCompletionContentPartParam, ChatCompletionContentPartTextParam, ChatCompletionContentPartInputAudioParam, ChatCompletionContentPartImageParam, ChatCompletionMessage, ChatCompletionMessageToolCall
 from openai.types.chat.chat_completion import Choice
+from openai.types.completion_usage import CompletionUsage
 from uuid import uuid4
 
 from google import genai
+from google.genai import _api_client as genai_api_client
+from google.genai import _mcp_utils as genai_mcp_utils
 from google.genai import types
 
-cwd = Path(__file__).parent
-configs = json.load(open(cwd / 'config' / 'config.json', 'r'))
-
+from net_simulator.file_store import get_file_store
+from net_simulator.llm_cache import cache_key, current_agent, get_llm_cache
+from net_simulator.llm_routing import (backoff_delay, get_breaker, get_latencies, hedge_stats, is_retryable,
+                                      retry_after, retry_budget)
+from net_simulator.msgs import UsageRecord
+from net_simulator.rate_limit import estimate_tokens, get_rate_limiter
+from net_simulator.settings import CONFIG_ENV, CONFIG_FILE, ApiServiceConfig, Config, get_config, get_settings, on_config_change, save_config
+from net_simulator.tool_loop import ResetCallback, TextCallback, ToolLoop, ToolLoopAdapter, tool_list_cache
+from net_simulator.usage import record_usage, usage_context
 
-def get_config(key: str, default=None):
-    # key can be nested, e.g., 'database.host'
-    keys = key.split('.') if '.' in key else [key]
-
-    obj = configs
-    for k in keys:
-        if k in obj:
-            obj = obj[k]
-        else:
-            return default
+cwd = Path(__file__).parent
+AGENT_SERVICE_SCRIPT = cwd / 'mcp' / 'agent_service.py'
+# task (or user conversation) an agent_service process sends its messages for
+PARENT_TASK_ENV = 'NET_SIMULATOR_PARENT_TASK'
 
-    return obj
 
+def agent_service_env(parent_task_id: str) -> Dict[str, str]:
+    """
+    Environment of an agent_service process: the task it works for, and the config file of
+    this process, which it would not find if this one was started with another config.
+    """
+    return {PARENT_TASK_ENV: parent_task_id, CONFIG_ENV: str(CONFIG_FILE.resolve())}
 
-def save_config(key: str, value):
-    global configs
+T = TypeVar('T')
 
-    keys = key.split('.') if '.' in key else [key]
-    for k in keys[:-1]:
-        if k not in configs:
-            configs[k] = {}
-        configs = configs[k]
 
-    configs[keys[-1]] = value
-    with open(cwd / 'config' / 'config.json', 'w') as f:
-        json.dump(configs, f, indent=2)
+# converted tool lists, keyed by the id of the (cached, shared) tool list
+_tool_dicts: Dict[int, Tuple[List[mcp.types.Tool], List[dict]]] = {}
+_genai_tools: Dict[int, Tuple[List[mcp.types.Tool], List[types.Tool]]] = {}
+_TOOL_DICTS_SIZE = 64
 
 
 def tool_dict(tools: List[mcp.types.Tool]) -> List[dict]:
-    return [
+    """
+    Convert MCP tools to OpenAI function tools. The result for a tool list object is memoized.
+    """
+    entry = _tool_dicts.get(id(tools))
+    # the entry keeps the list alive, so its id cannot be reused while cached
+    if entry is not None and entry[0] is tools:
+        return entry[1]
+
+    result = [
         {
             'type': "function",
             'function': {
@@ -62,98 +80,282 @@ def tool_dict(tools: List[mcp.types.Tool]) -> List[dict]:
         }
         for x in tools
     ]
+    if len(_tool_dicts) >= _TOOL_DICTS_SIZE:
+        _tool_dicts.pop(next(iter(_tool_dicts)))
+    _tool_dicts[id(tools)] = (tools, result)
+    return result
+
+
+def genai_tools(tools: List[mcp.types.Tool]) -> List[types.Tool]:
+    """
+    Convert MCP tools to Gemini function declarations. The result for a tool list object is memoized.
+    """
+    entry = _genai_tools.get(id(tools))
+    if entry is not None and entry[0] is tools:
+        return entry[1]
+
+    result = genai_mcp_utils.mcp_to_gemini_tools(tools)
+    if len(_genai_tools) >= _TOOL_DICTS_SIZE:
+        _genai_tools.pop(next(iter(_genai_tools)))
+    _genai_tools[id(tools)] = (tools, result)
+    return result
+
+
+async def stream_chat_completion(service: 'LLMService', **kwargs) -> AsyncIterator[str | Choice]:
+    """
+    Stream a chat completion of `service`. Yields text deltas as they arrive, then the assembled Choice.
+    Tool call deltas are accumulated by their index into complete tool calls.
+    """
+    start = time.monotonic()
+    stream = await service.openai_client.chat.completions.create(
+        stream=True, stream_options={'include_usage': True}, **kwargs)
+
+    text = []
+    tool_calls: Dict[int, dict] = {}
+    finish_reason = None
+    usage = None
+    async for chunk in stream:
+        # the usage comes with the last chunk, which has no choices
+        usage = chunk.usage or usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            text.append(delta.content)
+            yield delta.content
+        for tool_call in delta.tool_calls or []:
+            call = tool_calls.setdefault(tool_call.index, {'id': '', 'name': '', 'arguments': ''})
+            call['id'] = tool_call.id or call['id']
+            if tool_call.function:
+                call['name'] += tool_call.function.name or ''
+                call['arguments'] += tool_call.function.arguments or ''
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+
+    service.record_openai_usage(start, usage)
+    if tool_calls:
+        finish_reason = 'tool_calls'
+    yield Choice(
+        finish_reason=finish_reason or 'stop',
+        index=0,
+        message=ChatCompletionMessage(
+            role='assistant',
+            content=''.join(text) if text or not tool_calls else None,
+            tool_calls=[
+                ChatCompletionMessageToolCall(
+                    id=x['id'],
+                    function={'name': x['name'], 'arguments': x['arguments']},
+                    type='function'
+                )
+                for _, x in sorted(tool_calls.items())
+            ] or None
+        )
+    )
+
+
+# ================================================================================
+# Provider clients, shared by all LLM services of the process
+# ================================================================================
+
+_openai_clients: Dict[Tuple[str, str | None, str | None, int], AsyncOpenAI] = {}
+_genai_clients: Dict[Tuple[str, str | None, str | None], genai.Client] = {}
+
+
+def _http_client_args() -> dict:
+    options = get_settings().http_client
+    return {
+        'limits': httpx.Limits(
+            max_connections=options.max_connections,
+            max_keepalive_connections=options.max_keepalive_connections,
+            keepalive_expiry=options.keepalive_expiry
+        ),
+        # HTTP/2 needs the optional `h2` package
+        'http2': options.http2 and importlib.util.find_spec('h2') is not None,
+        'timeout': httpx.Timeout(options.timeout, connect=options.connect_timeout),
+    }
+
+
+def get_openai_client(api_key: str, base_url: str | None) -> AsyncOpenAI:
+    """
+    Get the process-wide AsyncOpenAI client for a provider endpoint.
+    Its connection pool is kept alive and shared by every task of this process.
+    """
+    settings = get_settings()
+    proxy_url = settings.proxy.url
+    max_retries = settings.http_client.max_retries
+    if max_retries is None:
+        # `llm_routing` retries within its budget, the SDK's own retries would multiply them
+        max_retries = 0 if settings.llm_routing.enabled else DEFAULT_MAX_RETRIES
+    key = (api_key, base_url, proxy_url, max_retries)
+    if key not in _openai_clients:
+        args = _http_client_args()
+        if proxy_url:
+            http_client = httpx.AsyncClient(
+                mounts={'all://': httpx.AsyncHTTPTransport(
+                    proxy=proxy_url,
+                    local_address='0.0.0.0',
+                    verify=False,
+                    limits=args['limits'],
+                    http2=args['http2']
+                )},
+                timeout=args['timeout']
+            )
+        else:
+            http_client = httpx.AsyncClient(**args)
+        _openai_clients[key] = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=max_retries
+        )
+    return _openai_clients[key]
+
+
+def get_genai_client(api_key: str, base_url: str | None) -> genai.Client:
+    """
+    Get the process-wide genai client for a provider endpoint.
+    """
+    proxy_url = get_settings().proxy.url
+    key = (api_key, base_url, proxy_url)
+    if key not in _genai_clients:
+        args = _http_client_args()
+        # the timeout of genai is set per request in milliseconds
+        args.pop('timeout')
+        if proxy_url:
+            args['proxy'] = proxy_url
+        # with aiohttp installed, genai opens a new session (and connection) for every
+        # request. Its httpx fallback keeps one pooled client, so always use that one.
+        # The switch is private (see the google-genai pin in pyproject.toml)
+        if hasattr(genai_api_client, 'has_aiohttp'):
+            genai_api_client.has_aiohttp = False
+        else:
+            logging.getLogger('uvicorn').warning(
+                "google-genai has no has_aiohttp switch, its requests may not share connections.")
+        _genai_clients[key] = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(
+                base_url=base_url,
+                timeout=int(get_settings().http_client.timeout * 1000),
+                async_client_args=args
+            )
+        )
+    return _genai_clients[key]
+
+
+async def close_llm_clients():
+    """
+    Close the connection pools of all provider clients. Call it on shutdown.
+    """
+    for client in list(_openai_clients.values()):
+        await client.close()
+    for client in list(_genai_clients.values()):
+        # genai has no public close, its httpx client is private
+        http_client = getattr(getattr(client, '_api_client', None), '_async_httpx_client', None)
+        if http_client is not None:
+            await http_client.aclose()
+        else:
+            logging.getLogger('uvicorn').warning("Cannot close the connections of the google-genai client.")
+    _openai_clients.clear()
+    _genai_clients.clear()
+    _llm_services.clear()
 
 
 class LLMService(ABC):
     DEFAULT_API_SERVICE: str = 'openai'
+    api_service: str
     openai_client: AsyncOpenAI
     model: str
     api_key: str
     base_url: str
     enable_tools: bool
+    tool_loop_adapter: ToolLoopAdapter = ToolLoopAdapter()
 
     def __init__(self, api_service: str = DEFAULT_API_SERVICE):
-        self.api_key = get_config(f"api_services.{api_service}.api_key")
-        self.model = get_config(f"api_services.{api_service}.model")
-        self.base_url = get_config(f"api_services.{api_service}.base_url")
-        self.enable_tools = get_config(
-            f"api_services.{api_service}.tools", True)
+        service = get_settings().api_services.get(api_service, ApiServiceConfig())
+        self.api_service = api_service
+        self.api_key = service.api_key
+        self.model = service.model
+        self.base_url = service.base_url
+        self.enable_tools = service.tools
         if self.api_key is None:
             raise ValueError(
                 f"API key for {api_service} is not set in the config.")
 
-        proxy_url = get_config(f"proxy.{get_config('proxy.use', 'ssh')}", None)
-        if get_config('proxy.enabled', False) and proxy_url:
-            self.openai_client = AsyncOpenAI(
-                api_key=self.api_key,
-                base_url=self.base_url,
-                http_client=httpx.AsyncClient(
-                    proxy=proxy_url,
-                    transport=httpx.HTTPTransport(local_address='0.0.0.0'),
-                    verify=False,
-                    timeout=600
-                )
-            )
-        else:
-            self.openai_client = AsyncOpenAI(
-                api_key=self.api_key,
-                base_url=self.base_url,
-                timeout=600
-            )
+        self.openai_client = get_openai_client(self.api_key, self.base_url)
 
     @abstractmethod
     async def send_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) -> List[Choice]:
         pass
 
-    async def send_message_mcp(self, messages: List[ChatCompletionMessageParam], mcp_url: Any) \
+    async def stream_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) \
+            -> AsyncIterator[str | Choice]:
+        """
+        Streaming version of `send_message`: yields text deltas, then the complete Choice.
+        Services without provider streaming yield the whole text at once.
+        """
+        choices = await self.send_message(messages=messages, tools=tools)
+        if not choices:
+            raise ValueError("No choices returned from the model.")
+        if choices[0].finish_reason != 'tool_calls' and choices[0].message.content:
+            yield choices[0].message.content
+        yield choices[0]
+
+    def record_usage(self, start: float, prompt_tokens: int | None, completion_tokens: int | None,
+                     cached_tokens: int | None = None):
+        """
+        Record the tokens, cost and latency of a provider call started at `start` (`time.monotonic()`).
+        """
+        service = get_settings().api_services.get(self.api_service, ApiServiceConfig())
+        prompt_tokens, completion_tokens, cached_tokens = prompt_tokens or 0, completion_tokens or 0, cached_tokens or 0
+        cached_price = service.prompt_price if service.cached_price is None else service.cached_price
+        cost = ((prompt_tokens - cached_tokens) * service.prompt_price + cached_tokens * cached_price
+                + completion_tokens * service.completion_price) / 1e6
+        record_usage(UsageRecord(
+            timestamp=time.time(),
+            service=self.api_service,
+            model=self.model,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cached_tokens=cached_tokens,
+            latency=time.monotonic() - start,
+            cost=cost
+        ))
+
+    def record_openai_usage(self, start: float, usage: CompletionUsage | None):
+        details = usage.prompt_tokens_details if usage else None
+        self.record_usage(
+            start,
+            usage.prompt_tokens if usage else 0,
+            usage.completion_tokens if usage else 0,
+            details.cached_tokens if details else 0
+        )
+
+    async def throttle(self, messages: List[ChatCompletionMessageParam]):
+        """
+        Wait until the `rpm` / `tpm` limits of this service allow the request.
+        `send_message` and `stream_message` do not throttle themselves: the tool loop and the
+        routed / cached services call this first, other callers of a bare service must too.
+        """
+        limiter = get_rate_limiter(self.api_service)
+        if limiter is not None:
+            await limiter.acquire(estimate_tokens(messages))
+
+    async def list_loop_tools(self, client: fastmcp.Client, mcp_url: Any) -> List[mcp.Tool] | Any:
+        """
+        Tools passed to `send_message` during the tool loop.
+        """
+        return await tool_list_cache.get(client, mcp_url)
+
+    async def send_message_mcp(self, messages: List[ChatCompletionMessageParam], mcp_url: Any,
+                               on_text: TextCallback | None = None, on_reset: ResetCallback | None = None) \
             -> Tuple[List[ChatCompletionMessageParam], Choice]:
+        """
+        Run the tool loop. If `on_text` is given, responses are streamed and each text delta is passed to it,
+        `on_reset` is called when the streamed text of a turn that ended in tool calls is to be discarded.
+        """
         if not self.enable_tools:
             raise ValueError("Tools are not enabled for this service.")
 
-        async with fastmcp.Client(transport=mcp_url, timeout=1800) as mcp:
-            tools = await mcp.list_tools()
-            while True:
-                choices = await self.send_message(
-                    messages=messages,
-                    tools=tools
-                )
-
-                if not choices:
-                    raise ValueError("No choices returned from the model.")
-
-                choice = choices[0]
-                if choice.finish_reason != 'tool_calls':
-                    return messages, choice
-                else:
-                    tool_name = choice.message.tool_calls[0].function.name
-                    tool_args = choice.message.tool_calls[0].function.arguments
-                    call_id = choice.message.tool_calls[0].id
-                    logger = logging.getLogger('uvicorn')
-                    header = f"{'='*20} Tool Call: {tool_name} {'='*20}"
-                    logger.info(header)
-                    logger.info(f"{'args:':<20}{tool_args}")
-                    logger.info(f"{'id:':<20}{call_id}")
-                    logger.info('=' * len(header))
-
-                    tool_response = await mcp.call_tool_mcp(
-                        name=tool_name,
-                        arguments=json.loads(tool_args),
-                        timeout=1800
-                    )
-
-                    messages.append(choice.message.model_dump())
-
-                    if call_id:
-                        messages.append({
-                            'role': 'tool',
-                            'content': tool_response.model_dump_json(),
-                            'tool_call_id': call_id
-                        })
-                    else:
-                        messages.append({
-                            'role': 'tool',
-                            'content': tool_response.model_dump_json(),
-                        })
+        return await ToolLoop(self, self.tool_loop_adapter).run(messages, mcp_url, on_text, on_reset)
 
 
 class SiliconFlowService(LLMService):
@@ -166,30 +368,47 @@ class SiliconFlowService(LLMService):
         if not self.enable_tools and len(tools) > 0:
             raise ValueError("Tools are not enabled for this service.")
 
-        tools_dict = tool_dict(tools) if self.enable_tools else NOT_GIVEN
-
+        start = time.monotonic()
         response = await self.openai_client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            tools=tools_dict,
-            extra_body={
-                'thinking_budget': 1
-            }
+            **self._completion_args(messages, tools)
         )
+        self.record_openai_usage(start, response.usage)
 
-        # extract json format tool calls
-        if response.choices:
-            for i, choice in enumerate(response.choices):
-                if choice.message.tool_calls:
-                    for j, tool_call in enumerate(choice.message.tool_calls):
-                        args = tool_call.function.arguments
-                        start_idx = args.find('{')
-                        end_idx = args.rfind('}')
-                        if start_idx != -1 and end_idx != -1:
-                            response.choices[i].message.tool_calls[j].function.arguments = args[start_idx:end_idx + 1]
+        for choice in response.choices:
+            self._extract_json_arguments(choice)
 
         return response.choices
 
+    async def stream_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) \
+            -> AsyncIterator[str | Choice]:
+        if not self.enable_tools and len(tools) > 0:
+            raise ValueError("Tools are not enabled for this service.")
+
+        async for item in stream_chat_completion(self, **self._completion_args(messages, tools)):
+            if isinstance(item, Choice):
+                self._extract_json_arguments(item)
+            yield item
+
+    def _completion_args(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) -> dict:
+        return {
+            'model': self.model,
+            'messages': messages,
+            'tools': tool_dict(tools) if self.enable_tools else NOT_GIVEN,
+            'extra_body': {
+                'thinking_budget': 1
+            }
+        }
+
+    @staticmethod
+    def _extract_json_arguments(choice: Choice):
+        # extract json format tool calls
+        for tool_call in choice.message.tool_calls or []:
+            args = tool_call.function.arguments
+            start_idx = args.find('{')
+            end_idx = args.rfind('}')
+            if start_idx != -1 and end_idx != -1:
+                tool_call.function.arguments = args[start_idx:end_idx + 1]
+
 
 class OpenAIService(LLMService):
     DEFAULT_API_SERVICE: str = 'openai'
@@ -201,17 +420,43 @@ class OpenAIService(LLMService):
             Choice]:
         tools_dict = tool_dict(tools)
 
+        start = time.monotonic()
         response = await self.openai_client.chat.completions.create(
             model=self.model,
             messages=messages,
             tools=tools_dict,
         )
+        self.record_openai_usage(start, response.usage)
 
         return response.choices
 
+    async def stream_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) \
+            -> AsyncIterator[str | Choice]:
+        async for item in stream_chat_completion(
+                self, model=self.model, messages=messages, tools=tool_dict(tools)):
+            yield item
+
+
+class GeminiOpenAIAdapter(ToolLoopAdapter):
+    """
+    Gemini's OpenAI compatible endpoint takes tool results as user messages.
+    """
+
+    def append_assistant(self, messages: List[ChatCompletionMessageParam], message: ChatCompletionMessage):
+        messages.append(message)
+
+    def append_tool_result(self, messages: List[ChatCompletionMessageParam],
+                           tool_call: ChatCompletionMessageToolCall, result: mcp.types.CallToolResult):
+        messages.append({
+            'role': 'user',
+            'content': result.model_dump_json(),
+            'tool_call_id': tool_call.id
+        })
+
 
 class GeminiOpenAIService(OpenAIService):
     DEFAULT_API_SERVICE = 'gemini'
+    tool_loop_adapter = GeminiOpenAIAdapter()
 
     def __init__(self, api_service: str = DEFAULT_API_SERVICE):
         super().__init__(api_service=api_service)
@@ -220,59 +465,17 @@ class GeminiOpenAIService(OpenAIService):
             Choice]:
         tools_dict = tool_dict(tools)
 
+        start = time.monotonic()
         response = await self.openai_client.chat.completions.create(
             model=self.model,
             messages=messages,
             tools=tools_dict,
             # reasoning_effort=None
         )
+        self.record_openai_usage(start, response.usage)
 
         return response.choices
 
-    async def send_message_mcp(self, messages: List[ChatCompletionMessageParam], mcp_url: str) \
-            -> Tuple[List[ChatCompletionMessageParam], Choice]:
-        if not self.enable_tools:
-            raise ValueError("Tools are not enabled for this service.")
-
-        async with fastmcp.Client(mcp_url, timeout=1800) as mcp:
-            tools = await mcp.list_tools()
-            while True:
-                choices = await self.send_message(
-                    messages=messages,
-                    tools=tools
-                )
-
-                if not choices:
-                    raise ValueError("No choices returned from the model.")
-
-                choice = choices[0]
-                if choice.finish_reason != 'tool_calls':
-                    return messages, choice
-                else:
-                    tool_name = choice.message.tool_calls[0].function.name
-                    tool_args = choice.message.tool_calls[0].function.arguments
-                    call_id = choice.message.tool_calls[0].id
-                    logger = logging.getLogger('uvicorn')
-                    header = f"{'='*15} Tool Call: {tool_name} {'='*15}"
-                    logger.info(header)
-                    logger.info(f"{'args:':<20}{tool_args}")
-                    logger.info(f"{'id:':<20}{call_id}")
-                    logger.info('=' * len(header))
-
-                    tool_response = await mcp.call_tool_mcp(
-                        name=tool_name,
-                        arguments=json.loads(tool_args),
-                        timeout=1800
-                    )
-
-                    messages.append(choice.message)
-
-                    messages.append({
-                        'role': 'user',
-                        'content': tool_response.model_dump_json(),
-                        'tool_call_id': call_id
-                    })
-
 
 class DeepSeekService(OpenAIService):
     DEFAULT_API_SERVICE: str = 'deepseek'
@@ -280,84 +483,34 @@ class DeepSeekService(OpenAIService):
     def __init__(self, api_service: str = DEFAULT_API_SERVICE):
         super().__init__(api_service=api_service)
 
-    async def send_message_mcp(self, messages: List[ChatCompletionMessageParam], mcp_url: Any) \
-            -> Tuple[List[ChatCompletionMessageParam], Choice]:
-        if not self.enable_tools:
-            raise ValueError("Tools are not enabled for this service.")
-
-        async with fastmcp.Client(transport=mcp_url, timeout=1800) as mcp:
-            tools = await mcp.list_tools()
-            while True:
-                choices = await self.send_message(
-                    messages=messages,
-                    tools=tools
-                )
-
-                if not choices:
-                    raise ValueError("No choices returned from the model.")
-
-                choice = choices[0]
-                if choice.finish_reason != 'tool_calls':
-                    return messages, choice
-                else:
-                    tool_name = choice.message.tool_calls[0].function.name
-                    tool_args = choice.message.tool_calls[0].function.arguments
-                    call_id = choice.message.tool_calls[0].id
-                    logger = logging.getLogger('uvicorn')
-                    header = f"{'='*20} Tool Call: {tool_name} {'='*20}"
-                    logger.info(header)
-                    logger.info(f"{'args:':<20}{tool_args}")
-                    logger.info(f"{'id:':<20}{call_id}")
-                    logger.info('=' * len(header))
-
-                    tool_response = await mcp.call_tool_mcp(
-                        name=tool_name,
-                        arguments=json.loads(tool_args),
-                        timeout=1800
-                    )
-
-                    messages.append(choice.message.model_dump())
-
-                    messages.append({
-                        'role': 'tool',
-                        'content': tool_response.model_dump_json(),
-                        'tool_call_id': call_id
-                    })
-
 # LLM Gemini Service, But implement using genai api...
 
 
 class GeminiGenAIService(LLMService):
     DEFAULT_API_SERVICE = 'gemini-genai'
+    CONTENTS_BYTES = 64 * 1024 * 1024
     gemini_client: genai.Client
+    _contents: OrderedDict[str, Tuple[int, Any]]
+    """
+    Converted contents by hash of the message, so each turn of a tool loop only converts the new
+    messages. The least recently used are dropped beyond `CONTENTS_BYTES` of messages.
+    """
 
     def __init__(self, api_service: str = DEFAULT_API_SERVICE):
-        self.api_key = get_config(f"api_services.{api_service}.api_key")
-        self.model = get_config(f"api_services.{api_service}.model")
-        self.base_url = get_config(f"api_services.{api_service}.base_url")
-        self.enable_tools = get_config(
-            f"api_services.{api_service}.tools", True)
+        service = get_settings().api_services.get(api_service, ApiServiceConfig())
+        self.api_service = api_service
+        self.api_key = service.api_key
+        self.model = service.model
+        self.base_url = service.base_url
+        self.enable_tools = service.tools
 
         if self.api_key is None:
             raise ValueError(
                 f"API key for {api_service} is not set in the config.")
 
-        proxy_url = get_config(f"proxy.{get_config('proxy.use', 'ssh')}", None)
-        if get_config('proxy.enabled', False) and proxy_url:
-            self.gemini_client = genai.Client(
-                api_key=self.api_key,
-                http_options=types.HttpOptions(
-                    base_url=self.base_url,
-                    async_client_args={'proxy': proxy_url}
-                )
-            )
-        else:
-            self.gemini_client = genai.Client(
-                api_key=self.api_key,
-                http_options=types.HttpOptions(
-                    base_url=self.base_url
-                )
-            )
+        self.gemini_client = get_genai_client(self.api_key, self.base_url)
+        self._contents = OrderedDict()
+        self._contents_bytes = 0
 
     def _openai_content_to_genai(self, content: Union[str, Iterable[ChatCompletionContentPartParam]]):
         if isinstance(content, str):
@@ -370,17 +523,16 @@ class GeminiGenAIService(LLMService):
                 elif item['type'] == 'image_url':
                     # the image_url is like data:image/png;base64,xxx
                     # we need to extract the base64 part and mime_type part
-                    b64_bytes = item['image_url']['url'].split(',')[1]
-                    mime_type = item['image_url']['url'].split(';')[0].split(':')[1]
+                    header, b64_data = item['image_url']['url'].split(',', 1)
+                    mime_type = header.split(';')[0].split(':')[1]
                     result.append(types.Part.from_bytes(
-                        data=b64_bytes,
+                        data=base64.b64decode(b64_data),
                         mime_type=mime_type
                     ))
                 elif item['type'] == 'input_audio':
-                    b64_bytes = item['input_audio']['data']
                     mime_type = f"audio/{item['input_audio']['format']}"
                     result.append(types.Part.from_bytes(
-                        data=b64_bytes,
+                        data=base64.b64decode(item['input_audio']['data']),
                         mime_type=mime_type
                     ))
                 else:
@@ -388,134 +540,366 @@ class GeminiGenAIService(LLMService):
                         f"Unsupported content part type: {type(item)}")
             return result
 
+    def _convert_message(self, message: ChatCompletionMessageParam) -> types.Content | types.Part | None:
+        if message['role'] == 'user':
+            return types.UserContent(parts=self._openai_content_to_genai(message['content']))
+        elif message['role'] == 'assistant':
+            if not message['content']:
+                return None
+            return types.ModelContent(parts=self._openai_content_to_genai(message['content']))
+        elif message['role'] == 'tool':
+            return types.Part.from_function_response(
+                name=message['tool_call_id'],
+                response={'result': message['content']}
+            )
+        elif message['role'] == 'system':
+            return None
+        else:
+            raise ValueError(
+                f"Unsupported message role: {message['role']}. Only 'user' and 'assistant' roles are supported.")
+
     def _openai_message_to_genai(self, messages: List[ChatCompletionMessageParam]) -> Union[types.ContentListUnion, types.ContentListUnionDict]:
         contents = []
         for message in messages:
-            if message['role'] == 'user':
-                contents.append(types.UserContent(parts=self._openai_content_to_genai(message['content'])))
-            elif message['role'] == 'assistant':
-                if not message['content']:
-                    continue
-                contents.append(types.ModelContent(parts=self._openai_content_to_genai(message['content'])))
-            elif message['role'] == 'tool':
-                contents.append(
-                    types.Part.from_function_response(
-                        name=message['tool_call_id'],
-                        response={'result': message['content']}
-                    )
-                )
-            elif message['role'] == 'system':
-                pass
+            payload = json.dumps(message, sort_keys=True, default=lambda x: x.model_dump(mode='json'))
+            key = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+            entry = self._contents.get(key)
+            if entry is None:
+                entry = (len(payload), self._convert_message(message))
+                self._contents[key] = entry
+                self._contents_bytes += entry[0]
+                while self._contents_bytes > self.CONTENTS_BYTES:
+                    self._contents_bytes -= self._contents.popitem(last=False)[1][0]
             else:
-                raise ValueError(
-                    f"Unsupported message role: {message['role']}. Only 'user' and 'assistant' roles are supported.")
+                self._contents.move_to_end(key)
+            if entry[1] is not None:
+                contents.append(entry[1])
         return contents
 
-    async def send_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) -> List[Choice]:
-        # tools as mcp transport
-        async with fastmcp.Client(tools) as mcp_server:
-            system_prompts = '\n'.join([str(x['content']) for x in messages if x['role'] == 'system'])
-            response = await self.gemini_client.aio.models.generate_content(
-                model=self.model,
-                contents=self._openai_message_to_genai(messages),
-                config=types.GenerateContentConfig(
-                    system_instruction=system_prompts,
-                    tools=[mcp_server.session],
-                    thinking_config=types.ThinkingConfig(thinking_budget=0),
-                    automatic_function_calling=types.AutomaticFunctionCallingConfig(
-                        disable=True
-                    )
+    def _generate_args(self, messages: List[ChatCompletionMessageParam], tools: List[types.Tool]) -> dict:
+        system_prompts = '\n'.join([str(x['content']) for x in messages if x['role'] == 'system'])
+        return {
+            'model': self.model,
+            'contents': self._openai_message_to_genai(messages),
+            'config': types.GenerateContentConfig(
+                system_instruction=system_prompts,
+                tools=tools,
+                thinking_config=types.ThinkingConfig(thinking_budget=0),
+                automatic_function_calling=types.AutomaticFunctionCallingConfig(
+                    disable=True
                 )
             )
+        }
 
-            if not response.candidates:
-                raise ValueError("No candidates returned from the model.")
-
-            # text response
-            candidate = response.candidates[0]
-
-            choice = None
-            # function call
-            for part in candidate.content.parts:
-                if part.function_call:
-                    choice = Choice(
-                        finish_reason='tool_calls',
-                        index=0,
-                        message=ChatCompletionMessage(
-                            role='assistant',
-                            content=None,
-                            tool_calls=[
-                                ChatCompletionMessageToolCall(
-                                    id=part.function_call.name,
-                                    function={'name': part.function_call.name, 'arguments': json.dumps(part.function_call.args)},
-                                    type='function'
-                                )
-                            ]
-                        )
-                    )
-
-                    return [choice]
-
-            text = '\n'.join([str(x.text) for x in candidate.content.parts if x.text is not None])
-            choice = Choice(
-                finish_reason='stop',
+    @staticmethod
+    def _parts_to_choice(parts: List[types.Part], text_separator: str = '\n') -> Choice:
+        # function calls, the model may request several in one turn
+        tool_calls = [
+            ChatCompletionMessageToolCall(
+                id=part.function_call.name,
+                function={'name': part.function_call.name, 'arguments': json.dumps(part.function_call.args)},
+                type='function'
+            )
+            for part in parts if part.function_call
+        ]
+        if tool_calls:
+            return Choice(
+                finish_reason='tool_calls',
                 index=0,
                 message=ChatCompletionMessage(
-                    content=text,
-                    role='assistant'
+                    role='assistant',
+                    content=None,
+                    tool_calls=tool_calls
                 )
             )
 
-            return [choice]
+        # text response
+        text = text_separator.join([str(x.text) for x in parts if x.text is not None])
+        return Choice(
+            finish_reason='stop',
+            index=0,
+            message=ChatCompletionMessage(
+                content=text,
+                role='assistant'
+            )
+        )
+
+    async def send_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) -> List[Choice]:
+        # tools as gemini function declarations, see list_loop_tools
+        start = time.monotonic()
+        response = await self.gemini_client.aio.models.generate_content(
+            **self._generate_args(messages, tools)
+        )
+        self._record_genai_usage(start, response.usage_metadata)
+
+        if not response.candidates:
+            raise ValueError("No candidates returned from the model.")
+
+        return [self._parts_to_choice(response.candidates[0].content.parts)]
+
+    async def stream_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) \
+            -> AsyncIterator[str | Choice]:
+        parts = []
+        usage = None
+        start = time.monotonic()
+        async for chunk in await self.gemini_client.aio.models.generate_content_stream(
+                **self._generate_args(messages, tools)):
+            usage = chunk.usage_metadata or usage
+            if not chunk.candidates or not chunk.candidates[0].content:
+                continue
+            for part in chunk.candidates[0].content.parts or []:
+                parts.append(part)
+                if part.text:
+                    yield part.text
+
+        self._record_genai_usage(start, usage)
+        if not parts:
+            raise ValueError("No candidates returned from the model.")
+
+        # streamed text parts are fragments of one text, join them without separator
+        yield self._parts_to_choice(parts, text_separator='')
+
+    def _record_genai_usage(self, start: float, usage: types.GenerateContentResponseUsageMetadata | None):
+        self.record_usage(
+            start,
+            usage.prompt_token_count if usage else 0,
+            usage.candidates_token_count if usage else 0,
+            usage.cached_content_token_count if usage else 0
+        )
+
+    async def list_loop_tools(self, client: fastmcp.Client, mcp_url: Any) -> List[mcp.Tool] | Any:
+        # the tools of the loop's own session, the tool loop runs the calls itself
+        return genai_tools(await tool_list_cache.get(client, mcp_url))
+
+
+class StubLLMService(LLMService):
+    """
+    LLM service answering locally without any provider. Used by benchmarks.
+    Set `latency` in its `api_services` entry to simulate provider latency (seconds).
+    """
+    DEFAULT_API_SERVICE = 'stub'
+    latency: float
+
+    def __init__(self, api_service: str = DEFAULT_API_SERVICE):
+        service = get_settings().api_services.get(api_service, ApiServiceConfig())
+        self.api_service = api_service
+        self.api_key = service.api_key or ''
+        self.model = service.model or 'stub'
+        self.base_url = ''
+        self.enable_tools = service.tools
+        self.latency = getattr(service, 'latency', 0.0)
+
+    async def send_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) -> List[Choice]:
+        start = time.monotonic()
+        await asyncio.sleep(self.latency)
+        self.record_usage(start, 0, 0)
+
+        content = messages[-1]['content'] if messages else ''
+        if not isinstance(content, str):
+            content = ' '.join(x['text'] for x in content if x['type'] == 'text')
+
+        return [Choice(
+            finish_reason='stop',
+            index=0,
+            message=ChatCompletionMessage(
+                role='assistant',
+                content=f"Stub response to: {content[:100]}"
+            )
+        )]
+
+    async def stream_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) \
+            -> AsyncIterator[str | Choice]:
+        choice = (await self.send_message(messages, tools))[0]
+        for i, word in enumerate(choice.message.content.split(' ')):
+            yield f" {word}" if i else word
+        yield choice
 
-    async def send_message_mcp(self, messages: List[ChatCompletionMessageParam], mcp_url: Any) \
+    async def send_message_mcp(self, messages: List[ChatCompletionMessageParam], mcp_url: Any,
+                               on_text: TextCallback | None = None, on_reset: ResetCallback | None = None) \
             -> Tuple[List[ChatCompletionMessageParam], Choice]:
-        if not self.enable_tools:
-            raise ValueError("Tools are not enabled for this service.")
+        # the stub never calls tools, so there is no need to start the MCP server
+        if on_text is None:
+            return messages, (await self.send_message(messages, []))[0]
 
-        async with fastmcp.Client(transport=mcp_url, timeout=1800) as mcp:
-            while True:
-                choices = await self.send_message(
-                    messages=messages,
-                    tools=mcp_url
-                )
+        async for item in self.stream_message(messages, []):
+            if isinstance(item, Choice):
+                return messages, item
+            await on_text(item)
 
-                if not choices:
-                    raise ValueError("No choices returned from the model.")
 
-                choice = choices[0]
-                if choice.finish_reason != 'tool_calls':
-                    return messages, choice
-                else:
-                    tool_name = choice.message.tool_calls[0].function.name
-                    tool_args = choice.message.tool_calls[0].function.arguments
-                    call_id = choice.message.tool_calls[0].id
-                    logger = logging.getLogger('uvicorn')
-                    header = f"{'='*20} Tool Call: {tool_name} {'='*20}"
-                    logger.info(header)
-                    logger.info(f"{'args:':<20}{tool_args}")
-                    logger.info(f"{'id:':<20}{call_id}")
-                    logger.info('=' * len(header))
-
-                    tool_response = await mcp.call_tool_mcp(
-                        name=tool_name,
-                        arguments=json.loads(tool_args),
-                        timeout=1800
-                    )
-
-                    messages.append(choice.message.model_dump())
-
-                    if call_id:
-                        messages.append({
-                            'role': 'tool',
-                            'content': tool_response.model_dump_json(),
-                            'tool_call_id': call_id
-                        })
-                    else:
-                        messages.append({
-                            'role': 'tool',
-                            'content': tool_response.model_dump_json(),
-                        })
+# generated IDs and timestamps in a request: uuids, ISO times, tool call IDs
+_VOLATILE_ID = re.compile(
+    r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+    r'|\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?'
+    r'|(?<="tool_call_id": ")[^"]+|(?<="id": ")[^"]+'
+)
+
+
+class ReplayLLMService(LLMService):
+    """
+    Deterministic offline LLM service. Its `api_services` entry sets:
+
+    - `mode`: `record` sends the requests to the `upstream` service and appends each request
+      and its response to the trace file, `replay` answers from the trace file without any provider.
+    - `upstream`: name of the recorded service, also in replay mode as it decides the tool
+      and history format.
+    - `trace`: path of the trace file (JSON lines), `data/llm_traces/<name>.jsonl` by default.
+      Relative paths are relative to `net_simulator`.
+    - `latency`: synthetic latency of replayed responses in seconds, the recorded latency
+      times `latency_scale` if not set.
+
+    A request is replayed by the hash of its messages, or of its last message if the history
+    differs. Generated IDs (uuids such as task IDs, tool call IDs) and timestamps are replaced
+    by placeholders numbered in order of appearance before hashing. Repeated requests replay
+    their recorded responses in order. A request matching neither hash gets the response
+    recorded after the last one served to the same agent.
+    """
+    DEFAULT_API_SERVICE = 'replay'
+    mode: str
+    upstream: str
+    trace: Path
+    latency: float | None
+    latency_scale: float
+    _entries: Dict[str, List[dict]] | None
+    _sequences: Dict[str, List[dict]]
+    _served: Dict[str, int]
+    _next: Dict[str, int]
+
+    def __init__(self, api_service: str = DEFAULT_API_SERVICE):
+        service = get_settings().api_services.get(api_service, ApiServiceConfig())
+        self.api_service = api_service
+        self.mode = getattr(service, 'mode', 'replay')
+        self.upstream = getattr(service, 'upstream', OpenAIService.DEFAULT_API_SERVICE)
+        trace = getattr(service, 'trace', None)
+        # relative to net_simulator, like the default
+        self.trace = cwd / trace if trace else cwd / 'data' / 'llm_traces' / f"{api_service}.jsonl"
+        self.latency = getattr(service, 'latency', None)
+        self.latency_scale = getattr(service, 'latency_scale', 1.0)
+        self._entries = None
+        self._sequences = {}
+        self._served = {}
+        self._next = {}
+
+        if self.mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown mode {self.mode} of {api_service}, expected 'record' or 'replay'.")
+
+        upstream_class = llm_mapping.get(self.upstream, OpenAIService)
+        self.tool_loop_adapter = upstream_class.tool_loop_adapter
+        if self.mode == 'record':
+            llm = create_llm(self.upstream)
+            self.api_key, self.model, self.base_url = llm.api_key, llm.model, llm.base_url
+            self.enable_tools = llm.enable_tools
+        else:
+            self.api_key = service.api_key or ''
+            self.model = service.model or self.upstream
+            self.base_url = ''
+            self.enable_tools = service.tools
+
+    @staticmethod
+    def _hash(messages: List[ChatCompletionMessageParam]) -> str:
+        payload = json.dumps(
+            messages, sort_keys=True, ensure_ascii=False,
+            default=lambda x: x.model_dump(mode='json') if hasattr(x, 'model_dump') else repr(x))
+        placeholders = {}
+        payload = _VOLATILE_ID.sub(lambda m: placeholders.setdefault(m.group(0), f"<id{len(placeholders)}>"), payload)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _keys(cls, messages: List[ChatCompletionMessageParam]) -> Tuple[str, str]:
+        return cls._hash(messages), cls._hash(messages[-1:])
+
+    @staticmethod
+    def _agent() -> str:
+        return current_agent.get() or usage_context.get().agent_id or ''
+
+    def _record(self, messages: List[ChatCompletionMessageParam], choice: Choice, latency: float):
+        key, tail = self._keys(messages)
+        line = json.dumps({
+            'key': key,
+            'tail': tail,
+            'agent': self._agent(),
+            'latency': latency,
+            'choice': choice.model_dump(mode='json')
+        }, ensure_ascii=False)
+        self.trace.parent.mkdir(parents=True, exist_ok=True)
+        # one write per line, the agents of a recording may share the trace file
+        with open(self.trace, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def _load(self) -> Dict[str, List[dict]]:
+        if self._entries is None:
+            if not self.trace.exists():
+                raise ValueError(f"Trace file {self.trace} of {self.api_service} does not exist, record it first.")
+            self._entries = {}
+            with open(self.trace, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        sequence = self._sequences.setdefault(entry.get('agent') or '', [])
+                        entry['position'] = len(sequence)
+                        sequence.append(entry)
+                        self._entries.setdefault(entry['key'], []).append(entry)
+                        if entry['tail'] != entry['key']:
+                            self._entries.setdefault(entry['tail'], []).append(entry)
+        return self._entries
+
+    async def _replay(self, messages: List[ChatCompletionMessageParam]) -> Choice:
+        entries = self._load()
+        agent = self._agent()
+        for key in self._keys(messages):
+            if key in entries:
+                served = self._served.get(key, 0)
+                self._served[key] = served + 1
+                entry = entries[key][served % len(entries[key])]
+                break
+        else:
+            sequence = self._sequences.get(agent, [])
+            position = self._next.get(agent, 0)
+            if position >= len(sequence):
+                raise ValueError(f"No response recorded in {self.trace} for this request.")
+            entry = sequence[position]
+        if (entry.get('agent') or '') == agent:
+            self._next[agent] = entry['position'] + 1
+
+        start = time.monotonic()
+        latency = self.latency if self.latency is not None else entry['latency'] * self.latency_scale
+        await asyncio.sleep(latency)
+        self.record_usage(start, 0, 0)
+        return Choice.model_validate(entry['choice'])
+
+    async def send_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) -> List[Choice]:
+        if self.mode == 'replay':
+            return [await self._replay(messages)]
+
+        start = time.monotonic()
+        choices = await create_llm(self.upstream).send_message(messages, tools)
+        self._record(messages, choices[0], time.monotonic() - start)
+        return choices
+
+    async def stream_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) \
+            -> AsyncIterator[str | Choice]:
+        if self.mode == 'replay':
+            choice = await self._replay(messages)
+            if choice.message.content:
+                for i, word in enumerate(choice.message.content.split(' ')):
+                    yield f" {word}" if i else word
+            yield choice
+            return
+
+        start = time.monotonic()
+        async for item in create_llm(self.upstream).stream_message(messages, tools):
+            if isinstance(item, Choice):
+                self._record(messages, item, time.monotonic() - start)
+            yield item
+
+    async def throttle(self, messages: List[ChatCompletionMessageParam]):
+        if self.mode == 'record':
+            await create_llm(self.upstream).throttle(messages)
+
+    async def list_loop_tools(self, client: fastmcp.Client, mcp_url: Any) -> List[mcp.Tool] | Any:
+        if self.mode == 'record':
+            return await create_llm(self.upstream).list_loop_tools(client, mcp_url)
+        return await super().list_loop_tools(client, mcp_url)
 
 
 llm_mapping = {
@@ -523,87 +907,306 @@ llm_mapping = {
     'gemini': GeminiOpenAIService,
     'silicon-flow': SiliconFlowService,
     'deepseek': DeepSeekService,
-    'gemini-genai': GeminiGenAIService
+    'gemini-genai': GeminiGenAIService,
+    'stub': StubLLMService,
+    'replay': ReplayLLMService
 }
 
 
-def get_llm() -> OpenAIService | GeminiOpenAIService | SiliconFlowService:
-    api_service = get_config('api_service', OpenAIService.DEFAULT_API_SERVICE)
-    if api_service in llm_mapping:
-        return llm_mapping[api_service](api_service=api_service)
-    else:
-        return OpenAIService(api_service=api_service)
+class RoutedLLMService(LLMService):
+    """
+    Sends requests to `api_service` and fails over to the `llm_routing.fallbacks` services.
+    Transient errors are retried with jittered exponential backoff within the process-wide retry
+    budget, and providers whose circuit breaker is open are skipped.
 
-# file system
+    With `hedge`, a request the primary service has not answered within its usual latency is
+    also sent to the next service, the first answer wins and the other request is cancelled.
+    Streams are not hedged.
+    """
+
+    services: List[Tuple[str, LLMService]]
+    hedge: bool
+    logger: logging.Logger
+
+    def __init__(self, api_service: str, fallbacks: List[str], hedge: bool = False):
+        self.logger = logging.getLogger('uvicorn')
+        self.hedge = hedge
+        primary = create_llm(api_service)
+        self.services = [(api_service, primary)]
+        for name in fallbacks:
+            if name == api_service or name not in get_settings().api_services:
+                self.logger.warning(f"Fallback LLM service {name} is not configured, skipping it.")
+                continue
+            service = create_llm(name)
+            if not self._compatible(primary, service):
+                self.logger.warning(
+                    f"Fallback LLM service {name} is not compatible with {api_service}, skipping it.")
+                continue
+            self.services.append((name, service))
+
+        self.api_service = api_service
+        self.api_key = primary.api_key
+        self.model = primary.model
+        self.base_url = primary.base_url
+        self.enable_tools = primary.enable_tools
+        self.tool_loop_adapter = primary.tool_loop_adapter
+
+    @staticmethod
+    def _compatible(primary: LLMService, fallback: LLMService) -> bool:
+        # the fallback must take the same tools and history format as the primary service
+        return type(primary).list_loop_tools is type(fallback).list_loop_tools \
+            and type(primary.tool_loop_adapter) is type(fallback.tool_loop_adapter) \
+            and (fallback.enable_tools or not primary.enable_tools)
+
+    async def _route(self, call: Callable[[LLMService], Awaitable[T]], messages: List[ChatCompletionMessageParam],
+                     first: int = 0) -> T:
+        options = get_settings().llm_routing
+        retry_budget.record_request()
+        error = None
+        for attempt in range(options.max_attempts):
+            # each attempt moves on to the next provider, back off once all were tried
+            offset = (first + attempt) % len(self.services)
+            if attempt > 0:
+                if not retry_budget.try_retry():
+                    self.logger.warning('LLM retry budget exhausted.', extra={'category': 'llm_routing'})
+                    break
+                if offset == first:
+                    delay = retry_after(error) or backoff_delay(attempt // len(self.services) - 1, options)
+                    await asyncio.sleep(min(delay, options.backoff_max))
+
+            candidates = self.services[offset:] + self.services[:offset]
+            selected = next(((name, service) for name, service in candidates if get_breaker(name).allow()), None)
+            if selected is None:
+                break
+            name, service = selected
+
+            try:
+                await service.throttle(messages)
+                start = time.monotonic()
+                result = await call(service)
+            except Exception as e:
+                # caller-side errors (bad request) say nothing about the provider's health
+                if not is_retryable(e):
+                    raise
+                get_breaker(name).record_failure()
+                error = e
+                self.logger.warning(
+                    f"LLM service {name} failed (attempt {attempt + 1}/{options.max_attempts}): {e}",
+                    extra={'category': 'llm_routing', 'service': name})
+                continue
+
+            get_breaker(name).record_success()
+            get_latencies(name).record(time.monotonic() - start)
+            return result
+
+        if error is None:
+            raise RuntimeError('No LLM service available, all circuit breakers are open.')
+        raise error
+
+    async def _hedge(self, call: Callable[[LLMService], Awaitable[T]], messages: List[ChatCompletionMessageParam]) -> T:
+        latencies = get_latencies(self.services[0][0])
+        delay = latencies.hedge_delay()
+        hedge_stats['requests'] += 1
+        start = time.monotonic()
+
+        primary = asyncio.ensure_future(self._route(call, messages))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            # hedges are extra load, they share the retry budget
+            if done or not retry_budget.try_retry():
+                return await primary
+
+            hedge_stats['hedged'] += 1
+            self.logger.info(f"LLM request not answered in {delay:.2f}s, hedging.", extra={'category': 'llm_routing'})
+            secondary = asyncio.ensure_future(self._route(call, messages, first=1))
+            pending.add(secondary)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                answered = [x for x in done if x.exception() is None]
+                if not answered:
+                    # the other request may still answer
+                    if not pending:
+                        raise done.pop().exception()
+                    continue
+                if secondary in answered and primary not in answered:
+                    elapsed = time.monotonic() - start
+                    hedge_stats['hedge_wins'] += 1
+                    expected = latencies.expected_beyond(elapsed)
+                    if expected is not None:
+                        hedge_stats['saved_seconds'] += expected - elapsed
+                return answered[0].result()
+        finally:
+            for task in pending:
+                task.cancel()
 
+    async def send_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) -> List[Choice]:
+        def call(service: LLMService):
+            return service.send_message(messages=messages, tools=tools)
+
+        if self.hedge and len(self.services) > 1:
+            return await self._hedge(call, messages)
+        return await self._route(call, messages)
+
+    async def stream_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) \
+            -> AsyncIterator[str | Choice]:
+        async def _open(service: LLMService):
+            stream = service.stream_message(messages=messages, tools=tools)
+            return stream, await anext(stream)
+
+        # a stream can only fail over until its first item, later errors are raised
+        stream, first = await self._route(_open, messages)
+        yield first
+        async for item in stream:
+            yield item
+
+    async def throttle(self, messages: List[ChatCompletionMessageParam]):
+        # each service is throttled by `_route` before it is called
+        pass
+
+    async def list_loop_tools(self, client: fastmcp.Client, mcp_url: Any) -> List[mcp.Tool] | Any:
+        return await self.services[0][1].list_loop_tools(client, mcp_url)
 
-def create_file(b64_bytes: str, media_type: str) -> str:
+
+class CachedLLMService(LLMService):
     """
-    Create a file in the file system and return its ID.
+    Answers identical requests from the `llm_cache` before they reach `service`, so the tool
+    loop and direct `send_message` / `stream_message` callers share the cache. Cache hits are
+    not throttled; a hit on a stream yields the whole text at once.
     """
-    file_id = str(uuid4())
-    fs_folder = cwd / 'data' / 'filesystem'
-    fs_folder.mkdir(parents=True, exist_ok=True)
 
-    fs_index_json = fs_folder / 'index.json'
-    if not fs_index_json.exists():
-        fs_index_json.write_text('{}')
+    service: LLMService
 
-    file_id = str(uuid4())
-    file_path = fs_folder / file_id
-    with open(file_path, 'wb') as f:
-        f.write(b64_bytes.encode('utf-8'))
+    def __init__(self, service: LLMService):
+        self.service = service
+        self.api_service = service.api_service
+        self.api_key = service.api_key
+        self.model = service.model
+        self.base_url = service.base_url
+        self.enable_tools = service.enable_tools
+        self.tool_loop_adapter = service.tool_loop_adapter
+
+    async def send_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) -> List[Choice]:
+        cache = get_llm_cache()
+        key = cache_key(self.model, messages, tools) if cache else None
+        choice = await cache.get(key) if cache else None
+        if choice is not None:
+            return [choice]
+
+        await self.service.throttle(messages)
+        choices = await self.service.send_message(messages=messages, tools=tools)
+        if cache and choices:
+            await cache.put(key, choices[0])
+        return choices
+
+    async def stream_message(self, messages: List[ChatCompletionMessageParam], tools: List[mcp.Tool] | Any) \
+            -> AsyncIterator[str | Choice]:
+        cache = get_llm_cache()
+        key = cache_key(self.model, messages, tools) if cache else None
+        choice = await cache.get(key) if cache else None
+        if choice is not None:
+            if choice.finish_reason != 'tool_calls' and choice.message.content:
+                yield choice.message.content
+            yield choice
+            return
+
+        await self.service.throttle(messages)
+        async for item in self.service.stream_message(messages=messages, tools=tools):
+            if cache and isinstance(item, Choice):
+                await cache.put(key, item)
+            yield item
+
+    async def throttle(self, messages: List[ChatCompletionMessageParam]):
+        # the wrapped service is throttled on cache misses only
+        pass
+
+    async def list_loop_tools(self, client: fastmcp.Client, mcp_url: Any) -> List[mcp.Tool] | Any:
+        return await self.service.list_loop_tools(client, mcp_url)
 
-    with open(fs_index_json, 'r+', encoding='utf-8') as f:
-        index = json.load(f)
-        index[file_id] = {
-            'media_type': media_type,
-        }
-        f.seek(0)
-        json.dump(index, f, indent=2)
 
-    return file_id
+_llm_services: Dict[str, LLMService] = {}
+
+
+def create_llm(api_service: str) -> LLMService:
+    # services only hold config and shared clients, so one instance per service is enough
+    if api_service not in _llm_services:
+        service_class = llm_mapping.get(api_service, OpenAIService)
+        _llm_services[api_service] = service_class(api_service=api_service)
+    return _llm_services[api_service]
+
+
+def get_llm(hedge: bool = False) -> LLMService:
+    """
+    Get the LLM service of this process. `hedge` is for interactive requests, it takes effect
+    if `llm_routing.hedge` is on and a fallback service is configured.
+    """
+    settings = get_settings()
+    if not settings.llm_routing.enabled:
+        key, service = settings.api_service, create_llm(settings.api_service)
+    else:
+        hedge = hedge and settings.llm_routing.hedge
+        key = f"{'hedged' if hedge else 'routed'}:{settings.api_service}"
+        if key not in _llm_services:
+            _llm_services[key] = RoutedLLMService(settings.api_service, settings.llm_routing.fallbacks, hedge)
+        service = _llm_services[key]
+
+    if not settings.llm_cache.enabled:
+        return service
+    if f"cached:{key}" not in _llm_services:
+        _llm_services[f"cached:{key}"] = CachedLLMService(service)
+    return _llm_services[f"cached:{key}"]
+
+
+@on_config_change
+def _reset_llm_services(old: Config, new: Config):
+    if old.api_services != new.api_services or old.proxy != new.proxy \
+            or old.llm_routing.fallbacks != new.llm_routing.fallbacks:
+        _llm_services.clear()
+
+# file system
+
+
+def create_file(b64_bytes: str, media_type: str, holder: str | None = None, owner: str | None = None) -> str:
+    """
+    Create a file in the file system and return its ID.
+    The file is kept while `holder` references it, see `FileStore.create`.
+    """
+    return get_file_store().create(base64.b64decode(b64_bytes), media_type, holder=holder, owner=owner)
 
 
 def get_file(file_id: str) -> Tuple[str, str] | None:
     """
     Get a file from the file system by its ID.
-    Returns the file's content and media type.
+    Returns the file's base64 content and media type.
     """
-    fs_folder = cwd / 'data' / 'filesystem'
-    fs_index_json = fs_folder / 'index.json'
+    return get_file_store().get(file_id)
 
-    if not fs_index_json.exists():
-        fs_index_json.write_text('{}')
 
-    with open(fs_index_json, 'r', encoding='utf-8') as f:
-        index = json.load(f)
+def read_file(file_id: str) -> Tuple[memoryview, str] | None:
+    """
+    Get a file from the file system by its ID without copying or encoding it.
+    Returns a read-only view of the file's content and its media type.
+    """
+    return get_file_store().read(file_id)
 
-    if file_id not in index:
-        return None
 
-    file_path = fs_folder / file_id
-    if not file_path.exists():
-        return None
+def acquire_file(file_id: str, holder: str, owner: str | None = None) -> bool:
+    """
+    Keep a file while `holder` uses it, charged to the quota of `owner`.
+    Returns False if there is no such file, raises ValueError if the quota is exceeded.
+    """
+    return get_file_store().acquire(file_id, holder, owner=owner)
 
-    with open(file_path, 'rb') as f:
-        content = f.read()
 
-    return content.decode('utf-8'), index[file_id]['media_type']
+def release_files(holder: str) -> None:
+    """
+    Drop the references of `holder` to files.
+    """
+    get_file_store().release_all(holder)
 
 
 def clear_files() -> None:
     """
     Clear all files in the file system.
     """
-    fs_folder = cwd / 'data' / 'filesystem'
-    if fs_folder.exists():
-        for item in fs_folder.iterdir():
-            if item.is_file():
-                item.unlink()
-        fs_index_json = fs_folder / 'index.json'
-        if fs_index_json.exists():
-            fs_index_json.unlink()  # Remove the index file
-    else:
-        # Ensure the folder exists
-        fs_folder.mkdir(parents=True, exist_ok=True)
+    get_file_store().clear()